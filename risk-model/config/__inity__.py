@@ -1,4 +1,5 @@
 from .params import SIMULATION_PARAMS
-from .scenarios import generate_scenario_params
+from .scenarios import generate_scenario_params, iter_scenario_params, parse_scenario_filters
 
-__all__ = ['SIMULATION_PARAMS', 'generate_scenario_params']
+__all__ = ['SIMULATION_PARAMS', 'generate_scenario_params', 'iter_scenario_params',
+           'parse_scenario_filters']
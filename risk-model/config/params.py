@@ -26,9 +26,24 @@ SIMULATION_PARAMS = {
     # Liquidation parameters
     'collateralisation_ratio': 150,  # Percentage
     'health_factor_liquidation_threshold': 100,  # health factor
+    # Order in which queued vaults are liquidated: 'fifo' (queue order),
+    # 'worst_health_first' or 'largest_debt_first'
+    'liquidation_order': 'fifo',
 
     # Reserve fund parameters
     'reserve_fund_percentage_of_debt': 0.10,
+
+    # Performance parameters
+    # Run silent simulations as an analytic queue recurrence when the price
+    # never rises (the step engine is used otherwise)
+    'use_fast_path': True,
+    # Run the fast path's queue steps in a Numba-compiled kernel (uses the
+    # NumPy implementation when numba is not installed)
+    'use_jit_kernel': False,
+
+    # Debug parameters
+    # Cross-check the incremental protocol metrics against a full recompute
+    'debug_metrics': False,
 }
 
 
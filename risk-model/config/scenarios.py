@@ -1,4 +1,5 @@
-from typing import Dict, Any
+from fnmatch import fnmatchcase
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 # Risk setups
 RISK_SETUPS = {
@@ -108,15 +109,106 @@ PRICE_SCENARIOS = {
 }
 
 
-def generate_scenario_params(base_params: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
-    """Generate all combinations of scenarios with different risk and scale setups"""
-    scenarios = {}
+# Scenario dimensions a filter can select on, see parse_scenario_filters
+SCENARIO_DIMENSIONS = {
+    'price': PRICE_SCENARIOS,
+    'risk': RISK_SETUPS,
+    'scale': SCALE_SETUPS,
+}
+
 
+def parse_scenario_filters(expressions: Iterable[str]) -> Dict[str, List[str]]:
+    """
+    Parse filter expressions such as risk=high_risk or price=*_7_days
+
+    Each expression is dimension=pattern, with a dimension of
+    SCENARIO_DIMENSIONS, or a bare pattern matched against the whole scenario
+    name. Patterns are shell-style wildcards and may list alternatives
+    separated by commas. A scenario matches when it matches every dimension
+    that is filtered; repeating a dimension adds alternatives.
+
+    Returns:
+        dict: Patterns by dimension, 'name' for the bare patterns
+    """
+    filters: Dict[str, List[str]] = {}
+    for expression in expressions:
+        dimension, separator, patterns = expression.partition('=')
+        if not separator:
+            dimension, patterns = 'name', expression
+        dimension = dimension.strip()
+        if dimension not in SCENARIO_DIMENSIONS and dimension != 'name':
+            raise ValueError(
+                f"Unknown scenario filter {dimension!r} in {expression!r}, expected one of "
+                f"{', '.join(SCENARIO_DIMENSIONS)} or name")
+        patterns = [pattern.strip() for pattern in patterns.split(',') if pattern.strip()]
+        if not patterns:
+            raise ValueError(f"Empty scenario filter {expression!r}")
+        filters.setdefault(dimension, []).extend(patterns)
+    return filters
+
+
+def _matches(filters: Optional[Dict[str, List[str]]], dimension: str, value: str) -> bool:
+    """Whether a value passes the filter of one dimension"""
+    if not filters or dimension not in filters:
+        return True
+    return any(fnmatchcase(value, pattern) for pattern in filters[dimension])
+
+
+def split_scenario_name(scenario_name: str) -> Optional[Dict[str, str]]:
+    """Price scenario, risk setup and scale setup of a generated scenario name"""
+    for risk_setup_name in RISK_SETUPS:
+        for scale_setup_name in SCALE_SETUPS:
+            suffix = f"_{risk_setup_name}_{scale_setup_name}"
+            if scenario_name.endswith(suffix):
+                return {'price': scenario_name[:-len(suffix)],
+                        'risk': risk_setup_name, 'scale': scale_setup_name}
+    return None
+
+
+def scenario_matches(scenario_name: str, filters: Optional[Dict[str, List[str]]]) -> bool:
+    """
+    Whether a scenario name passes parsed filters
+
+    Names that are not of the generated format only pass filters on the name.
+    """
+    if not filters:
+        return True
+    parts = split_scenario_name(scenario_name) or {}
+    parts['name'] = scenario_name
+    return all(dimension in parts and _matches(filters, dimension, parts[dimension])
+               for dimension in filters)
+
+
+def iter_scenario_params(base_params: Dict[str, Any],
+                         filters: Optional[Dict[str, List[str]]] = None
+                         ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily generate the combinations of price scenarios with risk and scale setups
+
+    Filtered out dimensions are skipped before any of their scenarios are
+    built, so selecting a few cells of the grid costs only those cells.
+
+    Args:
+        base_params (dict): Parameters every scenario starts from
+        filters (dict, optional): Filters of parse_scenario_filters
+
+    Yields:
+        tuple: (scenario_name, scenario_params) in grid order
+    """
     for price_scenario_name, price_scenario in PRICE_SCENARIOS.items():
+        if not _matches(filters, 'price', price_scenario_name):
+            continue
         for risk_setup_name, risk_setup in RISK_SETUPS.items():
+            if not _matches(filters, 'risk', risk_setup_name):
+                continue
             for scale_setup_name, scale_setup in SCALE_SETUPS.items():
+                if not _matches(filters, 'scale', scale_setup_name):
+                    continue
+
                 # Create scenario name
                 scenario_name = f"{price_scenario_name}_{risk_setup_name}_{scale_setup_name}"
+                if not _matches(filters, 'name', scenario_name):
+                    continue
 
                 # Start with base parameters
                 scenario_params = base_params.copy()
@@ -144,6 +236,11 @@ def generate_scenario_params(base_params: Dict[str, Any]) -> Dict[str, Dict[str,
                     )
                 })
 
-                scenarios[scenario_name] = scenario_params
+                yield scenario_name, scenario_params
+
 
-    return scenarios
+def generate_scenario_params(base_params: Dict[str, Any],
+                             filters: Optional[Dict[str, List[str]]] = None
+                             ) -> Dict[str, Dict[str, Any]]:
+    """Generate all combinations of scenarios with different risk and scale setups"""
+    return dict(iter_scenario_params(base_params, filters))
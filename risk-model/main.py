@@ -3,26 +3,86 @@ from pathlib import Path
 from datetime import datetime
 import re
 from services.simulation import Simulation
-from config.scenarios import generate_scenario_params
+from config.scenarios import iter_scenario_params, parse_scenario_filters, scenario_matches
 from config.params import SIMULATION_PARAMS
 from report.report_generator import ReportGenerator
-from run_scenarios import run_batch_simulations
+import numpy as np
+from run_scenarios import run_batch_simulations, get_population_key, get_seed_sequence
+from services.result_cache import ResultCache
+from services.population_store import PopulationStore
+from services.vault_snapshot import load_vault_snapshot
+from profiler import Profiler, PROFILE_EXPORTS
+from models.vault_queue import LIQUIDATION_ORDERS
+from run_benchmarks import run_benchmarks, BENCHMARKS, DEFAULT_SIZES, DEFAULT_BASELINE, DEFAULT_TOLERANCE
+from run_solver import run_solver, SOLVER_PARAMETERS, SOLVER_OUTCOMES, SOLVER_SEED, DEFAULT_THRESHOLD
 
 
-def run_single_simulation():
+def write_profile(profiler, base_path, exports):
+    """Print a run's profile and write it next to its results"""
+    profiler.print_summary()
+    paths = profiler.write(base_path, exports)
+    print(f"\nProfile written to: {', '.join(str(path) for path in paths)}")
+
+
+def load_population(params, population_store=None, seed=None, vaults_file=None):
+    """
+    Vault population of a single run: a snapshot of real vaults, or one from
+    the population store
+
+    Returns:
+        tuple: (params, population) - params with num_vaults set to the
+            snapshot's size; population is None when neither source is given
+    """
+    if vaults_file is not None:
+        # Real vaults replace the sampled population
+        population = load_vault_snapshot(vaults_file, SIMULATION_PARAMS['start_price'])
+        return {**params, 'num_vaults': len(population),
+                'scenario_description': f'Vault snapshot {Path(vaults_file).name}'}, population
+    if population_store is not None:
+        # Same population as iteration 0 of a scenario batch with this seed
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        print(f"Root seed: {seed}")
+        population_key = get_population_key(params)
+        seed_sequence = get_seed_sequence(seed, population_key, 0)
+        population = population_store.get_or_generate(
+            population_store.make_key(population_key, seed_sequence),
+            {**SIMULATION_PARAMS, **params}, seed_sequence)
+        print(f"Vault population memory-mapped from {population_store.store_dir}")
+        return params, population
+    return params, None
+
+
+def run_single_simulation(profiler=None, profile_exports=(), liquidation_order=None,
+                          population_store=None, seed=None, vaults_file=None):
     """Run a single simulation with default parameters"""
     print("Starting single simulation...")
-    sim = Simulation()
-    sim.run_simulation(silent=False)
+    params = {'liquidation_order': liquidation_order} if liquidation_order else {}
+    params, population = load_population(params, population_store, seed, vaults_file)
+    sim = Simulation(params, population=population, profiler=profiler)
+    with sim.profiler.timer('run_simulation'), sim.profiler.profile_calls():
+        sim.run_simulation(silent=False)
     print("\nSimulation Complete!")
 
+    if profiler is not None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        write_profile(profiler, f'results/simulation_{timestamp}', profile_exports)
+
 
-def run_scenarios():
+def run_scenarios(workers=1, seed=None, cache=None, results_format='csv',
+                  share_populations=True, profiler=None, profile_exports=(),
+                  memory_budget=None, liquidation_order=None, population_store=None,
+                  scenario_filters=None):
     """Run multiple scenarios based on configuration"""
     print("Starting scenario simulations...")
 
-    # Generate all scenario combinations
-    scenarios = generate_scenario_params(SIMULATION_PARAMS)
+    # Generate the scenario combinations that pass the filters
+    base_params = {**SIMULATION_PARAMS, 'liquidation_order': liquidation_order} \
+        if liquidation_order else SIMULATION_PARAMS
+    scenarios = dict(iter_scenario_params(base_params, scenario_filters))
+    if not scenarios:
+        print("No scenarios match the filters")
+        return
 
     # Print scenario overview
     print("Running the following scenarios:")
@@ -37,20 +97,43 @@ def run_scenarios():
 
     # Run all scenarios
     results_df, distributions_df, results_path = run_batch_simulations(
-        scenarios, iterations_per_scenario=1)
+        scenarios, iterations_per_scenario=1, workers=workers, seed=seed, cache=cache,
+        results_format=results_format, share_populations=share_populations,
+        profiler=profiler, memory_budget=memory_budget, population_store=population_store)
 
     print("\nScenario simulations complete!")
     print(f"Total scenarios run: {len(scenarios)}")
-    print(f"Total rows of data: {len(results_df)}")
+    print(f"Results written to: {results_path}")
+
+    if profiler is not None:
+        # Written next to the results, e.g. simulation_results_[timestamp].profile.json
+        write_profile(profiler, Path(results_path).with_suffix(''), profile_exports)
 
 
-def analyze_results(results_file=None, distributions_file=None):
+def solve(parameter, outcome, low=None, high=None, tolerance=None, threshold=DEFAULT_THRESHOLD,
+          price_drop_duration=None, liquidation_order=None, population_store=None,
+          seed=None, vaults_file=None, output_path=None):
+    """Find the critical value of a parameter on one vault population"""
+    params = {}
+    if price_drop_duration is not None:
+        params['price_drop_duration'] = price_drop_duration
+    if liquidation_order:
+        params['liquidation_order'] = liquidation_order
+    params, population = load_population(params, population_store, seed, vaults_file)
+    run_solver(parameter, outcome, params, population, output_path, low=low, high=high,
+               tolerance=tolerance, threshold=threshold,
+               seed=SOLVER_SEED if seed is None else seed)
+
+
+def analyze_results(results_file=None, distributions_file=None, scenario_filters=None):
     """Analyze simulation results and generate reports"""
     results_dir = Path('results')
 
     # If no results file specified, find the most recent one
+    # (CSV files or Parquet result directories)
     if results_file is None:
-        results_files = list(results_dir.glob('simulation_results_*.csv'))
+        results_files = [path for path in results_dir.glob('simulation_results_*')
+                         if path.suffix == '.csv' or path.is_dir()]
         if not results_files:
             print("No results files found!")
             return
@@ -59,7 +142,8 @@ def analyze_results(results_file=None, distributions_file=None):
         results_file = Path(results_file)
 
     # If no distributions file specified, try to find the matching one
-    if distributions_file is None:
+    # (Parquet result directories hold their own distributions)
+    if distributions_file is None and not results_file.is_dir():
         # Extract timestamp from results filename
         timestamp_match = re.search(r'(\d{8}_\d{6})', results_file.name)
         if timestamp_match:
@@ -92,7 +176,7 @@ def analyze_results(results_file=None, distributions_file=None):
                     f"Using most recent distributions file: {distributions_file}")
             else:
                 print("No health distributions file found. Will use synthetic data.")
-    else:
+    elif distributions_file is not None:
         distributions_file = Path(distributions_file)
 
     print(f"Analyzing results from: {results_file}")
@@ -100,7 +184,12 @@ def analyze_results(results_file=None, distributions_file=None):
         print(f"Using health factor distributions from: {distributions_file}")
 
     # Generate report
-    report = ReportGenerator(results_file, distributions_file)
+    scenario_filter = (lambda name: scenario_matches(name, scenario_filters)) \
+        if scenario_filters else None
+    report = ReportGenerator(results_file, distributions_file, scenario_filter)
+    if not report.scenarios:
+        print("No scenarios in the results match the filters")
+        return
     report.generate_full_report()
 
 
@@ -112,17 +201,19 @@ def main():
 
     parser.add_argument(
         'command',
-        choices=['simulate', 'scenarios', 'analyze'],
+        choices=['simulate', 'scenarios', 'analyze', 'bench', 'solve'],
         help='''Command to execute:
 simulate  - Run a single simulation with default parameters
 scenarios - Run multiple scenario simulations
-analyze   - Analyze results and generate reports'''
+analyze   - Analyze results and generate reports
+bench     - Run the benchmark suite and compare it with a baseline
+solve     - Find the critical value of a parameter, e.g. the largest survivable price drop'''
     )
 
     parser.add_argument(
         '--results-file',
         type=str,
-        help='Specific results file to analyze (for analyze command)'
+        help='Specific results file or Parquet results directory to analyze (for analyze command)'
     )
 
     parser.add_argument(
@@ -131,14 +222,251 @@ analyze   - Analyze results and generate reports'''
         help='Specific health factor distributions file to use (for analyze command)'
     )
 
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of worker processes, 0 for one per CPU core (for scenarios command)'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='Root random seed; runs with the same seed give identical results (for scenarios and solve commands, and simulate with --population-store)'
+    )
+
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Reuse cached results of unchanged scenarios, requires --seed (for scenarios command)'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default='results/cache',
+        help='Directory of the result cache (for scenarios command)'
+    )
+
+    parser.add_argument(
+        '--cache-max-size',
+        type=float,
+        help='Maximum result cache size in MB, least recently used results are evicted first'
+    )
+
+    parser.add_argument(
+        '--cache-max-entries',
+        type=int,
+        help='Maximum number of cached simulations, least recently used are evicted first'
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=['csv', 'parquet'],
+        default='csv',
+        help='Results format: a single CSV file, or a Parquet directory partitioned by scenario (for scenarios command)'
+    )
+
+    parser.add_argument(
+        '--no-shared-populations',
+        action='store_true',
+        help='Draw a separate vault population for every price scenario instead of sharing one per risk and scale setup (for scenarios command)'
+    )
+
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Record wall time per phase and sub-step and the engine counters, written next to the results (for simulate and scenarios commands)'
+    )
+
+    parser.add_argument(
+        '--profile-export',
+        nargs='+',
+        choices=PROFILE_EXPORTS,
+        default=[],
+        help='Also export the profile as cProfile data (.prof) or collapsed stacks for flame graphs (with --profile)'
+    )
+
+    parser.add_argument(
+        '--liquidation-order',
+        choices=LIQUIDATION_ORDERS,
+        help='Order in which queued vaults are liquidated, fifo by default (for simulate, scenarios and solve commands)'
+    )
+
+    parser.add_argument(
+        '--memory-budget',
+        type=float,
+        help='Memory in MB the batch may use across all processes: fewer workers and smaller result chunks are used to fit it (for scenarios command)'
+    )
+
+    parser.add_argument(
+        '--filter',
+        nargs='+',
+        default=[],
+        metavar='EXPRESSION',
+        help='''Only run or analyze matching scenarios (for scenarios and analyze commands), e.g.
+--filter risk=high_risk scale=*_scale price=*_7_days
+Each expression is price=, risk= or scale= followed by a wildcard pattern,
+or a pattern for the whole scenario name. Commas separate alternatives.'''
+    )
+
+    parser.add_argument(
+        '--vaults-file',
+        type=str,
+        help='CSV or Parquet snapshot of real vaults with collateral and debt columns, simulated instead of a sampled population (for simulate and solve commands)'
+    )
+
+    parser.add_argument(
+        '--population-store',
+        action='store_true',
+        help='Write vault populations to disk once and memory-map them read only, reused by later runs with the same --seed (for simulate, scenarios and solve commands)'
+    )
+
+    parser.add_argument(
+        '--population-dir',
+        type=str,
+        default='results/populations',
+        help='Directory of the population store (with --population-store)'
+    )
+
+    parser.add_argument(
+        '--parameter',
+        choices=list(SOLVER_PARAMETERS),
+        default='end_price',
+        help='Parameter to solve for, raising it must make the protocol safer (for solve command)'
+    )
+
+    parser.add_argument(
+        '--outcome',
+        choices=list(SOLVER_OUTCOMES),
+        default='reserve_fund_depleted',
+        help='''Outcome every run must meet (for solve command):
+''' + '\n'.join(f'{name} - {condition}' for name, condition in SOLVER_OUTCOMES.items())
+    )
+
+    parser.add_argument(
+        '--low',
+        type=float,
+        help='Lower end of the searched range, defaults depend on the parameter (for solve command)'
+    )
+
+    parser.add_argument(
+        '--high',
+        type=float,
+        help='Upper end of the searched range, defaults depend on the parameter (for solve command)'
+    )
+
+    parser.add_argument(
+        '--solve-tolerance',
+        type=float,
+        help='Width of the range at which the search stops, defaults depend on the parameter (for solve command)'
+    )
+
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='Minimum final protocol health factor, for the protocol_health_factor outcome (for solve command)'
+    )
+
+    parser.add_argument(
+        '--price-drop-duration',
+        type=float,
+        help='Hours over which the price falls to end_price, 24 by default (for solve command)'
+    )
+
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=list(DEFAULT_SIZES),
+        help='Vault counts to run every benchmark at (for bench command)'
+    )
+
+    parser.add_argument(
+        '--benchmarks',
+        nargs='+',
+        choices=list(BENCHMARKS),
+        help='Benchmarks to run, all by default (for bench command)'
+    )
+
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=5,
+        help='Timed runs of each benchmark, the fastest is compared with the baseline (for bench command)'
+    )
+
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='JSON file for the benchmark or solver results, timestamped in results/benchmarks/ or results/solver/ by default (for bench and solve commands)'
+    )
+
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=DEFAULT_BASELINE,
+        help='Baseline benchmark results to compare with (for bench command)'
+    )
+
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Store the benchmark results as the new baseline (for bench command)'
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='Relative slowdown or memory growth over the baseline reported as a regression (for bench command)'
+    )
+
     args = parser.parse_args()
+    try:
+        scenario_filters = parse_scenario_filters(args.filter)
+    except ValueError as error:
+        parser.error(str(error))
+
+    profiler = Profiler(cprofile='cprofile' in args.profile_export) \
+        if args.profile else None
+
+    population_store = PopulationStore(args.population_dir) \
+        if args.population_store else None
 
     if args.command == 'simulate':
-        run_single_simulation()
+        run_single_simulation(profiler, args.profile_export, args.liquidation_order,
+                              population_store, args.seed, args.vaults_file)
     elif args.command == 'scenarios':
-        run_scenarios()
+        cache = None
+        if args.cache:
+            if args.seed is None:
+                print("Result cache requires --seed, running without cache")
+            else:
+                max_bytes = int(args.cache_max_size * 1024 * 1024) \
+                    if args.cache_max_size is not None else None
+                cache = ResultCache(args.cache_dir, max_bytes=max_bytes,
+                                    max_entries=args.cache_max_entries)
+        memory_budget = int(args.memory_budget * 1024 * 1024) \
+            if args.memory_budget is not None else None
+        run_scenarios(args.workers, args.seed, cache, args.format,
+                      not args.no_shared_populations, profiler, args.profile_export,
+                      memory_budget, args.liquidation_order, population_store,
+                      scenario_filters)
     elif args.command == 'analyze':
-        analyze_results(args.results_file, args.distributions_file)
+        analyze_results(args.results_file, args.distributions_file, scenario_filters)
+    elif args.command == 'solve':
+        solve(args.parameter, args.outcome, args.low, args.high, args.solve_tolerance,
+              args.threshold, args.price_drop_duration, args.liquidation_order,
+              population_store, args.seed, args.vaults_file, args.output)
+    elif args.command == 'bench':
+        _, comparison = run_benchmarks(
+            args.sizes, args.benchmarks, args.repeats, args.output, args.baseline,
+            args.save_baseline, args.tolerance)
+        # A failing exit status lets scheduled runs flag regressions
+        if comparison and any(entry['regression'] for entry in comparison):
+            raise SystemExit(1)
 
 
 if __name__ == "__main__":
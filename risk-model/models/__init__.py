@@ -1,4 +1,11 @@
 from .vault import Vault
+from .vault_book import VaultBook, VaultView
+from .vault_queue import VaultQueue, PriorityVaultQueue, LIQUIDATION_ORDERS
+from .price_index import ThresholdPriceIndex
+from .metrics import MetricsAccumulator
 from .engine import Engine
+from .multi_path_engine import MultiPathEngine
 
-__all__ = ['Vault', 'Engine']
+__all__ = ['Vault', 'VaultBook', 'VaultView', 'VaultQueue', 'PriorityVaultQueue',
+           'LIQUIDATION_ORDERS', 'ThresholdPriceIndex', 'MetricsAccumulator', 'Engine',
+           'MultiPathEngine']
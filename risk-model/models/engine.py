@@ -1,23 +1,63 @@
-from collections import deque
+from types import MappingProxyType
 import numpy as np
 from .vault import Vault
+from .vault_book import VaultBook
+from .vault_queue import VaultQueue, PriorityVaultQueue, liquidation_priorities
+from .metrics import MetricsAccumulator
 from config.params import SIMULATION_PARAMS
 from utils import HEALTH_FACTOR_THRESHOLDS
+from profiler import NULL_PROFILER
+
+# Queue state codes stored in Engine.vault_state. Vaults popped from a queue
+# without being liquidated (their health factor recovered) go back to
+# VAULT_ACTIVE and are queued again once they are below the threshold.
+VAULT_ACTIVE = 0
+VAULT_QUEUED = 1
+VAULT_IN_RECOVERY = 2
+VAULT_LIQUIDATED = 3
 
 
 class Engine:
-    def __init__(self, params=None):
-        """Initialize the engine with optional scenario parameters"""
+    def __init__(self, params=None, rng=None, population=None, profiler=None):
+        """
+        Initialize the engine with optional scenario parameters
+
+        Args:
+            params (dict): Override parameters for this scenario
+            rng (np.random.Generator): Random generator used to create vaults,
+                defaults to the global NumPy random state
+            population (VaultBook, optional): Pre-generated vault population.
+                create_vaults then works on a copy-on-write clone of it instead
+                of sampling new vaults.
+            profiler (Profiler, optional): Collects counters of the queue
+                operations and health factor evaluations
+        """
         self.params = SIMULATION_PARAMS.copy()
         if params:
             self.params.update(params)
+        # Read-only parameters shared by the Vault objects of this engine
+        self.vault_params = MappingProxyType(self.params)
+        self.rng = rng
+        self.population = population
+        self.profiler = profiler or NULL_PROFILER
 
-        self.vaults = []
+        self.vaults = VaultBook([], [], [])
         self.current_price = self.params['start_price']
-        self.liquidation_queue = deque()
-        self.recovery_queue = deque()
+        self.liquidation_queue = VaultQueue()
+        self.recovery_queue = VaultQueue()
         self.max_liquidations_per_step = self.params['txs_per_block']
 
+        # Price indexes and queue state of each vault - built in create_vaults
+        self.liquidation_index = None
+        self.insolvency_index = None
+        self.vault_state = np.zeros(0, dtype=np.int8)
+        # Vaults released from a queue while the liquidation index still
+        # counts them as below the threshold, see release_vaults
+        self.requeue_candidates = np.empty(0, dtype=np.intp)
+
+        # Incrementally maintained protocol metrics - built in create_vaults
+        self.metrics = None
+
         # Initialize reserve fund to zero - will be set after vaults are created
         self.reserve_fund = 0
         self.initial_reserve_fund = 0
@@ -27,11 +67,15 @@ class Engine:
 
     def create_vaults(self):
         """Create vaults and initialize the reserve fund"""
-        self.vaults = [Vault(self.params)
-                       for _ in range(self.params['num_vaults'])]
+        if self.population is not None:
+            self.vaults = self.population.clone()
+        else:
+            self.vaults = VaultBook.generate(self.params, self.rng)
+        self.build_price_indexes()
+        self.metrics = MetricsAccumulator(self.vaults, self.current_price)
 
         # Calculate total debt in the system
-        total_debt = sum(vault.get_debt_amount() for vault in self.vaults)
+        total_debt = float(self.vaults.debt.sum())
 
         print(f"Total debt: {total_debt}")
 
@@ -42,9 +86,42 @@ class Engine:
         self.reserve_fund_used = 0
         self.reserve_fund_depleted = False
 
+    def build_price_indexes(self):
+        """Index vaults by their liquidation and insolvency prices"""
+        self.liquidation_index = self.vaults.price_index(
+            self.params['health_factor_liquidation_threshold'])
+        self.insolvency_index = self.vaults.price_index(HEALTH_FACTOR_THRESHOLDS['INSOLVENCY'])
+
+        # Vaults without collateral count as liquidated, as in the metrics
+        self.vault_state = np.where(
+            self.vaults.collateral > 0, VAULT_ACTIVE, VAULT_LIQUIDATED).astype(np.int8)
+        self.requeue_candidates = np.empty(0, dtype=np.intp)
+        # Queued vaults are liquidated in the configured order, while the
+        # recovery queue is always first come first served. FIFO queues grow
+        # with the vaults queued at once instead of holding the population.
+        priorities = liquidation_priorities(
+            self.params.get('liquidation_order', 'fifo'), self.vaults.collateral,
+            self.vaults.debt)
+        self.liquidation_queue = VaultQueue() if priorities is None \
+            else PriorityVaultQueue(priorities)
+        self.recovery_queue = VaultQueue()
+
     def get_vaults(self):
         return self.vaults
 
+    def get_vault_objects(self):
+        """
+        Vault objects with the current state of all vaults
+
+        The vaults are copies sharing the engine's read-only parameters;
+        changing them does not change the engine's vaults.
+        """
+        vaults = self.vaults
+        return [Vault.from_state(collateral, debt, health_factor, self.vault_params)
+                for collateral, debt, health_factor in zip(
+                    vaults.collateral.tolist(), vaults.debt.tolist(),
+                    vaults.initial_health_factor.tolist())]
+
     def set_price(self, price):
         self.current_price = price
 
@@ -60,95 +137,178 @@ class Engine:
     def get_reserve_fund_used(self):
         return self.reserve_fund_used
 
+    def liquidate_vaults(self, indices):
+        """Liquidate vaults at the current price and update the metrics"""
+        collateral_amounts = self.vaults.collateral_of(indices)
+        debt_amounts = self.vaults.debt_of(indices)
+        liquidated = self.vaults.liquidate(
+            indices, self.current_price, self.params['health_factor_liquidation_threshold'])
+        self.vault_state[indices[liquidated]] = VAULT_LIQUIDATED
+        self.release_vaults(indices[~liquidated])
+        self.profiler.count('health_factor_evaluations', len(indices))
+        self.metrics.record_liquidations(
+            indices[liquidated], collateral_amounts[liquidated], debt_amounts[liquidated])
+        return liquidated
+
+    def release_vaults(self, vaults):
+        """
+        Return vaults popped without being liquidated to VAULT_ACTIVE
+
+        The liquidation index queues them again when the price next falls
+        below their liquidation price. Those it already counts as below the
+        threshold are rechecked by check_and_queue_liquidations instead.
+        """
+        if len(vaults) == 0:
+            return
+        self.vault_state[vaults] = VAULT_ACTIVE
+        below = vaults[self.liquidation_index.is_below(vaults)]
+        if len(below):
+            self.requeue_candidates = np.union1d(self.requeue_candidates, below)
+
     def process_liquidations(self, liquidations_to_process):
         """Process liquidations from the queue up to the specified limit"""
-        liquidations_this_step = 0
         liquidated_vaults = []
+        liquidations_this_step = 0
 
         while self.liquidation_queue and liquidations_this_step < liquidations_to_process:
-            vault = self.liquidation_queue.popleft()
-
-            # Check if vault is insolvent before liquidating
-            health_factor = vault.calculate_health_factor(self.current_price)
-            if health_factor < HEALTH_FACTOR_THRESHOLDS['INSOLVENCY']:
-                # Move to recovery queue if insolvent
-                self.recovery_queue.append(vault)
-                continue
-
-            # Liquidate the vault
-            vault.liquidate_vault(self.current_price)
-            liquidations_this_step += 1
-            liquidated_vaults.append(vault)
-
-        return liquidated_vaults
+            # Every popped vault either moves to the recovery queue or counts
+            # against the allowance, liquidated or not, so popping the
+            # remaining allowance never overshoots
+            batch = self.liquidation_queue.pop(liquidations_to_process - liquidations_this_step)
+            batch_size = len(batch)
+            self.profiler.count('liquidation_queue_pops', batch_size)
+
+            # Move insolvent vaults to the recovery queue instead of liquidating
+            health_factors = self.vaults.calculate_health_factors(
+                self.current_price, batch)
+            insolvent = health_factors < HEALTH_FACTOR_THRESHOLDS['INSOLVENCY']
+            self.recovery_queue.push(batch[insolvent])
+            self.vault_state[batch[insolvent]] = VAULT_IN_RECOVERY
+            self.profiler.count('health_factor_evaluations', batch_size)
+            self.profiler.count('recovery_queue_pushes', int(np.count_nonzero(insolvent)))
+
+            # Liquidate the rest of the batch
+            to_liquidate = batch[~insolvent]
+            self.liquidate_vaults(to_liquidate)
+            liquidations_this_step += len(to_liquidate)
+            liquidated_vaults.append(to_liquidate)
+
+        if not liquidated_vaults:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(liquidated_vaults)
 
     def check_and_queue_liquidations(self):
-        """Check all vaults and queue those that need liquidation"""
-        newly_queued = 0
-        already_queued = set(self.liquidation_queue)
-        already_in_recovery = set(self.recovery_queue)
-
-        for vault in self.vaults:
-            # Skip if vault is already in a queue or has no collateral
-            if (vault in already_queued or
-                vault in already_in_recovery or
-                    vault.get_collateral_amount() <= 0):
-                continue
-
-            health_factor = vault.calculate_health_factor(self.current_price)
-
-            # Check if vault needs liquidation
-            if health_factor < self.params['health_factor_liquidation_threshold']:
-                # Check if vault is insolvent and should go to recovery queue
-                if health_factor < HEALTH_FACTOR_THRESHOLDS['INSOLVENCY']:
-                    self.recovery_queue.append(vault)
-                else:
-                    self.liquidation_queue.append(vault)
-                newly_queued += 1
-
-        return newly_queued
+        """Queue the vaults whose liquidation price was crossed since the last check"""
+        crossed, _ = self.liquidation_index.advance(self.current_price)
+        self.profiler.count('vaults_scanned', len(crossed))
+
+        # Skip vaults that were already queued or have no collateral
+        newly_queued = crossed[self.vault_state[crossed] == VAULT_ACTIVE]
+        if len(self.requeue_candidates):
+            newly_queued = np.concatenate((newly_queued, self._requeued_vaults()))
+        newly_queued = np.unique(newly_queued)
+
+        # Insolvent vaults go straight to the recovery queue
+        insolvent = self.insolvency_index.threshold_prices[newly_queued] > self.current_price
+        self.recovery_queue.push(newly_queued[insolvent])
+        self.liquidation_queue.push(newly_queued[~insolvent])
+        self.vault_state[newly_queued] = np.where(insolvent, VAULT_IN_RECOVERY, VAULT_QUEUED)
+        self.profiler.count('recovery_queue_pushes', int(np.count_nonzero(insolvent)))
+        self.profiler.count('liquidation_queue_pushes', int(np.count_nonzero(~insolvent)))
+
+        return len(newly_queued)
+
+    def _requeued_vaults(self):
+        """Released vaults below the liquidation threshold at the current price"""
+        # Vaults the index no longer counts as below the threshold are queued
+        # when it next reports them crossed
+        candidates = self.requeue_candidates
+        candidates = candidates[(self.vault_state[candidates] == VAULT_ACTIVE) &
+                                self.liquidation_index.is_below(candidates)]
+        below = self.vaults.calculate_health_factors(self.current_price, candidates) < \
+            self.params['health_factor_liquidation_threshold']
+        self.profiler.count('health_factor_evaluations', len(candidates))
+        self.requeue_candidates = candidates[~below]
+        return candidates[below]
 
     def process_insolvent_vaults_with_reserve_fund(self, recoveries_to_process):
         """Process insolvent vaults using the reserve fund"""
-        recoveries_this_step = 0
         vaults_recovered = []
+        recoveries_this_step = 0
 
         while self.recovery_queue and recoveries_this_step < recoveries_to_process:
-            vault = self.recovery_queue.popleft()
-            debt_amount = vault.get_debt_amount()
-
-            # Skip if vault has no debt
-            if debt_amount <= 0:
-                continue
-
-            # Check if reserve fund has enough to cover the debt
-            if self.reserve_fund >= debt_amount:
-                # Calculate collateral value before liquidation
-                collateral_amount = vault.get_collateral_amount()
-                collateral_value = collateral_amount * self.current_price
-
-                # Use reserve fund to cover debt
-                self.reserve_fund -= debt_amount
-                self.reserve_fund_used += debt_amount
-
-                # Liquidate the vault
-                vault.liquidate_vault(self.current_price)
-
-                # Add collateral value back to reserve fund
-                self.reserve_fund += collateral_value
-
-                recoveries_this_step += 1
-                vaults_recovered.append(vault)
-            else:
-                # Put vault back in queue and mark reserve fund as depleted
-                self.recovery_queue.appendleft(vault)
+            batch = self.recovery_queue.pop(recoveries_to_process - recoveries_this_step)
+            batch_size = len(batch)
+            self.profiler.count('recovery_queue_pops', batch_size)
+            debt_amounts = self.vaults.debt_of(batch)
+
+            # Vaults without debt are dropped from the queue
+            positions = np.flatnonzero(debt_amounts > 0)
+            candidates = batch[positions]
+            debt_amounts = debt_amounts[positions]
+            collateral_values = self.vaults.collateral_values(
+                self.current_price, candidates)
+
+            # Replay the reserve fund sequentially: pay each debt, then add the
+            # collateral value back. cumsum accumulates left to right, so the
+            # running balances match the one-vault-at-a-time arithmetic.
+            flows = np.empty(2 * len(candidates))
+            flows[0::2] = -debt_amounts
+            flows[1::2] = collateral_values
+            balances = np.cumsum(np.concatenate(([self.reserve_fund], flows)))
+            affordable = balances[0:-1:2] >= debt_amounts
+            num_recovered = len(candidates) if affordable.all() \
+                else int(np.argmin(affordable))
+
+            recovered = candidates[:num_recovered]
+            self.reserve_fund = float(balances[2 * num_recovered])
+            self.reserve_fund_used = float(np.cumsum(
+                np.concatenate(([self.reserve_fund_used], debt_amounts[:num_recovered])))[-1])
+            self.liquidate_vaults(recovered)
+            recoveries_this_step += num_recovered
+            vaults_recovered.append(recovered)
+            self.profiler.count('reserve_fund_recoveries', num_recovered)
+
+            if num_recovered < len(candidates):
+                # Put the unaffordable vault (and everything behind it) back in
+                # the queue and mark reserve fund as depleted
+                self.recovery_queue.unpop(batch_size - int(positions[num_recovered]))
+                self.profiler.count('recovery_queue_pushes',
+                                    batch_size - int(positions[num_recovered]))
                 self.reserve_fund_depleted = True
                 break
 
-        return vaults_recovered
+        if not vaults_recovered:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(vaults_recovered)
 
     def get_liquidation_queue_size(self):
         return len(self.liquidation_queue)
 
     def get_recovery_queue_size(self):
         return len(self.recovery_queue)
+
+    def memory_usage(self):
+        """
+        Bytes held by the engine's data structures
+
+        Returns:
+            dict: vault_storage (the vault arrays, including those still shared
+                with the population), price_indexes (of the engine and the
+                metrics, memory-mapped ones included, counting arrays shared
+                by indexes once) and queues (the liquidation and recovery
+                queues and the vault states)
+        """
+        indexes = [index for index in (self.liquidation_index, self.insolvency_index)
+                   if index is not None]
+        if self.metrics is not None:
+            indexes.extend(self.metrics.price_indexes())
+        arrays = {id(array): array for index in indexes for array in index.arrays()}
+        price_indexes = sum(array.nbytes for array in arrays.values())
+        queues = self.vault_state.nbytes + self.liquidation_queue.nbytes() + \
+            self.recovery_queue.nbytes()
+        return {
+            'vault_storage': self.vaults.nbytes(),
+            'price_indexes': price_indexes,
+            'queues': queues,
+        }
@@ -0,0 +1,152 @@
+from utils import HEALTH_FACTOR_THRESHOLDS
+import numpy as np
+
+
+class MetricsAccumulator:
+    """
+    Incrementally maintained vault metrics for the whole protocol.
+
+    Totals only change when a vault is liquidated, so they are updated from the
+    engine's liquidation events. Category counts only change when the price
+    crosses a vault's threshold price, so they are derived from sorted
+    threshold-price indexes as the price moves instead of rescanning every vault.
+    """
+
+    def __init__(self, vaults, price):
+        """
+        Initialize the accumulator from a freshly created vault population
+
+        Args:
+            vaults (VaultBook): The vault population
+            price (float): The current price
+        """
+        self.vaults = vaults
+        collateral = vaults.collateral
+        debt = vaults.debt
+        active = collateral > 0
+
+        self.total_collateral = float(collateral.sum())
+        self.total_debt = float(debt.sum())
+        self.num_active = int(np.count_nonzero(active))
+        self.num_liquidated = len(vaults) - self.num_active
+        # Active vaults without debt have an infinite health factor and
+        # belong to no category
+        self.num_without_debt = int(np.count_nonzero(active & (debt == 0)))
+
+        self.insolvency_index = vaults.price_index(HEALTH_FACTOR_THRESHOLDS['INSOLVENCY'])
+        self.liquidation_index = vaults.price_index(HEALTH_FACTOR_THRESHOLDS['LIQUIDATION'])
+        self.safe_index = vaults.price_index(HEALTH_FACTOR_THRESHOLDS['SAFE'])
+
+        # Number of active vaults below each threshold, plus insolvent totals
+        self.num_below = {
+            'INSOLVENCY': 0,
+            'LIQUIDATION': 0,
+            'SAFE': 0,
+        }
+        self.total_insolvent_collateral = 0.0
+        self.total_debt_in_insolvent_vaults = 0.0
+
+        self.price = None
+        self.set_price(price)
+
+    def _indexes(self):
+        return (('INSOLVENCY', self.insolvency_index),
+                ('LIQUIDATION', self.liquidation_index),
+                ('SAFE', self.safe_index))
+
+    def price_indexes(self):
+        """The category price indexes"""
+        return [index for _, index in self._indexes()]
+
+    def nbytes(self):
+        """Bytes held by the category price indexes"""
+        return sum(index.nbytes() for _, index in self._indexes())
+
+    def set_price(self, price):
+        """Move the category counts to a new price"""
+        if price == self.price:
+            return
+        self.price = price
+
+        vaults = self.vaults
+        for name, index in self._indexes():
+            crossed, uncrossed = index.advance(price)
+            crossed_collateral = vaults.collateral_of(crossed)
+            uncrossed_collateral = vaults.collateral_of(uncrossed)
+            crossed = crossed[crossed_collateral > 0]
+            uncrossed = uncrossed[uncrossed_collateral > 0]
+            self.num_below[name] += len(crossed) - len(uncrossed)
+
+            if name == 'INSOLVENCY':
+                self.total_insolvent_collateral += float(
+                    crossed_collateral[crossed_collateral > 0].sum() -
+                    uncrossed_collateral[uncrossed_collateral > 0].sum())
+                self.total_debt_in_insolvent_vaults += float(
+                    vaults.debt_of(crossed).sum() - vaults.debt_of(uncrossed).sum())
+                self._clear_empty_insolvent_totals()
+
+    def record_liquidations(self, indices, collateral, debt):
+        """
+        Remove liquidated vaults from the totals
+
+        Args:
+            indices (np.ndarray): Indices of the liquidated vaults
+            collateral (np.ndarray): Their collateral amounts before liquidation
+            debt (np.ndarray): Their debt amounts before liquidation
+        """
+        if len(indices) == 0:
+            return
+
+        self.total_collateral -= float(collateral.sum())
+        self.total_debt -= float(debt.sum())
+        self.num_active -= len(indices)
+        self.num_liquidated += len(indices)
+        self.num_without_debt -= int(np.count_nonzero(debt == 0))
+
+        for name, index in self._indexes():
+            below = index.threshold_prices[indices] > self.price
+            self.num_below[name] -= int(np.count_nonzero(below))
+
+            if name == 'INSOLVENCY':
+                self.total_insolvent_collateral -= float(collateral[below].sum())
+                self.total_debt_in_insolvent_vaults -= float(debt[below].sum())
+                self._clear_empty_insolvent_totals()
+
+        # Avoid leaving rounding residue once every vault is gone
+        if self.num_active == 0:
+            self.total_collateral = 0.0
+            self.total_debt = 0.0
+
+    def _clear_empty_insolvent_totals(self):
+        if self.num_below['INSOLVENCY'] == 0:
+            self.total_insolvent_collateral = 0.0
+            self.total_debt_in_insolvent_vaults = 0.0
+
+    def snapshot(self, price):
+        """
+        Get the vault metrics at a price
+
+        Returns:
+            dict: Totals and category counts in the format of
+                Simulation.calculate_protocol_metrics
+        """
+        self.set_price(price)
+        num_insolvent = self.num_below['INSOLVENCY']
+        num_liquidatable = self.num_below['LIQUIDATION'] - num_insolvent
+        num_at_risk = self.num_below['SAFE'] - self.num_below['LIQUIDATION']
+        num_healthy = self.num_active - \
+            self.num_below['SAFE'] - self.num_without_debt
+
+        return {
+            'total_collateral': self.total_collateral,
+            'total_collateral_value': self.total_collateral * price,
+            'total_debt': self.total_debt,
+            'num_healthy_vaults': num_healthy,
+            'num_at_risk_vaults': num_at_risk,
+            'num_liquidatable_vaults': num_liquidatable,
+            'num_liquidated_vaults': self.num_liquidated,
+            'num_insolvent_vaults': num_insolvent,
+            'total_insolvent_collateral': self.total_insolvent_collateral,
+            'total_insolvent_collateral_value': self.total_insolvent_collateral * price,
+            'total_debt_in_insolvent_vaults': self.total_debt_in_insolvent_vaults,
+        }
@@ -0,0 +1,435 @@
+import numpy as np
+from config.params import SIMULATION_PARAMS
+from utils import HEALTH_FACTOR_THRESHOLDS, calculate_health_factors
+
+
+class MultiPathEngine:
+    """
+    Engine state for many price paths sharing one vault population.
+
+    Each path behaves like its own Engine: it has its own price, liquidation
+    and recovery queues, reserve fund and set of liquidated vaults. The state
+    is held in (paths x vaults) arrays so every engine operation advances all
+    paths at once. The vault population itself is never modified, which is
+    what lets the paths share it.
+
+    Queues are arrays with a head and a tail per path. A vault is in at most
+    one queue of a path at a time, so a row of num_vaults entries holds every
+    queued vault: a row whose tail reaches the end moves its queued entries
+    to the front. Vaults popped without being liquidated leave the queues and
+    are queued again once they are below the liquidation threshold, as in
+    Engine.
+    """
+
+    # Per-path state for each vault: active and queued flags plus both queues
+    STATE_BYTES_PER_VAULT = 2 * np.dtype(bool).itemsize + \
+        2 * np.dtype(np.int32).itemsize
+    # Scratch space of a gather spanning the whole population (indices,
+    # values and masks)
+    SCRATCH_BYTES_PER_VAULT = 3 * np.dtype(np.float64).itemsize
+
+    def __init__(self, vaults, num_paths, params=None):
+        """
+        Initialize every path at the start price with untouched vaults
+
+        Args:
+            vaults (VaultBook): The shared vault population, read only
+            num_paths (int): Number of price paths simulated together
+            params (dict): Override parameters for this scenario
+        """
+        self.params = SIMULATION_PARAMS.copy()
+        if params:
+            self.params.update(params)
+
+        self.vaults = vaults
+        self.num_paths = num_paths
+        self.max_liquidations_per_step = self.params['txs_per_block']
+        num_vaults = len(vaults)
+        collateral = vaults.collateral
+        debt = vaults.debt
+
+        self.prices = np.full(num_paths, float(self.params['start_price']))
+        self._rows = np.arange(num_paths)[:, None]
+
+        # Vault indexes by threshold price, shared by all paths
+        self.liquidation_index = vaults.price_index(
+            self.params['health_factor_liquidation_threshold'])
+        self.metric_indexes = {
+            name: vaults.price_index(HEALTH_FACTOR_THRESHOLDS[name])
+            for name in ('INSOLVENCY', 'LIQUIDATION', 'SAFE')
+        }
+        self.insolvency_prices = self.metric_indexes['INSOLVENCY'].threshold_prices
+
+        # Per-path vault state
+        self.active = np.repeat((collateral > 0)[None, :], num_paths, axis=0)
+        self.queued = np.zeros((num_paths, num_vaults), dtype=bool)
+        self.liquidation_position = np.zeros(num_paths, dtype=np.intp)
+        # Price of each path's last check: the liquidation index counts the
+        # vaults above it as below the threshold
+        self.liquidation_prices = np.full(num_paths, np.inf)
+        # (path, vault) pairs released from a queue while the index still
+        # counts them as below the threshold, see _release
+        self.requeue_rows = np.empty(0, dtype=np.intp)
+        self.requeue_vaults = np.empty(0, dtype=np.intp)
+
+        # Zero-filled so padded reads past a queue's tail stay valid indices
+        self.liquidation_queue = np.zeros((num_paths, num_vaults), dtype=np.int32)
+        self.liquidation_head = np.zeros(num_paths, dtype=np.intp)
+        self.liquidation_tail = np.zeros(num_paths, dtype=np.intp)
+        self.recovery_queue = np.zeros((num_paths, num_vaults), dtype=np.int32)
+        self.recovery_head = np.zeros(num_paths, dtype=np.intp)
+        self.recovery_tail = np.zeros(num_paths, dtype=np.intp)
+
+        # Reserve fund of each path, set from the total debt as in Engine
+        total_debt = float(debt.sum())
+        self.initial_reserve_fund = total_debt * \
+            self.params['reserve_fund_percentage_of_debt']
+        self.reserve_fund = np.full(num_paths, self.initial_reserve_fund)
+        self.reserve_fund_used = np.zeros(num_paths)
+        self.reserve_fund_depleted = np.zeros(num_paths, dtype=bool)
+
+        # Incrementally maintained metrics, as in MetricsAccumulator
+        num_active = int(np.count_nonzero(collateral > 0))
+        self.total_collateral = np.full(num_paths, float(collateral.sum()))
+        self.total_debt = np.full(num_paths, total_debt)
+        self.num_active = np.full(num_paths, num_active)
+        self.num_liquidated = np.full(num_paths, num_vaults - num_active)
+        # Vaults without debt are never liquidatable, so this stays constant
+        self.num_without_debt = int(np.count_nonzero((collateral > 0) & (debt == 0)))
+        self.metric_positions = {name: np.zeros(num_paths, dtype=np.intp)
+                                 for name in self.metric_indexes}
+        self.num_below = {name: np.zeros(num_paths, dtype=np.int64)
+                          for name in self.metric_indexes}
+        self.total_insolvent_collateral = np.zeros(num_paths)
+        self.total_debt_in_insolvent_vaults = np.zeros(num_paths)
+        self.metrics_prices = np.full(num_paths, np.nan)
+        self._set_metrics_prices(self.prices)
+
+    @classmethod
+    def bytes_per_path(cls, num_vaults):
+        """Peak memory one path needs for a population of num_vaults"""
+        return (cls.STATE_BYTES_PER_VAULT + cls.SCRATCH_BYTES_PER_VAULT) * num_vaults
+
+    def set_prices(self, prices):
+        self.prices = np.asarray(prices, dtype=np.float64)
+
+    def get_liquidation_queue_sizes(self):
+        return self.liquidation_tail - self.liquidation_head
+
+    def get_recovery_queue_sizes(self):
+        return self.recovery_tail - self.recovery_head
+
+    def _window(self, values, starts, counts):
+        """
+        Gather counts[p] consecutive entries of each row starting at starts[p]
+
+        Returns:
+            tuple: (entries, valid) padded to the largest count, valid marks the
+                entries that belong to the row's range
+        """
+        width = int(counts.max()) if len(counts) else 0
+        offsets = np.arange(width)
+        valid = offsets < counts[:, None]
+        positions = np.minimum(starts[:, None] + offsets, values.shape[-1] - 1)
+        if values.ndim == 1:
+            return values[positions], valid
+        return values[self._rows, positions], valid
+
+    def _push(self, queue, head, tail, vaults, mask):
+        """Append the masked vaults of each row to the end of its queue, in order"""
+        # Rows that would run past the end first move their entries to the front
+        for row in np.flatnonzero(tail + mask.sum(axis=1) > queue.shape[1]):
+            queued = queue[row, head[row]:tail[row]].copy()
+            queue[row, :len(queued)] = queued
+            head[row], tail[row] = 0, len(queued)
+
+        ranks = np.cumsum(mask, axis=1) - 1
+        rows, columns = np.nonzero(mask)
+        queue[rows, tail[rows] + ranks[rows, columns]] = vaults[rows, columns]
+        tail += mask.sum(axis=1)
+
+    def _masked_sum(self, values, mask):
+        return np.where(mask, values, 0.0).sum(axis=1)
+
+    def _set_metrics_prices(self, prices):
+        """Move the metric category counts of every path to new prices"""
+        if np.array_equal(prices, self.metrics_prices):
+            return
+        self.metrics_prices = prices.copy()
+
+        for name, index in self.metric_indexes.items():
+            new_positions = index.count_below_thresholds(prices)
+            old_positions = self.metric_positions[name]
+            self.metric_positions[name] = new_positions
+
+            # Vaults between the old and new position crossed the threshold
+            # (moving down) or rose back above it (moving up)
+            sign = np.sign(new_positions - old_positions)
+            vaults, valid = self._window(
+                index.order, np.minimum(old_positions, new_positions),
+                np.abs(new_positions - old_positions))
+            if vaults.shape[1] == 0:
+                continue
+            valid &= self.active[self._rows, vaults]
+            self.num_below[name] += sign * valid.sum(axis=1)
+
+            if name == 'INSOLVENCY':
+                self.total_insolvent_collateral += sign * self._masked_sum(
+                    self.vaults.collateral[vaults], valid)
+                self.total_debt_in_insolvent_vaults += sign * self._masked_sum(
+                    self.vaults.debt[vaults], valid)
+                self._clear_empty_insolvent_totals()
+
+    def _clear_empty_insolvent_totals(self):
+        empty = self.num_below['INSOLVENCY'] == 0
+        self.total_insolvent_collateral[empty] = 0.0
+        self.total_debt_in_insolvent_vaults[empty] = 0.0
+
+    def _liquidate(self, vaults, mask, health_factors):
+        """
+        Liquidate the masked vaults of each path at its current price
+
+        Mirrors VaultBook.liquidate: only vaults below the liquidation
+        threshold are liquidated.
+        """
+        liquidated = mask & (health_factors <
+                             self.params['health_factor_liquidation_threshold'])
+        rows, columns = np.nonzero(liquidated)
+        self.active[rows, vaults[rows, columns]] = False
+        self._release(vaults, mask & ~liquidated)
+
+        collateral = self.vaults.collateral[vaults]
+        debt = self.vaults.debt[vaults]
+        num_liquidated = liquidated.sum(axis=1)
+        self.total_collateral -= self._masked_sum(collateral, liquidated)
+        self.total_debt -= self._masked_sum(debt, liquidated)
+        self.num_active -= num_liquidated
+        self.num_liquidated += num_liquidated
+
+        # Category counts are relative to the last metrics price
+        for name, index in self.metric_indexes.items():
+            below = liquidated & (
+                index.threshold_prices[vaults] > self.metrics_prices[:, None])
+            self.num_below[name] -= below.sum(axis=1)
+
+            if name == 'INSOLVENCY':
+                self.total_insolvent_collateral -= self._masked_sum(collateral, below)
+                self.total_debt_in_insolvent_vaults -= self._masked_sum(debt, below)
+                self._clear_empty_insolvent_totals()
+
+        # Avoid leaving rounding residue once every vault is gone
+        empty = self.num_active == 0
+        self.total_collateral[empty] = 0.0
+        self.total_debt[empty] = 0.0
+
+    def _release(self, vaults, mask):
+        """
+        Take the masked vaults of each row, popped without being liquidated,
+        out of the queues
+
+        The liquidation index queues them again when the price of their path
+        next falls below their liquidation price. Those it already counts as
+        below the threshold are rechecked by check_and_queue_liquidations.
+        """
+        rows, columns = np.nonzero(mask)
+        if len(rows) == 0:
+            return
+        released = vaults[rows, columns]
+        self.queued[rows, released] = False
+        below = self.liquidation_index.threshold_prices[released] > \
+            self.liquidation_prices[rows]
+        self.requeue_rows = np.concatenate((self.requeue_rows, rows[below]))
+        self.requeue_vaults = np.concatenate((self.requeue_vaults, released[below]))
+
+    def _requeued_vaults(self):
+        """
+        Released vaults below the liquidation threshold at the current prices
+
+        Returns:
+            np.ndarray: (paths x n) vault indices, padded with len(vaults)
+        """
+        rows, vaults = self.requeue_rows, self.requeue_vaults
+        # Vaults the index no longer counts as below the threshold are queued
+        # when it next reports them crossed
+        keep = self.active[rows, vaults] & ~self.queued[rows, vaults] & (
+            self.liquidation_index.threshold_prices[vaults] > self.prices[rows])
+        rows, vaults = rows[keep], vaults[keep]
+        below = calculate_health_factors(
+            self.vaults.collateral_of(vaults), self.vaults.debt_of(vaults),
+            self.prices[rows]) < self.params['health_factor_liquidation_threshold']
+        self.requeue_rows, self.requeue_vaults = rows[~below], vaults[~below]
+
+        rows, vaults = rows[below], vaults[below]
+        requeued = np.full((self.num_paths, int(np.bincount(
+            rows, minlength=self.num_paths).max(initial=0))), len(self.vaults))
+        # Unique pairs in row order, each at its rank within the row
+        pairs = np.unique(rows * len(self.vaults) + vaults)
+        rows, vaults = np.divmod(pairs, len(self.vaults))
+        ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        requeued[rows, ranks] = vaults
+        return requeued
+
+    def check_and_queue_liquidations(self):
+        """Queue the vaults whose liquidation price was crossed since the last check"""
+        new_positions = self.liquidation_index.count_below_thresholds(self.prices)
+        counts = np.maximum(new_positions - self.liquidation_position, 0)
+        vaults, valid = self._window(
+            self.liquidation_index.order, self.liquidation_position, counts)
+        self.liquidation_position = new_positions
+        self.liquidation_prices = self.prices.copy()
+
+        # Skip vaults that were already queued or liquidated, then order the
+        # rest of each row by vault index
+        valid &= ~self.queued[self._rows, vaults] & self.active[self._rows, vaults]
+        vaults = np.where(valid, vaults, len(self.vaults))
+        if len(self.requeue_rows):
+            vaults = np.concatenate((vaults, self._requeued_vaults()), axis=1)
+        if vaults.shape[1] == 0:
+            return np.zeros(self.num_paths, dtype=np.intp)
+        vaults = np.sort(vaults, axis=1)
+        valid = vaults < len(self.vaults)
+        vaults = np.minimum(vaults, len(self.vaults) - 1)
+        rows, columns = np.nonzero(valid)
+        self.queued[rows, vaults[rows, columns]] = True
+
+        # Insolvent vaults go straight to the recovery queue
+        insolvent = valid & (self.insolvency_prices[vaults] > self.prices[:, None])
+        self._push(self.recovery_queue, self.recovery_head, self.recovery_tail,
+                   vaults, insolvent)
+        self._push(self.liquidation_queue, self.liquidation_head, self.liquidation_tail,
+                   vaults, valid & ~insolvent)
+
+        return valid.sum(axis=1)
+
+    def process_liquidations(self, liquidations_to_process):
+        """
+        Process liquidations from the queue of each path
+
+        Args:
+            liquidations_to_process (np.ndarray): Liquidation limit of each path
+        """
+        liquidations_this_step = np.zeros(self.num_paths, dtype=np.intp)
+
+        while True:
+            remaining = np.maximum(liquidations_to_process - liquidations_this_step, 0)
+            batch_sizes = np.minimum(remaining, self.get_liquidation_queue_sizes())
+            if not batch_sizes.any():
+                break
+            batch, valid = self._window(
+                self.liquidation_queue, self.liquidation_head, batch_sizes)
+            self.liquidation_head += batch_sizes
+
+            # Move insolvent vaults to the recovery queue instead of liquidating
+            health_factors = calculate_health_factors(
+                self.vaults.collateral[batch], self.vaults.debt[batch],
+                self.prices[:, None])
+            insolvent = valid & (
+                health_factors < HEALTH_FACTOR_THRESHOLDS['INSOLVENCY'])
+            self._push(self.recovery_queue, self.recovery_head, self.recovery_tail,
+                       batch, insolvent)
+
+            # Liquidate the rest of the batch
+            to_liquidate = valid & ~insolvent
+            self._liquidate(batch, to_liquidate, health_factors)
+            liquidations_this_step += to_liquidate.sum(axis=1)
+
+        return liquidations_this_step
+
+    def process_insolvent_vaults_with_reserve_fund(self, recoveries_to_process):
+        """
+        Process insolvent vaults of each path using its reserve fund
+
+        Args:
+            recoveries_to_process (np.ndarray): Recovery limit of each path
+        """
+        recoveries_this_step = np.zeros(self.num_paths, dtype=np.intp)
+        stopped = np.zeros(self.num_paths, dtype=bool)
+
+        while True:
+            remaining = np.maximum(recoveries_to_process - recoveries_this_step, 0)
+            batch_sizes = np.where(
+                stopped, 0, np.minimum(remaining, self.get_recovery_queue_sizes()))
+            if not batch_sizes.any():
+                break
+            batch, valid = self._window(
+                self.recovery_queue, self.recovery_head, batch_sizes)
+            debt_amounts = self.vaults.debt[batch]
+
+            # Vaults without debt are dropped from the queue; they add nothing
+            # to the flows below, which keeps each row's running balance exact
+            candidates = valid & (debt_amounts > 0)
+            debt_amounts = np.where(candidates, debt_amounts, 0.0)
+            collateral_values = np.where(
+                candidates, self.vaults.collateral[batch] * self.prices[:, None], 0.0)
+
+            # Replay each path's reserve fund sequentially, as in Engine
+            flows = np.empty((self.num_paths, 2 * batch.shape[1]))
+            flows[:, 0::2] = -debt_amounts
+            flows[:, 1::2] = collateral_values
+            balances = np.cumsum(np.concatenate(
+                (self.reserve_fund[:, None], flows), axis=1), axis=1)
+            affordable = ~candidates | (balances[:, 0:-1:2] >= debt_amounts)
+
+            # Rows stop at their first unaffordable vault
+            depleted = ~affordable.all(axis=1)
+            num_taken = np.where(depleted, np.argmin(affordable, axis=1), batch_sizes)
+            recovered = candidates & (np.arange(batch.shape[1]) < num_taken[:, None])
+
+            self.reserve_fund = balances[np.arange(self.num_paths), 2 * num_taken]
+            self.reserve_fund_used = np.cumsum(np.concatenate(
+                (self.reserve_fund_used[:, None],
+                 np.where(recovered, debt_amounts, 0.0)), axis=1), axis=1)[:, -1]
+            health_factors = calculate_health_factors(
+                self.vaults.collateral[batch], self.vaults.debt[batch],
+                self.prices[:, None])
+            self._liquidate(batch, recovered, health_factors)
+            recoveries_this_step += recovered.sum(axis=1)
+
+            # The unaffordable vault and everything behind it stay queued
+            self.recovery_head += num_taken
+            self.reserve_fund_depleted |= depleted
+            stopped |= depleted
+
+        return recoveries_this_step
+
+    def get_metrics(self):
+        """
+        Get the protocol metrics of every path at its current price
+
+        Returns:
+            dict: Arrays over the paths, with the keys of
+                Simulation.calculate_protocol_metrics
+        """
+        prices = self.prices
+        self._set_metrics_prices(prices)
+        num_insolvent = self.num_below['INSOLVENCY']
+        num_liquidatable = self.num_below['LIQUIDATION'] - num_insolvent
+        num_at_risk = self.num_below['SAFE'] - self.num_below['LIQUIDATION']
+        num_healthy = self.num_active - \
+            self.num_below['SAFE'] - self.num_without_debt
+
+        initial_reserve_fund = self.initial_reserve_fund
+
+        return {
+            'total_collateral': self.total_collateral.copy(),
+            'total_collateral_value': self.total_collateral * prices,
+            'total_debt': self.total_debt.copy(),
+            'num_healthy_vaults': num_healthy,
+            'num_at_risk_vaults': num_at_risk,
+            'num_liquidatable_vaults': num_liquidatable,
+            'num_liquidated_vaults': self.num_liquidated.copy(),
+            'num_insolvent_vaults': num_insolvent.copy(),
+            'total_insolvent_collateral': self.total_insolvent_collateral.copy(),
+            'total_insolvent_collateral_value': self.total_insolvent_collateral * prices,
+            'total_debt_in_insolvent_vaults': self.total_debt_in_insolvent_vaults.copy(),
+            'protocol_health_factor': calculate_health_factors(
+                self.total_collateral, self.total_debt, prices),
+            'current_price': prices,
+            'reserve_fund': self.reserve_fund.copy(),
+            'initial_reserve_fund': np.full(self.num_paths, initial_reserve_fund),
+            'reserve_fund_used': self.reserve_fund_used.copy(),
+            'reserve_fund_percentage': self.reserve_fund / initial_reserve_fund * 100
+            if initial_reserve_fund > 0 else np.zeros(self.num_paths),
+            'reserve_fund_used_percentage': self.reserve_fund_used / initial_reserve_fund * 100
+            if initial_reserve_fund > 0 else np.zeros(self.num_paths),
+        }
@@ -0,0 +1,94 @@
+from utils import calculate_threshold_price
+import numpy as np
+
+
+class ThresholdPriceIndex:
+    """
+    Vaults sorted by the price at which their health factor drops below a threshold.
+
+    A vault's threshold price only depends on its collateral and debt, so it is
+    fixed until the vault is liquidated. Keeping the population sorted by that
+    price lets the engine find the vaults that crossed the threshold between two
+    prices with a binary search instead of recomputing every health factor.
+    """
+
+    def __init__(self, collateral, debt, threshold):
+        """
+        Build the index for a vault population
+
+        Args:
+            collateral (np.ndarray): Collateral amount of each vault
+            debt (np.ndarray): Debt amount of each vault
+            threshold (float): Health factor threshold the index tracks
+        """
+        self.threshold = threshold
+
+        # Vaults without collateral never cross (their price is 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prices = np.where(collateral > 0, calculate_threshold_price(
+                collateral, debt, threshold), 0.0)
+        self.threshold_prices = prices
+
+        # Sorted by descending threshold price: the first `position` entries are
+        # the vaults whose health factor is below the threshold at the last price
+        self.order = np.argsort(-prices, kind='stable')
+        self._negated_prices = -prices[self.order]
+        self.position = 0
+        # Price the index was last moved to, no vault is below the threshold
+        # before the first move
+        self.price = np.inf
+
+    @classmethod
+    def from_arrays(cls, threshold, threshold_prices, order, negated_prices):
+        """
+        Index over arrays of an earlier index of the same vaults, see arrays
+
+        The arrays are only read, so any number of indexes (and processes, when
+        the arrays are memory-mapped) can share them.
+        """
+        index = object.__new__(cls)
+        index.threshold = threshold
+        index.threshold_prices = threshold_prices
+        index.order = order
+        index._negated_prices = negated_prices
+        index.position = 0
+        index.price = np.inf
+        return index
+
+    def arrays(self):
+        """The index's read-only arrays, in the argument order of from_arrays"""
+        return self.threshold_prices, self.order, self._negated_prices
+
+    def nbytes(self):
+        """Bytes held by the index arrays"""
+        return self.threshold_prices.nbytes + self.order.nbytes + self._negated_prices.nbytes
+
+    def count_below_threshold(self, price):
+        """Number of vaults whose health factor is below the threshold at a price"""
+        return int(np.searchsorted(self._negated_prices, -price, side='left'))
+
+    def count_below_thresholds(self, prices):
+        """Vectorized count_below_threshold for an array of prices"""
+        return np.searchsorted(self._negated_prices, -np.asarray(prices), side='left')
+
+    def advance(self, price):
+        """
+        Move the index to a new price
+
+        Args:
+            price (float): The new price
+
+        Returns:
+            tuple: (crossed, uncrossed) vault indices that fell below the threshold
+                or rose back above it since the previous price
+        """
+        new_position = self.count_below_threshold(price)
+        crossed = self.order[self.position:new_position]
+        uncrossed = self.order[new_position:self.position]
+        self.position = new_position
+        self.price = price
+        return crossed, uncrossed
+
+    def is_below(self, vaults):
+        """Mask of the vaults the index counts as below the threshold at its price"""
+        return self.threshold_prices[vaults] > self.price
@@ -0,0 +1,199 @@
+"""
+Compiled kernel for the queue steps of the simulation fast path.
+
+The per-step queue logic (queue pops, health checks, reserve fund arithmetic
+and early breaks) is sequential and does not vectorize, so the kernel runs a
+whole phase as scalar loops over typed arrays in one call. The loops are
+compiled with Numba when it is installed; without it the same functions run
+as plain Python, and callers are expected to prefer the NumPy implementation
+(QueueRecurrence in services/simulation.py), which is faster uncompiled.
+"""
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Whether the kernel functions are compiled
+JIT_AVAILABLE = numba is not None
+
+# Slots of the integer state array
+STEP = 0
+PRICE_STEP = 1
+LIQUIDATION_HEAD = 2
+LIQUIDATION_TAIL = 3
+RECOVERY_HEAD = 4
+RECOVERY_TAIL = 5
+RECOVERY_ARRIVALS_START = 6
+RESERVE_FUND_DEPLETED = 7
+NUM_TRACKED_LIQUIDATED = 8
+NUM_STATE_SLOTS = 9
+
+# Slots of the float state array
+RESERVE_FUND = 0
+RESERVE_FUND_USED = 1
+NUM_FUND_SLOTS = 2
+
+
+def _jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+@_jit
+def set_step(step, state, queues):
+    """Move to a step and queue the recovery arrivals of its price step"""
+    (liquidation_queue, liquidation_tails, recovery_arrivals, recovery_arrival_ends,
+     recovery_queue, insolvent_step, liquidatable_step, liquidated_step, tracked) = queues
+    price_step = min(step, len(liquidation_tails) - 1)
+    state[STEP] = step
+    state[PRICE_STEP] = price_step
+    state[LIQUIDATION_TAIL] = liquidation_tails[price_step]
+    for position in range(state[RECOVERY_ARRIVALS_START], recovery_arrival_ends[price_step]):
+        recovery_queue[state[RECOVERY_TAIL]] = recovery_arrivals[position]
+        state[RECOVERY_TAIL] += 1
+    state[RECOVERY_ARRIVALS_START] = max(
+        state[RECOVERY_ARRIVALS_START], recovery_arrival_ends[price_step])
+
+
+@_jit
+def _liquidate(vault, state, queues):
+    (liquidation_queue, liquidation_tails, recovery_arrivals, recovery_arrival_ends,
+     recovery_queue, insolvent_step, liquidatable_step, liquidated_step, tracked) = queues
+    if liquidatable_step[vault] <= state[PRICE_STEP]:
+        liquidated_step[vault] = state[STEP]
+        if tracked[vault]:
+            state[NUM_TRACKED_LIQUIDATED] += 1
+
+
+@_jit
+def process_liquidations(liquidations_to_process, state, queues):
+    """Engine.process_liquidations, one queued vault at a time"""
+    (liquidation_queue, liquidation_tails, recovery_arrivals, recovery_arrival_ends,
+     recovery_queue, insolvent_step, liquidatable_step, liquidated_step, tracked) = queues
+    liquidations_this_step = 0
+    while (state[LIQUIDATION_HEAD] < state[LIQUIDATION_TAIL] and
+           liquidations_this_step < liquidations_to_process):
+        vault = liquidation_queue[state[LIQUIDATION_HEAD]]
+        state[LIQUIDATION_HEAD] += 1
+        if insolvent_step[vault] <= state[PRICE_STEP]:
+            # Insolvent vaults move to the recovery queue
+            recovery_queue[state[RECOVERY_TAIL]] = vault
+            state[RECOVERY_TAIL] += 1
+        else:
+            _liquidate(vault, state, queues)
+            liquidations_this_step += 1
+
+
+@_jit
+def process_insolvent_vaults_with_reserve_fund(recoveries_to_process, price, collateral,
+                                               debt, state, funds, queues):
+    """Engine.process_insolvent_vaults_with_reserve_fund, one queued vault at a time"""
+    (liquidation_queue, liquidation_tails, recovery_arrivals, recovery_arrival_ends,
+     recovery_queue, insolvent_step, liquidatable_step, liquidated_step, tracked) = queues
+    recoveries_this_step = 0
+    while (state[RECOVERY_HEAD] < state[RECOVERY_TAIL] and
+           recoveries_this_step < recoveries_to_process):
+        vault = recovery_queue[state[RECOVERY_HEAD]]
+        debt_amount = debt[vault]
+        if debt_amount > 0:
+            if not funds[RESERVE_FUND] >= debt_amount:
+                # The vault stays at the head of the queue
+                state[RESERVE_FUND_DEPLETED] = 1
+                return
+            # Same order of operations as the engine's running balances
+            funds[RESERVE_FUND] = (funds[RESERVE_FUND] - debt_amount) + collateral[vault] * price
+            funds[RESERVE_FUND_USED] += debt_amount
+            _liquidate(vault, state, queues)
+            recoveries_this_step += 1
+        # Vaults without debt are dropped from the queue
+        state[RECOVERY_HEAD] += 1
+
+
+@_jit
+def run_step(step, max_liquidations, recoveries_during_liquidations, step_prices,
+             collateral, debt, state, funds, queues):
+    """One step of run_simulation: recoveries alongside liquidations, then liquidations"""
+    set_step(step, state, queues)
+    price = step_prices[state[PRICE_STEP]]
+    liquidations_this_step = max_liquidations
+    if (state[RECOVERY_TAIL] > state[RECOVERY_HEAD] and
+            state[LIQUIDATION_TAIL] > state[LIQUIDATION_HEAD] and
+            not state[RESERVE_FUND_DEPLETED]):
+        process_insolvent_vaults_with_reserve_fund(
+            recoveries_during_liquidations, price, collateral, debt, state, funds, queues)
+        liquidations_this_step -= recoveries_during_liquidations
+    process_liquidations(liquidations_this_step, state, queues)
+
+
+@_jit
+def _record_step(step, state, funds, reserve_funds, reserve_funds_used, liquidation_queue_sizes):
+    reserve_funds[step] = funds[RESERVE_FUND]
+    reserve_funds_used[step] = funds[RESERVE_FUND_USED]
+    liquidation_queue_sizes[step] = state[LIQUIDATION_TAIL] - state[LIQUIDATION_HEAD]
+
+
+@_jit
+def run_price_drop_phase(num_blocks, max_liquidations, recoveries_during_liquidations,
+                         step_prices, collateral, debt, state, funds, queues,
+                         reserve_funds, reserve_funds_used, liquidation_queue_sizes):
+    """
+    Run steps 1 to num_blocks, recording the reserve fund and queue size of each
+    """
+    for step in range(1, num_blocks + 1):
+        run_step(step, max_liquidations, recoveries_during_liquidations, step_prices,
+                 collateral, debt, state, funds, queues)
+        _record_step(step, state, funds, reserve_funds, reserve_funds_used,
+                     liquidation_queue_sizes)
+
+
+@_jit
+def run_recovery_phase(num_blocks, max_recovery_steps, max_simulation_steps,
+                       num_liquidatable_at_end, max_liquidations,
+                       recoveries_during_liquidations, step_prices, collateral, debt,
+                       state, funds, queues, reserve_funds, reserve_funds_used,
+                       liquidation_queue_sizes):
+    """
+    Run the recovery steps after the price drop until run_simulation would stop
+
+    The liquidatable vaults at the final price are the tracked ones, and
+    once no step can change the state any more the remaining steps up to the
+    limits are left to the caller as a span.
+
+    Returns:
+        tuple: (number of recorded steps, number of skipped steps after them)
+    """
+    recovery_step = 0
+    total_step = num_blocks
+    while True:
+        recovery_step += 1
+        total_step = num_blocks + recovery_step
+        if recovery_step > max_recovery_steps or total_step > max_simulation_steps:
+            return total_step, 0
+
+        run_step(total_step, max_liquidations, recoveries_during_liquidations, step_prices,
+                 collateral, debt, state, funds, queues)
+        _record_step(total_step, state, funds, reserve_funds, reserve_funds_used,
+                     liquidation_queue_sizes)
+
+        num_liquidatable = num_liquidatable_at_end - state[NUM_TRACKED_LIQUIDATED]
+        liquidation_queue_size = state[LIQUIDATION_TAIL] - state[LIQUIDATION_HEAD]
+        if num_liquidatable == 0 and liquidation_queue_size == 0:
+            if (state[RECOVERY_TAIL] > state[RECOVERY_HEAD] and
+                    not state[RESERVE_FUND_DEPLETED]):
+                # These recoveries come after the step was recorded, so they
+                # show up in the next step
+                set_step(total_step + 1, state, queues)
+                process_insolvent_vaults_with_reserve_fund(
+                    max_liquidations, step_prices[state[PRICE_STEP]], collateral, debt,
+                    state, funds, queues)
+            else:
+                return total_step + 1, 0
+
+        if liquidation_queue_size == 0 and num_liquidatable > 0:
+            # Nothing can change before the step limits end the run
+            skipped_steps = max(min(max_recovery_steps - recovery_step,
+                                    max_simulation_steps - total_step), 0)
+            if skipped_steps > 0:
+                return total_step + 1, skipped_steps
+
@@ -1,15 +1,53 @@
+from types import MappingProxyType
 from config.params import SIMULATION_PARAMS
 from utils import calculate_health_factor, calculate_max_allowed_debt, get_health_status
 import numpy as np
 from scipy import stats
 
+# Read-only view of the default parameters, shared by vaults created without any
+DEFAULT_VAULT_PARAMS = MappingProxyType(SIMULATION_PARAMS)
+
+
+def freeze_params(params=None):
+    """
+    Read-only simulation parameters that vaults can share
+
+    Args:
+        params (Mapping, optional): Override parameters. An already frozen
+            mapping is returned as is.
+
+    Returns:
+        MappingProxyType: The default parameters updated with params
+    """
+    if isinstance(params, MappingProxyType):
+        return params
+    if not params:
+        return DEFAULT_VAULT_PARAMS
+    return MappingProxyType({**SIMULATION_PARAMS, **params})
+
 
 class Vault:
+    """
+    A single vault for code that uses the per-vault object API.
+
+    Vaults only hold their numeric state and a reference to read-only
+    parameters, which are shared by all vaults of an engine
+    (Engine.vault_params), so a vault costs a few dozen bytes instead of a
+    parameter dict and an instance __dict__ of its own.
+    """
+
+    __slots__ = ('params', 'collateral_amount', 'debt_amount', 'initial_health_factor')
+
     def __init__(self, params=None):
-        """Initialize the vault with optional scenario parameters"""
-        self.params = SIMULATION_PARAMS.copy()
-        if params:
-            self.params.update(params)
+        """
+        Initialize the vault with optional scenario parameters
+
+        Args:
+            params (Mapping, optional): Override parameters. Pass the frozen
+                parameters of freeze_params or Engine.vault_params to share
+                them instead of creating a copy for this vault.
+        """
+        self.params = freeze_params(params)
 
         # Generate random collateral amount using normal distribution
         self.collateral_amount = max(1000, round(np.random.normal(
@@ -39,6 +77,27 @@ class Vault:
         # Calculate debt amount based on health factor and starting price
         self.debt_amount = self.calculate_initial_debt_amount()
 
+    @classmethod
+    def from_state(cls, collateral_amount, debt_amount, initial_health_factor, params=None):
+        """
+        Create a vault with the given state instead of sampling one
+
+        Args:
+            collateral_amount (float): Collateral of the vault
+            debt_amount (float): Debt of the vault
+            initial_health_factor (float): Health factor at the start price
+            params (Mapping, optional): Parameters, as for Vault()
+
+        Returns:
+            Vault: The vault
+        """
+        vault = object.__new__(cls)
+        vault.params = freeze_params(params)
+        vault.collateral_amount = collateral_amount
+        vault.debt_amount = debt_amount
+        vault.initial_health_factor = initial_health_factor
+        return vault
+
     def get_collateral_amount(self):
         return self.collateral_amount
 
@@ -58,9 +117,9 @@ class Vault:
         return calculate_health_factor(self.collateral_amount, self.debt_amount, price)
 
     def get_health_status(self, price):
-        health_factor = self.calculate_health_factor(price)
-        is_liquidated = self.collateral_amount == 0
-        return get_health_status(health_factor, is_liquidated)
+        if self.collateral_amount == 0:
+            return "LIQUIDATED"
+        return get_health_status(self.calculate_health_factor(price))
 
     def liquidate_vault(self, price):
         health_factor = self.calculate_health_factor(price)
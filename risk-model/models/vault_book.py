@@ -0,0 +1,432 @@
+from pathlib import Path
+from config.params import SIMULATION_PARAMS
+from utils import (calculate_health_factors, calculate_max_allowed_debt, get_health_status,
+                   HEALTH_FACTOR_THRESHOLDS)
+from .price_index import ThresholdPriceIndex
+import numpy as np
+
+# Vault status codes stored in VaultBook.status
+VAULT_ACTIVE = 0
+VAULT_LIQUIDATED = 1
+
+# Parameters that determine a generated vault population: scenarios that agree
+# on these can share one population
+POPULATION_PARAMS = (
+    'num_vaults',
+    'mean_collateral_amount',
+    'health_factor_mean',
+    'health_factor_std',
+    'min_health_factor',
+    'start_price',
+)
+
+# Arrays that make up a stored vault population, one .npy file each
+POPULATION_ARRAYS = ('collateral', 'debt', 'initial_health_factor')
+
+# Thresholds whose price index arrays are stored with a population, see
+# VaultBook.price_index. Named index_<threshold>_<array>.npy, with the arrays
+# of PRICE_INDEX_ARRAYS.
+POPULATION_INDEX_THRESHOLDS = tuple(sorted(set(HEALTH_FACTOR_THRESHOLDS.values())))
+PRICE_INDEX_ARRAYS = ('prices', 'order', 'sorted')
+
+
+def sample_collateral(params, rng, size):
+    """Collateral amounts of size vaults, normally distributed"""
+    mean_collateral = params['mean_collateral_amount']
+    return np.maximum(1000, np.round(rng.normal(
+        loc=mean_collateral, scale=mean_collateral * 1, size=size)))
+
+
+def sample_initial_health_factors(params, rng, size):
+    """Initial health factors of size vaults, log-normally distributed"""
+    # Get health factor distribution parameters
+    mean_hf = params.get('health_factor_mean', 150)
+    std_hf = params.get('health_factor_std', 30)
+    min_hf = params.get('min_health_factor', 105)
+
+    # Log-normal health factors with the configured mean and std
+    phi = std_hf / mean_hf  # Coefficient of variation
+    sigma = np.sqrt(np.log(1 + phi**2))
+    mu = np.log(mean_hf) - 0.5 * sigma**2
+    return np.maximum(min_hf, rng.lognormal(mean=mu, sigma=sigma, size=size))
+
+
+def initial_debt(params, collateral, initial_health_factor):
+    """Debt amounts that give the vaults their health factor at the starting price"""
+    max_allowed_debt = calculate_max_allowed_debt(collateral * params['start_price'])
+    return max_allowed_debt / (initial_health_factor / 100)
+
+
+class VaultBook:
+    """
+    Struct-of-arrays storage for a vault population.
+
+    Collateral, debt, initial health factor and status are held in contiguous
+    NumPy arrays so the engine and the simulation can work on the whole
+    population at once. Individual vaults remain reachable through
+    lightweight VaultView objects for code that still uses the per-vault API.
+
+    Clones never copy collateral and debt. They share them read only and
+    keep their liquidations in a private status array (the overlay), so many
+    simulations can run on one population, including a memory-mapped one.
+    Reads of single vaults (collateral_of, debt_of) apply the overlay on
+    the fly; the collateral and debt attributes of a clone with liquidations
+    are materialized on first access.
+    """
+
+    def __init__(self, collateral, debt, initial_health_factor):
+        """
+        Build a book from per-vault arrays
+
+        Args:
+            collateral (array-like): Collateral amount of each vault
+            debt (array-like): Debt amount of each vault
+            initial_health_factor (array-like): Initial health factor of each vault
+        """
+        self._init_arrays(np.array(collateral, dtype=np.float64),
+                          np.array(debt, dtype=np.float64),
+                          np.array(initial_health_factor, dtype=np.float64))
+
+    def _init_arrays(self, collateral, debt, initial_health_factor):
+        if not (len(collateral) == len(debt) == len(initial_health_factor)):
+            raise ValueError(
+                "collateral, debt and initial_health_factor must have the same length")
+        self._collateral = collateral
+        self._debt = debt
+        self.initial_health_factor = initial_health_factor
+        self.status = np.full(len(collateral), VAULT_ACTIVE, dtype=np.int8)
+        # Set while the arrays are shared with clones of this book
+        self._shared = False
+        # Clones record liquidations in status only
+        self._overlay = False
+        self._has_liquidations = False
+        self._effective = None
+        # Directory the arrays are memory-mapped from
+        self._source = None
+        # Price index arrays by threshold, valid until a vault is liquidated
+        self._indexes = {}
+
+    @classmethod
+    def wrap(cls, collateral, debt, initial_health_factor):
+        """
+        Build a book around existing arrays without copying them
+
+        The arrays are treated as shared and read only; simulations work on
+        clones of the book.
+
+        Returns:
+            VaultBook: The book
+        """
+        book = object.__new__(cls)
+        book._init_arrays(collateral, debt, initial_health_factor)
+        book._shared = True
+        return book
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Memory-map a population stored as .npy files, see POPULATION_ARRAYS
+
+        Pages are read on demand and shared by every process mapping the
+        same files, so the population does not need to fit in memory.
+        Pickling the book, e.g. to send it to a worker process, only sends
+        the directory and the worker maps the files itself.
+
+        Args:
+            directory (str | Path): Directory holding the arrays
+
+        Returns:
+            VaultBook: A read-only book, simulations work on clones of it
+        """
+        directory = Path(directory)
+        book = cls.wrap(*(np.load(directory / f'{name}.npy', mmap_mode='r')
+                          for name in POPULATION_ARRAYS))
+        book._source = directory
+        # Stored price indexes are mapped too, instead of sorting the vaults
+        # again in every run
+        for path in directory.glob(f'index_*_{PRICE_INDEX_ARRAYS[0]}.npy'):
+            threshold = float(path.name.split('_')[1])
+            book._indexes[threshold] = tuple(
+                np.load(directory / f'index_{threshold:g}_{name}.npy', mmap_mode='r')
+                for name in PRICE_INDEX_ARRAYS)
+        return book
+
+    def price_index_thresholds(self):
+        """Thresholds whose index arrays the book holds, the stored ones after load"""
+        return set(self._indexes)
+
+    def save_price_indexes(self, directory, thresholds=POPULATION_INDEX_THRESHOLDS):
+        """Write the price index arrays of some thresholds for VaultBook.load"""
+        directory = Path(directory)
+        for threshold in thresholds:
+            index = self.price_index(threshold)
+            for name, array in zip(PRICE_INDEX_ARRAYS, index.arrays()):
+                np.save(directory / f'index_{threshold:g}_{name}.npy', array)
+
+    def price_index(self, threshold):
+        """
+        ThresholdPriceIndex of the vaults for a health factor threshold
+
+        The sorted arrays are built once per book and threshold, or
+        memory-mapped for a loaded book, and shared by every later index of
+        the book and of its clones. Only the position of an index is its own.
+        """
+        arrays = self._indexes.get(threshold)
+        if arrays is None:
+            index = ThresholdPriceIndex(self.collateral, self.debt, threshold)
+            arrays = index.arrays()
+            for array in arrays:
+                array.flags.writeable = False
+            self._indexes[threshold] = arrays
+            return index
+        return ThresholdPriceIndex.from_arrays(threshold, *arrays)
+
+    def __reduce_ex__(self, protocol):
+        if self._source is not None and not self._overlay:
+            return (type(self).load, (self._source,))
+        return super().__reduce_ex__(protocol)
+
+    @property
+    def collateral(self):
+        """Collateral amount of each vault, 0 once liquidated"""
+        if self._overlay and self._has_liquidations:
+            return self._materialize()[0]
+        return self._collateral
+
+    @property
+    def debt(self):
+        """Debt amount of each vault, 0 once liquidated"""
+        if self._overlay and self._has_liquidations:
+            return self._materialize()[1]
+        return self._debt
+
+    def _materialize(self):
+        """Read-only collateral and debt arrays with the overlay applied"""
+        if self._effective is None:
+            liquidated = self.status == VAULT_LIQUIDATED
+            self._effective = tuple(np.where(liquidated, 0.0, values)
+                                    for values in (self._collateral, self._debt))
+            for values in self._effective:
+                values.flags.writeable = False
+        return self._effective
+
+    def collateral_of(self, indices):
+        """Collateral amounts of the selected vaults, without materializing the overlay"""
+        if self._overlay and self._has_liquidations:
+            # [()] keeps a single index a scalar
+            return np.where(self.status[indices] == VAULT_LIQUIDATED, 0.0,
+                            self._collateral[indices])[()]
+        return self._collateral[indices]
+
+    def debt_of(self, indices):
+        """Debt amounts of the selected vaults, without materializing the overlay"""
+        if self._overlay and self._has_liquidations:
+            return np.where(self.status[indices] == VAULT_LIQUIDATED, 0.0,
+                            self._debt[indices])[()]
+        return self._debt[indices]
+
+    @classmethod
+    def generate(cls, params, rng=None):
+        """
+        Sample a whole vault population in vectorized form
+
+        Draws the same distributions as Vault.__init__ (normal collateral
+        amounts, log-normal health factors) with one call per distribution.
+
+        Args:
+            params (dict): Simulation parameters
+            rng (np.random.Generator, optional): Random generator, defaults to
+                the global NumPy random state
+
+        Returns:
+            VaultBook: The generated population
+        """
+        rng = np.random if rng is None else rng
+        num_vaults = params['num_vaults']
+        collateral = sample_collateral(params, rng, num_vaults)
+        initial_health_factor = sample_initial_health_factors(params, rng, num_vaults)
+        # Debt amounts follow from the health factor at the starting price
+        debt = initial_debt(params, collateral, initial_health_factor)
+        return cls(collateral, debt, initial_health_factor)
+
+    @classmethod
+    def from_vaults(cls, vaults):
+        """Build a book from an iterable of Vault objects"""
+        vaults = list(vaults)
+        return cls(
+            [vault.get_collateral_amount() for vault in vaults],
+            [vault.get_debt_amount() for vault in vaults],
+            [vault.initial_health_factor for vault in vaults],
+        )
+
+    def clone(self):
+        """
+        Copy-on-write copy of the book
+
+        The clone shares this book's arrays, which become read-only. Its
+        liquidations go to an overlay: the status array is copied on the
+        first one, while collateral and debt stay shared. Handing one
+        generated population to many simulations therefore costs no sampling
+        and one byte per vault for each simulation.
+
+        Returns:
+            VaultBook: The clone
+        """
+        for array in (self._collateral, self._debt, self.initial_health_factor, self.status):
+            if array.flags.writeable:
+                array.flags.writeable = False
+        self._shared = True
+
+        clone = object.__new__(type(self))
+        clone._collateral = self.collateral
+        clone._debt = self.debt
+        clone.initial_health_factor = self.initial_health_factor
+        clone.status = self.status
+        clone._shared = True
+        clone._overlay = True
+        clone._has_liquidations = False
+        clone._effective = None
+        clone._source = None
+        # Indexes of a book with liquidations only cover its remaining vaults
+        clone._indexes = self._indexes if not self._has_liquidations else {}
+        return clone
+
+    def _make_private(self):
+        """Copy the mutable arrays before the first write to a shared book"""
+        if self._shared:
+            self.status = self.status.copy()
+            if not self._overlay:
+                self._collateral = self._collateral.copy()
+                self._debt = self._debt.copy()
+            self._shared = False
+
+    def __len__(self):
+        return len(self._collateral)
+
+    def nbytes(self):
+        """Bytes held by the vault arrays, shared and memory-mapped ones included"""
+        arrays = [self._collateral, self._debt, self.initial_health_factor, self.status]
+        if self._effective is not None:
+            arrays.extend(self._effective)
+        return sum(array.nbytes for array in arrays)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("vault index out of range")
+        return VaultView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield VaultView(self, index)
+
+    def collateral_values(self, price, indices=None):
+        """Collateral value of the selected vaults (all vaults by default)"""
+        collateral = self.collateral if indices is None else self.collateral_of(indices)
+        return collateral * price
+
+    def calculate_health_factors(self, price, indices=None):
+        """
+        Calculate health factors of the selected vaults at the given price
+
+        Args:
+            price (float): Collateral price
+            indices (array-like, optional): Vault indices, all vaults if omitted
+
+        Returns:
+            np.ndarray: Health factors, inf where a vault has no debt
+        """
+        if indices is None:
+            return calculate_health_factors(self.collateral, self.debt, price)
+        return calculate_health_factors(
+            self.collateral_of(indices), self.debt_of(indices), price)
+
+    def liquidate(self, indices, price, threshold=None):
+        """
+        Liquidate the selected vaults at the given price
+
+        Mirrors Vault.liquidate_vault: only vaults below the liquidation
+        threshold have their collateral and debt cleared.
+
+        Args:
+            indices (array-like): Vaults to liquidate
+            price (float): Collateral price
+            threshold (float, optional): Liquidation health factor threshold,
+                the configured default if not given
+
+        Returns:
+            np.ndarray: Boolean mask of the vaults that were liquidated
+        """
+        if threshold is None:
+            threshold = SIMULATION_PARAMS['health_factor_liquidation_threshold']
+        indices = np.asarray(indices, dtype=np.intp)
+        liquidatable = self.calculate_health_factors(price, indices) < threshold
+
+        self.mark_liquidated(indices[liquidatable])
+        return liquidatable
+
+    def mark_liquidated(self, indices):
+        """Clear the collateral and debt of vaults and mark them liquidated"""
+        if len(indices) == 0:
+            return
+        self._make_private()
+        # The shared price index arrays stay with the clones that use them
+        self._indexes = {}
+        if self._overlay:
+            self._has_liquidations = True
+            self._effective = None
+        else:
+            self._has_liquidations = True
+            self._collateral[indices] = 0
+            self._debt[indices] = 0
+        self.status[indices] = VAULT_LIQUIDATED
+
+
+class VaultView:
+    """Per-vault view onto a VaultBook exposing the Vault object API"""
+
+    __slots__ = ('book', 'index')
+
+    def __init__(self, book, index):
+        self.book = book
+        self.index = index
+
+    def __eq__(self, other):
+        return (isinstance(other, VaultView) and
+                other.book is self.book and other.index == self.index)
+
+    def __hash__(self):
+        return hash((id(self.book), self.index))
+
+    @property
+    def collateral_amount(self):
+        return self.book.collateral_of(self.index)
+
+    @property
+    def debt_amount(self):
+        return self.book.debt_of(self.index)
+
+    @property
+    def initial_health_factor(self):
+        return self.book.initial_health_factor[self.index]
+
+    def get_collateral_amount(self):
+        return self.collateral_amount
+
+    def get_collateral_value(self, price):
+        return self.collateral_amount * price
+
+    def get_debt_amount(self):
+        return self.debt_amount
+
+    def calculate_health_factor(self, price):
+        return self.book.calculate_health_factors(price, [self.index])[0]
+
+    def get_health_status(self, price):
+        if self.collateral_amount == 0:
+            return "LIQUIDATED"
+        return get_health_status(self.calculate_health_factor(price))
+
+    def liquidate_vault(self, price):
+        return bool(self.book.liquidate([self.index], price)[0])
@@ -0,0 +1,206 @@
+import heapq
+import sys
+import numpy as np
+
+# Orders in which queued vaults are liquidated, see liquidation_priorities
+LIQUIDATION_ORDERS = ('fifo', 'worst_health_first', 'largest_debt_first')
+
+# Size of a heap entry: its list slot and a tuple of a float and two ints
+HEAP_ENTRY_BYTES = 8 + sys.getsizeof((0.0, 0, 0)) + 24 + 2 * 28
+
+
+def liquidation_priorities(order, collateral, debt):
+    """
+    Priority of each vault in a liquidation order, lowest first
+
+    A vault's health factor is proportional to collateral / debt at any
+    price, so the worst health first order is fixed for as long as the vaults
+    are queued.
+
+    Args:
+        order (str): One of LIQUIDATION_ORDERS
+        collateral (np.ndarray): Collateral amount of each vault
+        debt (np.ndarray): Debt amount of each vault
+
+    Returns:
+        np.ndarray: Priorities, None for the fifo order
+    """
+    if order not in LIQUIDATION_ORDERS:
+        raise ValueError(
+            f"Unknown liquidation order {order!r}, expected one of {', '.join(LIQUIDATION_ORDERS)}")
+    if order == 'fifo':
+        return None
+    if order == 'worst_health_first':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(debt > 0, collateral / debt, np.inf)
+    return -debt
+
+
+class VaultQueue:
+    """
+    FIFO queue of vault indices in an integer array.
+
+    Pushes write behind the tail and pops move the head, returning a view of
+    the popped entries. Popped entries are never overwritten, which also lets
+    the last pop be undone. When a push does not fit, the live entries move
+    to the front of a new buffer twice their size, so the buffer follows the
+    number of queued vaults rather than the size of the population.
+    """
+
+    def __init__(self, capacity=0):
+        """
+        Args:
+            capacity (int): Number of entries the buffer initially holds
+        """
+        self.buffer = np.empty(capacity, dtype=np.intp)
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def __iter__(self):
+        return iter(self.buffer[self.head:self.tail].tolist())
+
+    def clear(self):
+        self.head = 0
+        self.tail = 0
+
+    def nbytes(self):
+        """Bytes held by the buffer"""
+        return self.buffer.nbytes
+
+    def push(self, vaults):
+        """Append vault indices to the end of the queue, in order"""
+        count = len(vaults)
+        if self.tail + count > len(self.buffer):
+            queued = self.buffer[self.head:self.tail]
+            self.buffer = np.empty(2 * (len(queued) + count), dtype=np.intp)
+            self.buffer[:len(queued)] = queued
+            self.head, self.tail = 0, len(queued)
+        self.buffer[self.tail:self.tail + count] = vaults
+        self.tail += count
+
+    def pop(self, count):
+        """
+        Remove up to count vaults from the front of the queue
+
+        Returns:
+            np.ndarray: The popped vault indices, a read-only view of the buffer
+        """
+        count = min(count, len(self))
+        vaults = self.buffer[self.head:self.head + count]
+        vaults.flags.writeable = False
+        self.head += count
+        return vaults
+
+    def unpop(self, count):
+        """Return the last count popped vaults to the front of the queue"""
+        self.head -= count
+
+
+class PriorityVaultQueue:
+    """
+    Queue of vault indices popped in order of a per-vault priority.
+
+    Backed by a binary heap of (priority, arrival, vault) entries, so pushes
+    and pops cost O(log N) however many vaults are queued; vaults of equal
+    priority leave in arrival order. Removing a vault only unstamps it: its
+    heap entry is skipped when it reaches the top (lazy deletion), so discard
+    is O(1) and never has to search the heap. Every push stamps the vault
+    with the arrival of its new entry, so an entry left over from an earlier
+    stay in the queue is never mistaken for the live one, and the heap is
+    rebuilt once stale entries outnumber live ones.
+
+    A vault that is discarded and pushed again queues behind the vaults
+    that arrived in the meantime:
+
+        >>> queue = PriorityVaultQueue(np.array([1.0, 1.0, 1.0]))
+        >>> queue.push([0]); queue.push([1]); queue.discard([0]); queue.push([0])
+        >>> queue.pop(3).tolist()
+        [1, 0]
+    """
+
+    def __init__(self, priorities):
+        """
+        Args:
+            priorities (np.ndarray): Priority of each vault, lowest first. A
+                vault's priority is read when it is pushed.
+        """
+        self.priorities = priorities
+        self.heap = []
+        self.queued = np.zeros(len(priorities), dtype=bool)
+        # Arrival of each queued vault's live heap entry
+        self.entry_id = np.full(len(priorities), -1, dtype=np.int64)
+        self.size = 0
+        self._arrivals = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(vault for _, arrival, vault in sorted(self.heap)
+                    if self._is_live(arrival, vault))
+
+    def _is_live(self, arrival, vault):
+        return self.queued[vault] and self.entry_id[vault] == arrival
+
+    def clear(self):
+        self.heap = []
+        self.queued[:] = False
+        self.entry_id[:] = -1
+        self.size = 0
+
+    def nbytes(self):
+        """Bytes held by the heap entries, the membership flags and the stamps"""
+        return self.queued.nbytes + self.entry_id.nbytes + len(self.heap) * HEAP_ENTRY_BYTES
+
+    def push(self, vaults):
+        """Add vault indices, those already queued are ignored"""
+        vaults = np.asarray(vaults, dtype=np.intp)
+        vaults = vaults[~self.queued[vaults]]
+        self.queued[vaults] = True
+        self.size += len(vaults)
+        arrivals = np.arange(self._arrivals, self._arrivals + len(vaults))
+        self.entry_id[vaults] = arrivals
+        entries = zip(self.priorities[vaults].tolist(), arrivals.tolist(), vaults.tolist())
+        self._arrivals += len(vaults)
+        if len(self.heap) > 2 * self.size:
+            # Drop the stale entries while rebuilding, so the heap stays
+            # within twice the number of queued vaults
+            self.heap = [entry for entry in self.heap if self._is_live(entry[1], entry[2])]
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+        elif len(vaults) > len(self.heap):
+            # Rebuilding is O(N), cheaper than pushing a large batch one by one
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+        else:
+            for entry in entries:
+                heapq.heappush(self.heap, entry)
+
+    def pop(self, count):
+        """
+        Remove up to count vaults with the lowest priorities
+
+        Returns:
+            np.ndarray: The popped vault indices, in priority order
+        """
+        vaults = []
+        while self.heap and len(vaults) < count:
+            _, arrival, vault = heapq.heappop(self.heap)
+            # Entries of discarded vaults, and earlier entries of re-pushed
+            # ones, are dropped here
+            if self._is_live(arrival, vault):
+                self.queued[vault] = False
+                vaults.append(vault)
+        self.size -= len(vaults)
+        return np.array(vaults, dtype=np.intp)
+
+    def discard(self, vaults):
+        """Remove vault indices wherever they are in the queue"""
+        vaults = np.asarray(vaults, dtype=np.intp)
+        vaults = vaults[self.queued[vaults]]
+        self.queued[vaults] = False
+        self.entry_id[vaults] = -1
+        self.size -= len(vaults)
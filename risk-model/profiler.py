@@ -0,0 +1,195 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import cProfile
+import json
+import pstats
+import time
+
+# Profile outputs besides the JSON summary
+PROFILE_EXPORTS = ('cprofile', 'collapsed')
+
+
+class _RawStats:
+    """cProfile statistics in the form pstats.Stats loads and adds"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _combine_stats(first, second):
+    """Sum two sets of raw cProfile statistics, either of which may be empty"""
+    if not first:
+        return second or None
+    if not second:
+        return first
+    stats = pstats.Stats(_RawStats(first))
+    stats.add(_RawStats(second))
+    return stats.stats
+
+
+class Profiler:
+    """
+    Opt-in wall-time and counter instrumentation of simulation runs.
+
+    Timers nest: a timer started inside another is recorded under the outer
+    timer's name, e.g. 'run_simulation/price_drop/process_liquidations'.
+    Counters are plain totals such as the number of health factor
+    evaluations. Profiles of separate runs (or worker processes) are combined
+    with merge.
+    """
+
+    enabled = True
+
+    def __init__(self, cprofile=False):
+        """
+        Initialize an empty profile
+
+        Args:
+            cprofile (bool): Also collect cProfile statistics inside the
+                profile_calls blocks
+        """
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self._stack = []
+        self.cprofile = cprofile
+        self._cprofile = cProfile.Profile() if cprofile else None
+        self._cprofile_stats = None
+
+    @contextmanager
+    def timer(self, name):
+        """Add the wall time of the block to the timer name"""
+        self._stack.append(name)
+        key = '/'.join(self._stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[key] += time.perf_counter() - start
+            self.calls[key] += 1
+            self._stack.pop()
+
+    def count(self, name, amount=1):
+        """Add amount to a counter"""
+        self.counters[name] += amount
+
+    @contextmanager
+    def profile_calls(self):
+        """Collect cProfile statistics of the block, if enabled"""
+        if self._cprofile is None:
+            yield
+            return
+        self._cprofile.enable()
+        try:
+            yield
+        finally:
+            self._cprofile.disable()
+
+    def _stats(self):
+        """cProfile statistics collected so far, None without cProfile"""
+        if self._cprofile is None:
+            return self._cprofile_stats
+        self._cprofile.create_stats()
+        return _combine_stats(dict(self._cprofile.stats), self._cprofile_stats)
+
+    def state(self):
+        """Picklable contents of the profile, for merging into another"""
+        return {
+            'timings': dict(self.timings),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+            'cprofile_stats': self._stats(),
+        }
+
+    def merge(self, state):
+        """Add the contents of another profile, as returned by state()"""
+        for key, seconds in state['timings'].items():
+            self.timings[key] += seconds
+        for key, calls in state['calls'].items():
+            self.calls[key] += calls
+        for name, amount in state['counters'].items():
+            self.counters[name] += amount
+        self._cprofile_stats = _combine_stats(self._cprofile_stats, state['cprofile_stats'])
+
+    def to_dict(self):
+        """Timings and counters in JSON form"""
+        return {
+            'timings': {key: {'seconds': self.timings[key], 'calls': self.calls[key]}
+                        for key in sorted(self.timings)},
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def collapsed_stacks(self):
+        """
+        Timings in collapsed-stack format, one 'outer;inner microseconds' line
+        per timer with the time not spent in nested timers, as read by
+        flame graph tools
+        """
+        self_times = dict(self.timings)
+        for key, seconds in self.timings.items():
+            parent = key.rpartition('/')[0]
+            if parent in self_times:
+                self_times[parent] -= seconds
+        return [f"{key.replace('/', ';')} {max(0, round(seconds * 1e6))}"
+                for key, seconds in sorted(self_times.items())]
+
+    def write(self, base_path, exports=()):
+        """
+        Write the profile next to a run's results
+
+        Args:
+            base_path (str): Path the file suffixes are appended to
+            exports (iterable): Extra outputs from PROFILE_EXPORTS - 'cprofile'
+                writes pstats data (.prof), 'collapsed' collapsed stacks
+
+        Returns:
+            list: Paths of the files written
+        """
+        base_path = Path(base_path)
+        base_path.parent.mkdir(parents=True, exist_ok=True)
+        paths = [base_path.with_name(base_path.name + '.profile.json')]
+        with open(paths[0], 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+        if 'cprofile' in exports:
+            stats = self._stats()
+            if stats is not None:
+                paths.append(base_path.with_name(base_path.name + '.prof'))
+                pstats.Stats(_RawStats(stats)).dump_stats(paths[-1])
+        if 'collapsed' in exports:
+            paths.append(base_path.with_name(base_path.name + '.collapsed.txt'))
+            with open(paths[-1], 'w') as file:
+                file.write('\n'.join(self.collapsed_stacks()) + '\n')
+        return paths
+
+    def print_summary(self):
+        """Print the timers, slowest first, and the counters"""
+        print("\nProfile (wall time):")
+        for key, seconds in sorted(self.timings.items(), key=lambda item: -item[1]):
+            print(f"  {key:<70} {seconds:>9.3f}s {self.calls[key]:>9} calls")
+        if self.counters:
+            print("\nCounters:")
+            for name, amount in sorted(self.counters.items()):
+                print(f"  {name:<70} {amount:>12}")
+
+
+class NullProfiler:
+    """Profiler stand-in that records nothing, used when profiling is off"""
+
+    enabled = False
+
+    def timer(self, name):
+        return nullcontext()
+
+    def count(self, name, amount=1):
+        pass
+
+    def profile_calls(self):
+        return nullcontext()
+
+
+NULL_PROFILER = NullProfiler()
@@ -4,7 +4,8 @@ import seaborn as sns
 from pathlib import Path
 from datetime import datetime
 import json
-from utils import get_protocol_status, get_health_status_labels, HEALTH_FACTOR_THRESHOLDS
+from services.results_store import open_results_store
+from utils import get_protocol_status, get_protocol_statuses, get_health_status_labels, HEALTH_FACTOR_THRESHOLDS
 import numpy as np
 import scipy.stats as stats
 import matplotlib.colors as mcolors
@@ -12,27 +13,46 @@ import matplotlib.patches as mpatches
 
 
 class ReportGenerator:
-    def __init__(self, csv_path, distributions_path=None):
-        """Initialize report generator with path to CSV files"""
+    # Columns read by each report section
+    EXECUTIVE_SUMMARY_COLUMNS = [
+        'scenario_name', 'price', 'simulation_hour', 'num_vaults',
+        'health_factor_mean', 'health_factor_std', 'min_health_factor',
+        'protocol_health_factor', 'total_collateral', 'total_debt',
+        'num_liquidated_vaults', 'collateralization_ratio', 'num_healthy_vaults',
+        'num_at_risk_vaults', 'num_liquidatable_vaults', 'num_insolvent_vaults'
+    ]
+    HEATMAP_COLUMNS = [
+        'scenario_name', 'iteration', 'step', 'simulation_phase', 'num_vaults',
+        'protocol_health_factor', 'num_liquidated_vaults'
+    ]
+    SUMMARY_STATISTICS_COLUMNS = [
+        'scenario_name', 'protocol_health_factor', 'collateralization_ratio',
+        'num_liquidated_vaults', 'liquidation_queue_size'
+    ]
+
+    def __init__(self, csv_path, distributions_path=None, scenario_filter=None):
+        """
+        Initialize report generator with the path to the results
+
+        Args:
+            csv_path (str): Results CSV file, or a Parquet results directory
+            distributions_path (str, optional): Health factor distributions CSV
+            scenario_filter (callable, optional): Only report on the scenarios
+                whose name it returns True for
+        """
         self.csv_path = Path(csv_path)
-        self.df = pd.read_csv(self.csv_path)
+        self.store = open_results_store(self.csv_path, scenario_filter)
 
         # Load distributions if available
         self.distributions_path = distributions_path
         if distributions_path:
             self.distributions_df = pd.read_csv(Path(distributions_path))
         else:
-            # Try to infer distributions path from results path
-            potential_dist_path = self.csv_path.parent / \
-                f"health_distributions_{self.csv_path.name.split('_')[-1]}"
-            if potential_dist_path.exists():
-                self.distributions_df = pd.read_csv(potential_dist_path)
-                self.distributions_path = potential_dist_path
-            else:
-                self.distributions_df = None
+            # Try to find the distributions stored with the results
+            self.distributions_df, self.distributions_path = self.store.read_distributions()
 
+        self.scenarios = self.store.scenario_names()
         self.output_dir = self._create_output_directory()
-        self.scenarios = self.df['scenario_name'].unique()
 
         # Set style for all plots
         sns.set_theme()
@@ -45,7 +65,7 @@ class ReportGenerator:
         output_dir.mkdir(parents=True, exist_ok=True)
 
         # Create subdirectory for each scenario
-        for scenario in self.df['scenario_name'].unique():
+        for scenario in self.scenarios:
             (output_dir / scenario).mkdir(exist_ok=True)
 
         return output_dir
@@ -61,7 +81,7 @@ class ReportGenerator:
         # Generate individual scenario reports
         for scenario in self.scenarios:
             print(f"\nGenerating reports for scenario: {scenario}")
-            scenario_df = self.df[self.df['scenario_name'] == scenario]
+            scenario_df = self.store.read(scenario=scenario)
 
             # Generate detailed step-by-step breakdown for this scenario
             self.generate_step_by_step_breakdown(scenario, scenario_df)
@@ -86,17 +106,27 @@ class ReportGenerator:
         labels = get_health_status_labels()
 
         summary = []
+        df = self.store.read(columns=self.EXECUTIVE_SUMMARY_COLUMNS)
+
+        # Classify the final state of every scenario in one call
+        final_states = df.groupby('scenario_name', sort=False).tail(1)
+        protocol_statuses = dict(zip(
+            final_states['scenario_name'],
+            get_protocol_statuses(
+                final_states['protocol_health_factor'],
+                final_states['num_vaults'] - final_states['num_liquidated_vaults'])
+        ))
 
         for scenario in self.scenarios:
-            scenario_df = self.df[self.df['scenario_name'] == scenario]
+            scenario_df = df[df['scenario_name'] == scenario]
             final_state = scenario_df.iloc[-1]
             initial_state = scenario_df.iloc[0]
 
             # Get scenario parameters
             scenario_params = {
                 'num_vaults': int(final_state['num_vaults']),
-                'price_drop_percentage': float((self.df['price'].iloc[0] - final_state['price']) /
-                                               self.df['price'].iloc[0] * 100),
+                'price_drop_percentage': float((df['price'].iloc[0] - final_state['price']) /
+                                               df['price'].iloc[0] * 100),
                 'simulation_duration': float(final_state['simulation_hour']),
                 'health_factor_mean': float(initial_state.get('health_factor_mean', 150)),
                 'health_factor_std': float(initial_state.get('health_factor_std', 30)),
@@ -117,11 +147,7 @@ class ReportGenerator:
             }
 
             # Get protocol status
-            protocol_status = get_protocol_status(
-                final_metrics['protocol_health_factor'],
-                scenario_params['num_vaults'] -
-                final_metrics['num_liquidated_vaults']
-            )
+            protocol_status = str(protocol_statuses[scenario])
 
             summary.append({
                 'scenario_name': scenario,
@@ -196,7 +222,8 @@ class ReportGenerator:
         by `risk_level` vs. `price_drop`.
         """
         # 1) Sort and keep only final row of each scenario_name+iteration
-        df_sorted = self.df.sort_values(by='step', ascending=True)
+        df_sorted = self.store.read(columns=self.HEATMAP_COLUMNS).sort_values(
+            by='step', ascending=True)
 
         # Create two separate dataframes - one for end of price drop, one for final state
         # For price drop phase, get the last row of each scenario where simulation_phase is 'price_drop'
@@ -792,10 +819,8 @@ class ReportGenerator:
             mu = np.log(mean_hf) - 0.5 * sigma**2
 
             # Generate synthetic health factors
-            synthetic_hfs = np.array([
-                max(min_hf, stats.lognorm.rvs(s=sigma, scale=np.exp(mu)))
-                for _ in range(num_vaults)
-            ])
+            synthetic_hfs = np.maximum(min_hf, stats.lognorm.rvs(
+                s=sigma, scale=np.exp(mu), size=int(num_vaults)))
 
             # Calculate statistics
             mean_hf = np.mean(synthetic_hfs)
@@ -845,7 +870,8 @@ class ReportGenerator:
 
     def generate_summary_statistics(self):
         """Generate summary statistics for each scenario"""
-        summary_stats = self.df.groupby('scenario_name').agg({
+        df = self.store.read(columns=self.SUMMARY_STATISTICS_COLUMNS)
+        summary_stats = df.groupby('scenario_name').agg({
             'protocol_health_factor': ['mean', 'min', 'max'],
             'collateralization_ratio': ['mean', 'min', 'max'],
             'num_liquidated_vaults': ['max'],
@@ -857,7 +883,7 @@ class ReportGenerator:
 
         # Also save individual scenario statistics
         for scenario in self.scenarios:
-            scenario_stats = self.df[self.df['scenario_name'] == scenario].agg({
+            scenario_stats = df[df['scenario_name'] == scenario].agg({
                 'protocol_health_factor': ['mean', 'min', 'max'],
                 'collateralization_ratio': ['mean', 'min', 'max'],
                 'num_liquidated_vaults': ['max'],
@@ -872,6 +898,11 @@ class ReportGenerator:
         # Create a text file for this scenario
         output_file = self.output_dir / scenario / 'step_by_step_breakdown.txt'
 
+        # Classify the protocol status of every step in one call
+        scenario_df = scenario_df.assign(protocol_status=get_protocol_statuses(
+            scenario_df['protocol_health_factor'],
+            scenario_df['num_healthy_vaults'] + scenario_df['num_at_risk_vaults']))
+
         with open(output_file, 'w') as f:
             # Write scenario information
             f.write(f"{'='*100}\n")
@@ -893,6 +924,8 @@ class ReportGenerator:
                 f"Health Factor Mean: {initial_row['health_factor_mean']}\n")
             f.write(f"Health Factor Std: {initial_row['health_factor_std']}\n")
             f.write(f"Min Health Factor: {initial_row['min_health_factor']}\n")
+            # Results written before liquidation orders existed are fifo
+            f.write(f"Liquidation Order: {initial_row.get('liquidation_order', 'fifo')}\n")
             f.write(f"{'-'*100}\n\n")
 
             # Group by step to ensure we process each step only once
@@ -967,11 +1000,16 @@ class ReportGenerator:
         file.write(
             f"Protocol Health Factor: {metrics['protocol_health_factor']:.0f}\n")
 
-        # Calculate number of active vaults
-        active_vaults = metrics['num_healthy_vaults'] + \
-            metrics['num_at_risk_vaults']
-        file.write(
-            f"Status: {get_protocol_status(metrics['protocol_health_factor'], active_vaults)}\n")
+        # Use the precomputed status when available
+        if 'protocol_status' in metrics:
+            protocol_status = metrics['protocol_status']
+        else:
+            # Calculate number of active vaults
+            active_vaults = metrics['num_healthy_vaults'] + \
+                metrics['num_at_risk_vaults']
+            protocol_status = get_protocol_status(
+                metrics['protocol_health_factor'], active_vaults)
+        file.write(f"Status: {protocol_status}\n")
 
         file.write(
             f"Total Collateral Value: ${metrics['total_collateral_value']:,.2f}\n")
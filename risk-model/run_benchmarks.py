@@ -0,0 +1,275 @@
+from datetime import datetime
+from pathlib import Path
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+import warnings
+import numpy as np
+from models.engine import Engine
+from services.simulation import Simulation, MODEL_VERSION
+from services.results_writer import StreamingResultsWriter
+from report.report_generator import ReportGenerator
+from config.scenarios import generate_scenario_params
+from config.params import SIMULATION_PARAMS
+
+# Vault counts every benchmark runs at
+DEFAULT_SIZES = (5000, 50000, 500000)
+
+# Baseline the timings are compared against
+DEFAULT_BASELINE = 'results/benchmarks/baseline.json'
+
+# Relative slowdown (or memory growth) over the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.10
+
+# Scenario of the scenario grid the benchmarks simulate, with num_vaults
+# overridden. The report needs a name in the grid's format.
+BENCHMARK_SCENARIO = '50%_drop_1_day_medium_risk_medium_scale'
+BENCHMARK_SEED = 0
+
+
+def _new_simulation(params):
+    return Simulation(params, BENCHMARK_SCENARIO,
+                      rng=np.random.default_rng(BENCHMARK_SEED))
+
+
+def setup_create_vaults(params, workdir):
+    """Engine.create_vaults on a fresh engine"""
+    engine = Engine(params, np.random.default_rng(BENCHMARK_SEED))
+    return engine.create_vaults
+
+
+def setup_check_and_queue_liquidations(params, workdir):
+    """Engine.check_and_queue_liquidations at every block of the price drop"""
+    sim = _new_simulation(params)
+    sim.engine.create_vaults()
+
+    def sweep():
+        for price in sim.price_path:
+            sim.engine.set_price(price)
+            sim.engine.check_and_queue_liquidations()
+    return sweep
+
+
+def setup_calculate_protocol_metrics(params, workdir):
+    """Simulation.calculate_protocol_metrics at every block of the price drop"""
+    sim = _new_simulation(params)
+    sim.engine.create_vaults()
+
+    def sweep():
+        for price in sim.price_path:
+            sim.engine.set_price(price)
+            sim.calculate_protocol_metrics()
+    return sweep
+
+
+def setup_run_simulation(params, workdir):
+    """A full silent Simulation.run_simulation, vault creation included"""
+    sim = _new_simulation(params)
+    return lambda: sim.run_simulation(silent=True)
+
+
+def setup_generate_full_report(params, workdir):
+    """ReportGenerator.generate_full_report on the results of one simulation"""
+    results_path = workdir / f"simulation_results_{params['num_vaults']}.csv"
+    distributions_path = workdir / f"health_distributions_{params['num_vaults']}.csv"
+    # The results are simulated once per size and shared by the repeats
+    if not results_path.exists():
+        results_df, distribution_data = _new_simulation(params).run_simulation(silent=True)
+        for path, rows in ((results_path, results_df),
+                           (distributions_path, [distribution_data])):
+            writer = StreamingResultsWriter(path)
+            writer.write_rows(rows)
+            writer.close()
+    return lambda: ReportGenerator(results_path, distributions_path).generate_full_report()
+
+
+# Benchmarks in the order they run
+BENCHMARKS = {
+    'create_vaults': setup_create_vaults,
+    'check_and_queue_liquidations': setup_check_and_queue_liquidations,
+    'calculate_protocol_metrics': setup_calculate_protocol_metrics,
+    'run_simulation': setup_run_simulation,
+    'generate_full_report': setup_generate_full_report,
+}
+
+
+def run_benchmark(setup, params, workdir, repeats):
+    """
+    Time a benchmark and measure its peak memory
+
+    Every repeat gets a fresh setup, which is not timed. Peak memory is the
+    most memory allocated at once by the benchmark, as traced by tracemalloc
+    on one extra run (tracing slows allocations down, so it is not timed).
+
+    Returns:
+        dict: Timings in seconds and peak memory in bytes
+    """
+    times = []
+    for _ in range(repeats):
+        function = setup(params, workdir)
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    function = setup(params, workdir)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'repeats': repeats,
+        'times_s': times,
+        'median_s': statistics.median(times),
+        'min_s': min(times),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare benchmark results with a baseline run
+
+    Args:
+        results (dict): Results of run_benchmarks
+        baseline (dict): Results of an earlier run
+        tolerance (float): Relative slowdown or memory growth reported as a
+            regression
+
+    Returns:
+        list: One entry per benchmark present in both runs
+    """
+    baseline_entries = {(entry['name'], entry['num_vaults']): entry
+                        for entry in baseline['benchmarks']}
+    comparison = []
+    for entry in results['benchmarks']:
+        base = baseline_entries.get((entry['name'], entry['num_vaults']))
+        if base is None:
+            continue
+        # The fastest run is the least disturbed by other load on the machine
+        time_ratio = entry['min_s'] / base['min_s'] \
+            if base['min_s'] > 0 else float('inf')
+        memory_ratio = entry['peak_memory_bytes'] / base['peak_memory_bytes'] \
+            if base['peak_memory_bytes'] > 0 else 1.0
+        comparison.append({
+            'name': entry['name'],
+            'num_vaults': entry['num_vaults'],
+            'baseline_min_s': base['min_s'],
+            'min_s': entry['min_s'],
+            'time_ratio': time_ratio,
+            'baseline_peak_memory_bytes': base['peak_memory_bytes'],
+            'peak_memory_bytes': entry['peak_memory_bytes'],
+            'memory_ratio': memory_ratio,
+            'regression': time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance,
+        })
+    return comparison
+
+
+def print_comparison(comparison):
+    """Print a comparison table, marking regressions"""
+    print(f"\n{'Benchmark':<30} {'Vaults':>8} {'Baseline':>10} {'Now':>10} "
+          f"{'Time':>7} {'Memory':>7}")
+    for entry in comparison:
+        marker = '  REGRESSION' if entry['regression'] else ''
+        print(f"{entry['name']:<30} {entry['num_vaults']:>8} "
+              f"{entry['baseline_min_s']:>9.3f}s {entry['min_s']:>9.3f}s "
+              f"{entry['time_ratio']:>6.2f}x {entry['memory_ratio']:>6.2f}x{marker}")
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, names=None, repeats=5, output_path=None,
+                   baseline_path=DEFAULT_BASELINE, save_baseline=False,
+                   tolerance=DEFAULT_TOLERANCE):
+    """
+    Run the benchmark suite and compare it with the baseline
+
+    Args:
+        sizes (iterable): Vault counts to run every benchmark at
+        names (iterable, optional): Benchmarks to run, all of BENCHMARKS by default
+        repeats (int): Timed runs of each benchmark
+        output_path (str, optional): JSON results file, defaults to a
+            timestamped file in results/benchmarks/
+        baseline_path (str): Baseline results file to compare with
+        save_baseline (bool): Also store the results as the new baseline
+        tolerance (float): Relative slowdown or memory growth reported as a
+            regression
+
+    Returns:
+        tuple: (results, comparison) - comparison is None without a baseline
+    """
+    names = list(BENCHMARKS) if names is None else list(names)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_path = Path(output_path or f'results/benchmarks/bench_{timestamp}.json').resolve()
+    baseline_path = Path(baseline_path).resolve()
+
+    results = {
+        'timestamp': timestamp,
+        'model_version': MODEL_VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'benchmarks': [],
+    }
+
+    # The benchmarks run in a scratch directory, so the report's output and
+    # the simulated results it reads do not end up in results/
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        os.chdir(workdir)
+        try:
+            for num_vaults in sizes:
+                params = {**generate_scenario_params(SIMULATION_PARAMS)[BENCHMARK_SCENARIO],
+                          'num_vaults': num_vaults}
+                for name in names:
+                    print(f"Running {name} with {num_vaults} vaults...", end=' ', flush=True)
+                    # Progress output and warnings of the code under test
+                    # are not shown
+                    with contextlib.redirect_stdout(io.StringIO()), \
+                            warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        entry = run_benchmark(BENCHMARKS[name], params, workdir, repeats)
+                    print(f"{entry['median_s']:.3f}s, "
+                          f"peak {entry['peak_memory_bytes'] / 1024 / 1024:.1f} MB")
+                    results['benchmarks'].append(
+                        {'name': name, 'num_vaults': num_vaults, **entry})
+        finally:
+            os.chdir(cwd)
+
+    comparison = None
+    if baseline_path.exists():
+        with open(baseline_path) as file:
+            comparison = compare_with_baseline(results, json.load(file), tolerance)
+        results['baseline'] = str(baseline_path)
+        results['comparison'] = comparison
+        if comparison:
+            print_comparison(comparison)
+        else:
+            print(f"\nNo benchmarks in common with the baseline {baseline_path}")
+    else:
+        print(f"\nNo baseline found at {baseline_path}")
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"\nBenchmark results written to {output_path}")
+
+    if save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, 'w') as file:
+            json.dump({key: value for key, value in results.items()
+                       if key not in ('baseline', 'comparison')}, file, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+
+    return results, comparison
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -1,63 +1,340 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from pathlib import Path
+import json
 import os
+import zlib
+import numpy as np
 import pandas as pd
-from services.simulation import Simulation
+from services.simulation import Simulation, MODEL_VERSION
+from services.results_writer import StreamingResultsWriter, ParquetResultsWriter
+from services.memory import format_bytes, peak_rss_bytes, plan_batch_memory
+from models.vault_book import VaultBook, POPULATION_PARAMS
 from config.scenarios import generate_scenario_params
 from config.params import SIMULATION_PARAMS
+from profiler import Profiler
 
 
-def run_batch_simulations(scenarios, iterations_per_scenario=5):
+def get_seed_sequence(root_seed, stream_name, iteration):
+    """
+    Derive the RNG stream of one (scenario, iteration) from the root seed
+
+    The spawn key depends on the scenario name (or the population key, when
+    populations are shared) rather than its position, so a scenario gets the
+    same stream whichever other scenarios are in the batch.
+    """
+    stream_key = zlib.crc32(stream_name.encode('utf-8'))
+    return np.random.SeedSequence(root_seed, spawn_key=(stream_key, iteration))
+
+
+def get_population_key(scenario_params):
+    """
+    Identify the vault population a scenario draws
+
+    Scenarios that only differ in their price path (the same risk and scale
+    setup) get the same key and can share one population.
+    """
+    params = {**SIMULATION_PARAMS, **scenario_params}
+    return 'population:' + json.dumps(
+        {name: params.get(name) for name in POPULATION_PARAMS}, sort_keys=True)
+
+
+def run_simulation_task(task):
+    """
+    Run one (scenario, iteration) simulation - executed in worker processes
+
+    Returns:
+        tuple: (results, distribution_data, profile, memory) - profile is the
+            state of the task's Profiler, None unless the task asks for
+            profiling. memory holds the bytes of the simulation's data
+            structures and the peak RSS of the process that ran it.
+    """
+    scenario_name, scenario_params, iteration, seed_sequence, population, profile = task
+    profiler = Profiler(cprofile=profile['cprofile']) if profile is not None else None
+    if population is not None:
+        sim = Simulation(scenario_params, scenario_name, population=population,
+                         profiler=profiler)
+    else:
+        sim = Simulation(scenario_params, scenario_name,
+                         rng=np.random.default_rng(seed_sequence), profiler=profiler)
+    with sim.profiler.timer('run_simulation'), sim.profiler.profile_calls():
+        results, distribution_data = sim.run_simulation(iteration=iteration, silent=True)
+    memory = {**sim.memory_usage(), 'peak_rss': peak_rss_bytes()}
+    return (results, distribution_data, profiler.state() if profiler is not None else None,
+            memory)
+
+
+def _run_tasks(tasks, executor, window, prepare):
+    """
+    Run tasks in order, yielding their results
+
+    At most window tasks are submitted to the executor ahead of the result
+    being consumed, and prepare is only called on a task when it is
+    submitted, so the data passed to workers is created as it is needed.
+    """
+    if executor is None:
+        for task in tasks:
+            yield run_simulation_task(prepare(task))
+        return
+
+    futures = deque()
+    for task in tasks:
+        futures.append(executor.submit(run_simulation_task, prepare(task)))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def write_memory_report(path, memory_entries, memory_budget, workers):
+    """
+    Print the memory use of a batch and write it as JSON
+
+    Args:
+        path (Path): JSON file to write
+        memory_entries (list): memory of each simulation run, with its
+            scenario_name and iteration
+        memory_budget (int, optional): Budget of the batch in bytes
+        workers (int): Worker processes the batch ran with
+
+    Returns:
+        dict: The report
+    """
+    def structure_bytes(entry):
+        return sum(value for name, value in entry.items()
+                   if name not in ('scenario_name', 'iteration', 'peak_rss'))
+
+    largest = max(memory_entries, key=structure_bytes, default=None)
+    report = {
+        'memory_budget': memory_budget,
+        'workers': workers,
+        'peak_rss': peak_rss_bytes(),
+        # The largest of the worker processes, None for serial runs
+        'peak_rss_workers': peak_rss_bytes(children=True) if workers > 1 else None,
+        'largest_simulation': largest,
+        'simulations': memory_entries,
+    }
+
+    if report['peak_rss'] is not None:
+        peak = f"Peak RSS {format_bytes(report['peak_rss'])}"
+        if report['peak_rss_workers']:
+            peak += f" (largest worker {format_bytes(report['peak_rss_workers'])})"
+        print(peak)
+    if largest is not None:
+        print(f"Largest simulation ({largest['scenario_name']}, iteration {largest['iteration']}): " +
+              ', '.join(f"{name.replace('_', ' ')} {format_bytes(value)}"
+                        for name, value in largest.items()
+                        if name not in ('scenario_name', 'iteration', 'peak_rss')))
+
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Memory report saved to {path}")
+    return report
+
+
+def run_batch_simulations(scenarios, iterations_per_scenario=5, workers=1, seed=None,
+                          cache=None, keep_results=False, chunk_size=10000,
+                          results_format='csv', share_populations=True, profiler=None,
+                          memory_budget=None, population_store=None):
     """
     Run multiple scenarios with multiple iterations each
 
+    The memory use of every simulation and the peak RSS of the batch are
+    written next to the results as [results name].memory.json.
+
     Args:
         scenarios (dict): Dictionary of scenario names and their parameters
         iterations_per_scenario (int): Number of iterations to run for each scenario
+        workers (int): Number of worker processes, 0 for one per CPU core
+        seed (int): Root seed for the batch, random if omitted. Serial and
+            parallel runs with the same seed produce identical results.
+        cache (ResultCache, optional): Cache of previous results. Only used when
+            a seed is given, since unseeded runs are never repeated.
+        keep_results (bool): Also return all step results as a DataFrame. By
+            default they are only streamed to disk to keep memory bounded.
+        chunk_size (int): Number of step rows written to disk at a time
+        results_format (str): 'csv' for a single CSV file, or 'parquet' for a
+            directory with a scenario table and step rows partitioned by scenario
+        share_populations (bool): Generate each vault population once per
+            (risk, scale, iteration) and give every price scenario a
+            copy-on-write clone of it. Price scenarios are then compared on
+            common random numbers. When off, every scenario draws its own.
+        profiler (Profiler, optional): Collects the timers and counters of
+            every simulation run (cached results are not profiled)
+        memory_budget (int, optional): Bytes the batch may use, this process
+            and its workers together. Fewer workers are started and results
+            are flushed in smaller chunks to fit the estimated peak memory.
+        population_store (PopulationStore, optional): Store the shared
+            populations on disk and memory-map them instead of holding them
+            in memory. A population stored by an earlier run with the same
+            seed is reused. Ignored unless populations are shared.
 
     Returns:
-        tuple: (results_df, distributions_df, results_path)
+        tuple: (results_df, distributions_df, results_path) - results_df is
+            None unless keep_results is set
     """
-    all_results = []
+    all_results = [] if keep_results else None
     all_distributions = []
 
+    # Results are streamed to disk as each simulation finishes
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if results_format == 'parquet':
+        results_path = f'results/simulation_results_{timestamp}'
+        distributions_path = f'{results_path}/health_distributions.csv'
+    else:
+        results_path = f'results/simulation_results_{timestamp}.csv'
+        distributions_path = f'results/health_distributions_{timestamp}.csv'
+
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    max_pending_chunks = 4
+    if memory_budget is not None:
+        plan = plan_batch_memory(
+            memory_budget, [{**SIMULATION_PARAMS, **params} for params in scenarios.values()],
+            workers, chunk_size, max_pending_chunks)
+        workers, chunk_size = plan['workers'], plan['chunk_size']
+        print(f"Memory budget {format_bytes(memory_budget)}: about "
+              f"{format_bytes(plan['simulation_bytes'])} per simulation and "
+              f"{format_bytes(plan['process_bytes'])} per process, "
+              f"{chunk_size} rows per results chunk")
+        if not plan['fits']:
+            print("Warning: the largest simulation is estimated to exceed the memory "
+                  "budget even when run serially")
+
+    # A random root seed is reported so the batch can be reproduced
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        cache = None
+
     print(
         f"Running {len(scenarios)} scenarios with {iterations_per_scenario} iterations each")
+    print(f"Root seed: {seed} ({workers} worker{'s' if workers != 1 else ''})")
+
+    # Tasks are built, and their results merged, in a fixed order
+    population_keys = {
+        scenario_name: get_population_key(scenario_params) if share_populations else None
+        for scenario_name, scenario_params in scenarios.items()
+    }
+    profile = {'cprofile': profiler.cprofile} if profiler is not None else None
+    tasks = [
+        (scenario_name, scenario_params, i,
+         get_seed_sequence(seed, population_keys[scenario_name] or scenario_name, i),
+         None, profile)
+        for scenario_name, scenario_params in scenarios.items()
+        for i in range(iterations_per_scenario)
+    ]
+
+    # Look up cached results before dispatching any work
+    cache_keys = [None] * len(tasks)
+    cached_results = [None] * len(tasks)
+    if cache is not None:
+        for index, (scenario_name, scenario_params, i, _, _, _) in enumerate(tasks):
+            cache_keys[index] = cache.make_key(
+                {**SIMULATION_PARAMS, **scenario_params}, scenario_name, seed, i, MODEL_VERSION,
+                population_key=population_keys[scenario_name])
+            cached_results[index] = cache.get(cache_keys[index])
+    pending_tasks = [task for task, cached in zip(tasks, cached_results)
+                     if cached is None]
+    if cache is not None:
+        print(
+            f"Reusing {len(tasks) - len(pending_tasks)} cached simulations")
+
+    # Each shared population is generated when the first task that needs it
+    # is submitted, and dropped once the last one has been
+    populations = {}
+    population_uses = Counter((population_keys[scenario_name], i)
+                              for scenario_name, _, i, _, _, _ in pending_tasks)
+    if share_populations:
+        print(f"Sharing {len(population_uses)} vault populations across "
+              f"{len(pending_tasks)} simulations")
+    if population_store is not None:
+        store_counts = (population_store.hits, population_store.misses)
+
+    def attach_population(task):
+        if not share_populations:
+            return task
+        scenario_name, scenario_params, i, seed_sequence, _, profile = task
+        population_key = (population_keys[scenario_name], i)
+        if population_key not in populations:
+            params = {**SIMULATION_PARAMS, **scenario_params}
+            if population_store is not None:
+                # Workers receive the location of the files and map them themselves
+                populations[population_key] = population_store.get_or_generate(
+                    population_store.make_key(population_key[0], seed_sequence),
+                    params, seed_sequence)
+            else:
+                populations[population_key] = VaultBook.generate(
+                    params, np.random.default_rng(seed_sequence))
+        population = populations[population_key]
+        population_uses[population_key] -= 1
+        if population_uses[population_key] == 0:
+            del populations[population_key]
+        return (scenario_name, scenario_params, i, seed_sequence, population, profile)
 
-    for scenario_name, scenario_params in scenarios.items():
-        print(f"\nRunning scenario: {scenario_name}")
+    executor = ProcessPoolExecutor(max_workers=workers) \
+        if workers > 1 and len(pending_tasks) > 1 else None
+    writer_class = ParquetResultsWriter if results_format == 'parquet' \
+        else StreamingResultsWriter
+    results_writer = writer_class(results_path, chunk_size=chunk_size,
+                                  max_pending_chunks=max_pending_chunks)
+    distributions_writer = StreamingResultsWriter(
+        distributions_path, chunk_size=chunk_size, max_pending_chunks=max_pending_chunks)
+    memory_entries = []
+    try:
+        # Two tasks per worker keep the workers busy while bounding the
+        # populations and results in flight
+        computed_results = _run_tasks(pending_tasks, executor, 2 * workers, attach_population)
 
-        for i in range(iterations_per_scenario):
-            sim = Simulation(scenario_params, scenario_name)
-            results, distribution_data = sim.run_simulation(
-                iteration=i, silent=True)
+        for index, (scenario_name, _, i, _, _, _) in enumerate(tasks):
+            if i == 0:
+                print(f"\nRunning scenario: {scenario_name}")
 
-            all_results.extend(results)
+            if cached_results[index] is not None:
+                results, distribution_data = cached_results[index]
+            else:
+                results, distribution_data, profile_state, memory = next(computed_results)
+                if profile_state is not None:
+                    profiler.merge(profile_state)
+                memory_entries.append(
+                    {'scenario_name': scenario_name, 'iteration': i, **memory})
+                if cache is not None:
+                    cache.put(cache_keys[index],
+                              (results, distribution_data))
+
+            results_writer.write_rows(results)
+            distributions_writer.write_rows([distribution_data])
+            if keep_results:
+                all_results.append(results)
             all_distributions.append(distribution_data)
 
             # Print progress
             print(
                 f"  Completed iteration {i+1}/{iterations_per_scenario}", end="\r")
 
-        print(f"  Completed all iterations for {scenario_name}           ")
+            if i == iterations_per_scenario - 1:
+                print(
+                    f"  Completed all iterations for {scenario_name}           ")
+    finally:
+        if executor:
+            executor.shutdown()
+        results_writer.close()
+        distributions_writer.close()
 
-    # Convert results to DataFrames
-    results_df = pd.DataFrame(all_results)
+    results_df = pd.concat(all_results, ignore_index=True) \
+        if keep_results and all_results else None
     distributions_df = pd.DataFrame(all_distributions)
 
-    # Save results
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    results_path = f'results/simulation_results_{timestamp}.csv'
-    distributions_path = f'results/health_distributions_{timestamp}.csv'
-
-    # Create directory if it doesn't exist
-    os.makedirs('results', exist_ok=True)
-
-    # Save to CSV
-    results_df.to_csv(results_path, index=False)
-    distributions_df.to_csv(distributions_path, index=False)
-
-    print(f"\nResults saved to {results_path}")
+    print(
+        f"\nResults saved to {results_path} ({results_writer.rows_written} rows)")
     print(f"Health factor distributions saved to {distributions_path}")
+    if share_populations and population_store is not None:
+        print(f"Vault populations in {population_store.store_dir}: "
+              f"{population_store.hits - store_counts[0]} reused, "
+              f"{population_store.misses - store_counts[1]} generated")
+    write_memory_report(Path(f"{Path(results_path).with_suffix('')}.memory.json"),
+                        memory_entries, memory_budget, workers if executor else 1)
 
     return results_df, distributions_df, results_path
 
@@ -79,7 +356,7 @@ def main():
 
     # Run all scenarios
     results_df, distributions_df, results_path = run_batch_simulations(
-        scenarios, iterations_per_scenario=1)
+        scenarios, iterations_per_scenario=1, keep_results=True)
 
     print("\nSimulation batch complete!")
     print(f"Total scenarios run: {len(scenarios)}")
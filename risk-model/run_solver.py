@@ -0,0 +1,203 @@
+from datetime import datetime
+from pathlib import Path
+import contextlib
+import io
+import json
+import math
+import numpy as np
+from models.vault_book import VaultBook
+from services.simulation import Simulation, MODEL_VERSION
+from config.params import SIMULATION_PARAMS
+
+# Parameters the solver can search, with their default search range, the
+# resolution at which the search stops and whether the values are integers.
+# Raising any of them makes the protocol safer, so the solver looks for the
+# smallest value at which the outcome is met. Ranges are fractions of the
+# start price for end_price.
+SOLVER_PARAMETERS = {
+    'end_price': {'low': 0.01, 'high': 1.0, 'tolerance': 0.001, 'integer': False},
+    'txs_per_block': {'low': 1, 'high': 500, 'tolerance': 1, 'integer': True},
+    'reserve_fund_percentage_of_debt': {'low': 0.0, 'high': 1.0, 'tolerance': 0.001,
+                                        'integer': False},
+}
+
+# Outcomes a run can be required to meet, see probe_outcome
+SOLVER_OUTCOMES = {
+    'reserve_fund_depleted': 'the reserve fund is never depleted',
+    'insolvent_vaults': 'no insolvent vaults are left at the end of the run',
+    'protocol_health_factor': 'the final protocol health factor is at least the threshold',
+}
+
+DEFAULT_THRESHOLD = 100
+SOLVER_SEED = 0
+
+
+def probe_outcome(sim, results, outcome, threshold=DEFAULT_THRESHOLD):
+    """
+    Whether a finished run met an outcome
+
+    Args:
+        sim (Simulation): The simulation that ran
+        results (pd.DataFrame): Its step results
+        outcome (str): One of SOLVER_OUTCOMES
+        threshold (float): Minimum final protocol health factor, for the
+            protocol_health_factor outcome
+
+    Returns:
+        tuple: (met, value) - value is the metric the outcome was decided on
+    """
+    final_state = results.iloc[-1]
+    if outcome == 'reserve_fund_depleted':
+        depleted = bool(sim.engine.reserve_fund_depleted)
+        return not depleted, depleted
+    if outcome == 'insolvent_vaults':
+        num_insolvent = int(final_state['num_insolvent_vaults'])
+        return num_insolvent == 0, num_insolvent
+    health_factor = float(final_state['protocol_health_factor'])
+    return health_factor >= threshold, health_factor
+
+
+def solve_critical_value(parameter, outcome, params=None, population=None, low=None,
+                         high=None, tolerance=None, threshold=DEFAULT_THRESHOLD,
+                         seed=SOLVER_SEED, max_probes=50):
+    """
+    Find the smallest value of a parameter at which runs meet an outcome
+
+    Bisects between low and high, assuming the outcome is met above some
+    critical value and missed below it. Every probe is a silent simulation of
+    the same vault population, so probes only differ in the parameter and
+    each costs a copy-on-write clone instead of new sampling. The search
+    stops as soon as the outcome is decided: right after the first two probes
+    when it is met (or missed) over the whole range, and otherwise once the
+    bracket is narrower than the tolerance.
+
+    Args:
+        parameter (str): One of SOLVER_PARAMETERS
+        outcome (str): One of SOLVER_OUTCOMES
+        params (dict, optional): Overrides of the simulation parameters
+        population (VaultBook, optional): Population to run the probes on,
+            sampled from params with the seed by default
+        low (float, optional): Lower end of the search range
+        high (float, optional): Upper end of the search range
+        tolerance (float, optional): Bracket width at which the search stops
+        threshold (float): Minimum final protocol health factor, for the
+            protocol_health_factor outcome
+        seed (int): Seed of the sampled population
+        max_probes (int): Maximum number of simulations
+
+    Returns:
+        dict: The critical value (None when the outcome is met nowhere in the
+            range), whether the whole range meets the outcome, and every probe
+    """
+    if parameter not in SOLVER_PARAMETERS:
+        raise ValueError(
+            f"Unknown parameter {parameter!r}, expected one of {', '.join(SOLVER_PARAMETERS)}")
+    if outcome not in SOLVER_OUTCOMES:
+        raise ValueError(
+            f"Unknown outcome {outcome!r}, expected one of {', '.join(SOLVER_OUTCOMES)}")
+
+    params = {**SIMULATION_PARAMS, **(params or {})}
+    search = SOLVER_PARAMETERS[parameter]
+    scale = params['start_price'] if parameter == 'end_price' else 1
+    low = search['low'] * scale if low is None else low
+    high = search['high'] * scale if high is None else high
+    tolerance = search['tolerance'] * scale if tolerance is None else tolerance
+    if search['integer']:
+        low, high = math.floor(low), math.ceil(high)
+    if low > high:
+        raise ValueError(f"Empty search range: low {low} is above high {high}")
+    if population is None:
+        population = VaultBook.generate(params, np.random.default_rng(seed))
+
+    probes = []
+
+    def probe(value):
+        value = int(value) if search['integer'] else float(value)
+        sim = Simulation({**params, parameter: value}, f'solve_{parameter}',
+                         population=population)
+        # Probes only report their outcome
+        with contextlib.redirect_stdout(io.StringIO()):
+            results, _ = sim.run_simulation(silent=True)
+        met, metric = probe_outcome(sim, results, outcome, threshold)
+        probes.append({'value': value, 'met': met, 'metric': metric,
+                       'steps': int(results['step'].iloc[-1])})
+        print(f"  {parameter} = {value:g}: {'met' if met else 'missed'} ({outcome}: {metric})")
+        return met
+
+    # The outcome is decided without bisecting when it holds over the whole
+    # range, or nowhere in it
+    met_at_low = probe(low)
+    met_at_high = met_at_low or probe(high)
+    result = {
+        'parameter': parameter,
+        'outcome': outcome,
+        'condition': SOLVER_OUTCOMES[outcome],
+        'threshold': threshold if outcome == 'protocol_health_factor' else None,
+        'low': low,
+        'high': high,
+        'tolerance': tolerance,
+        'model_version': MODEL_VERSION,
+        'probes': probes,
+    }
+    if met_at_low or not met_at_high:
+        return {**result, 'value': low if met_at_low else None, 'met_everywhere': met_at_low}
+
+    # Invariant: the outcome is missed at low and met at high
+    while high - low > tolerance and len(probes) < max_probes:
+        middle = (low + high) // 2 if search['integer'] else (low + high) / 2
+        if middle in (low, high):
+            break
+        if probe(middle):
+            high = middle
+        else:
+            low = middle
+    return {**result, 'value': high, 'met_everywhere': False, 'missed_below': low}
+
+
+def describe_solution(result, start_price):
+    """One line stating what the solver found"""
+    parameter = result['parameter']
+    condition = result['condition']
+    if result['value'] is None:
+        return (f"Missed over the whole range {parameter} = {result['low']:g} to "
+                f"{result['high']:g} ({condition})")
+    if result['met_everywhere']:
+        return f"Met over the whole range from {parameter} = {result['low']:g} ({condition})"
+    if parameter == 'end_price':
+        drop = (1 - result['value'] / start_price) * 100
+        return (f"Largest survivable drop: {drop:.2f}% to end_price {result['value']:g} "
+                f"({condition})")
+    return f"Smallest {parameter} meeting the outcome: {result['value']:g} ({condition})"
+
+
+def run_solver(parameter, outcome, params=None, population=None, output_path=None, **options):
+    """
+    Run the solver, print its result and write it as JSON
+
+    Args:
+        parameter (str): One of SOLVER_PARAMETERS
+        outcome (str): One of SOLVER_OUTCOMES
+        params (dict, optional): Overrides of the simulation parameters
+        population (VaultBook, optional): Population to run the probes on
+        output_path (str, optional): JSON file for the result, timestamped in
+            results/solver/ by default
+        **options: Further arguments of solve_critical_value
+
+    Returns:
+        dict: The result of solve_critical_value
+    """
+    start_price = {**SIMULATION_PARAMS, **(params or {})}['start_price']
+    print(f"Solving for {parameter}: {SOLVER_OUTCOMES[outcome]}")
+    result = solve_critical_value(parameter, outcome, params, population, **options)
+    print(f"\n{describe_solution(result, start_price)} "
+          f"({len(result['probes'])} simulations)")
+
+    if output_path is None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_path = f'results/solver/solve_{parameter}_{timestamp}.json'
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as file:
+        json.dump(result, file, indent=2)
+    print(f"Solver result saved to {output_path}")
+    return result
@@ -1,3 +1,9 @@
-from .simulation import Simulation
+from .simulation import Simulation, MODEL_VERSION
+from .step_records import StepRecordBuffer
+from .result_cache import ResultCache
+from .population_store import PopulationStore
+from .results_writer import StreamingResultsWriter, ParquetResultsWriter
+from .results_store import CsvResultsStore, ParquetResultsStore, open_results_store
 
-__all__ = ['Simulation']
+__all__ = ['Simulation', 'MODEL_VERSION', 'StepRecordBuffer', 'ResultCache', 'PopulationStore', 'StreamingResultsWriter', 'ParquetResultsWriter',
+           'CsvResultsStore', 'ParquetResultsStore', 'open_results_store']
@@ -0,0 +1,117 @@
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Peak memory of a simulation per vault and per recorded step, measured with
+# tracemalloc on the fast path (the step engine needs about two thirds of it).
+# The step part covers the step record buffer and the results DataFrame.
+ESTIMATED_BYTES_PER_VAULT = 300
+ESTIMATED_BYTES_PER_STEP = 600
+
+# Memory of one buffered result row in the results writers
+ESTIMATED_BYTES_PER_RESULT_ROW = 300
+
+# Share of a memory budget given to buffered result rows
+RESULT_BUFFER_SHARE = 0.1
+
+
+def format_bytes(num_bytes):
+    """Human readable size, e.g. '12.3 MB'"""
+    return f"{num_bytes / 1024 / 1024:.1f} MB"
+
+
+def peak_rss_bytes(children=False):
+    """
+    Peak resident set size of this process, or of its finished and waited-for
+    child processes (the largest of them)
+
+    Returns:
+        int: Bytes, None where the platform does not report it
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def current_rss_bytes():
+    """Current resident set size of this process, the peak where unavailable"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_bytes()
+
+
+def estimate_simulation_memory(params):
+    """
+    Estimated peak memory of one simulation on top of the process itself
+
+    Args:
+        params (dict): Merged simulation parameters
+
+    Returns:
+        int: Bytes
+    """
+    # Same step limits as Simulation._max_recorded_steps
+    blocks = int(params['price_drop_duration'] * 60 / params['block_time'])
+    recovery_blocks = int(params.get('recovery_duration', params['price_drop_duration'])
+                          * 60 / params['block_time'])
+    max_steps = min(blocks + recovery_blocks, params.get('max_simulation_steps', 1000)) + 1
+    return (params['num_vaults'] * ESTIMATED_BYTES_PER_VAULT +
+            max_steps * ESTIMATED_BYTES_PER_STEP)
+
+
+def plan_batch_memory(memory_budget, scenario_params, workers, chunk_size,
+                      max_pending_chunks):
+    """
+    Fit a batch of simulations into a memory budget
+
+    Every worker process is assumed to start at this process's current size
+    (workers import the same modules) and to need the estimated memory of the
+    largest simulation on top. Workers are removed until the estimate fits,
+    and the results writers buffer fewer rows before flushing.
+
+    Args:
+        memory_budget (int): Budget in bytes for this process and its workers
+        scenario_params (list): Merged parameters of the simulations to run
+        workers (int): Requested number of worker processes
+        chunk_size (int): Requested rows per written chunk
+        max_pending_chunks (int): Chunks the writers may buffer
+
+    Returns:
+        dict: workers, chunk_size and the estimates the plan is based on.
+            fits is False when even a serial run is estimated to exceed the
+            budget.
+    """
+    process_bytes = current_rss_bytes() or 0
+    simulation_bytes = max((estimate_simulation_memory(params) for params in scenario_params),
+                           default=0)
+
+    # Result rows buffered by the writers get a fixed share of the budget
+    buffer_rows = int(memory_budget * RESULT_BUFFER_SHARE /
+                      ESTIMATED_BYTES_PER_RESULT_ROW / (max_pending_chunks + 1))
+    chunk_size = max(1000, min(chunk_size, buffer_rows))
+    buffer_bytes = chunk_size * (max_pending_chunks + 1) * ESTIMATED_BYTES_PER_RESULT_ROW
+
+    available = memory_budget - process_bytes - buffer_bytes
+    planned_workers = 1
+    for candidate in range(workers, 1, -1):
+        if candidate * (process_bytes + simulation_bytes) <= available:
+            planned_workers = candidate
+            break
+
+    return {
+        'workers': planned_workers,
+        'chunk_size': chunk_size,
+        'process_bytes': process_bytes,
+        'simulation_bytes': simulation_bytes,
+        'buffer_bytes': buffer_bytes,
+        'fits': simulation_bytes <= available,
+    }
@@ -0,0 +1,162 @@
+from pathlib import Path
+import hashlib
+import json
+import shutil
+import tempfile
+import numpy as np
+from models.vault_book import (VaultBook, POPULATION_ARRAYS, POPULATION_PARAMS,
+                               POPULATION_INDEX_THRESHOLDS, sample_collateral,
+                               sample_initial_health_factors, initial_debt)
+
+
+class PopulationStore:
+    """
+    On-disk store of generated vault populations.
+
+    Each population is written once as .npy files of its collateral, debt and
+    initial health factor arrays, keyed by the parameters that define it and
+    the seed it was drawn from, and memory-mapped read only by every
+    simulation that uses it. Simulations keep their liquidations in a
+    copy-on-write overlay (see VaultBook.clone), so any number of them, in
+    any number of processes, share one mapping. Populations are generated
+    in chunks and never have to fit in memory as a whole.
+
+    The threshold price indexes of POPULATION_INDEX_THRESHOLDS are stored
+    with the population and memory-mapped as well, so runs do not sort the
+    vaults again. Sorting them needs the population's threshold prices in
+    memory once, when the population is written.
+    """
+
+    def __init__(self, store_dir='results/populations', chunk_size=1_000_000):
+        """
+        Initialize the store
+
+        Args:
+            store_dir (str): Directory holding one subdirectory per population
+            chunk_size (int): Number of vaults sampled at a time when a
+                population is generated
+        """
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(population_key, seed_sequence):
+        """
+        Stable hash identifying one population
+
+        Args:
+            population_key (str): Key of the population parameters, see
+                run_scenarios.get_population_key
+            seed_sequence (np.random.SeedSequence): Seed the population is drawn from
+        """
+        key_fields = {
+            'population_key': population_key,
+            'entropy': seed_sequence.entropy,
+            'spawn_key': list(seed_sequence.spawn_key),
+        }
+        payload = json.dumps(key_fields, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.store_dir / key
+
+    def load(self, key):
+        """Memory-map a stored population, or return None if it is not stored"""
+        try:
+            population = VaultBook.load(self._path(key))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not set(POPULATION_INDEX_THRESHOLDS) <= population.price_index_thresholds():
+            # Stored before its price indexes were
+            self._add_price_indexes(self._path(key), population)
+            population = VaultBook.load(self._path(key))
+        return population
+
+    def _add_price_indexes(self, path, population):
+        """Store the price indexes of a population stored without them"""
+        tmp_path = Path(tempfile.mkdtemp(dir=self.store_dir, suffix='.tmp'))
+        try:
+            population.save_price_indexes(tmp_path)
+            # VaultBook.load finds an index by its prices file, so that moves last
+            for file in sorted(tmp_path.iterdir(), key=lambda file: file.name.endswith(
+                    '_prices.npy')):
+                file.replace(path / file.name)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def get_or_generate(self, key, params, seed_sequence):
+        """
+        Memory-map a stored population, generating and storing it first if needed
+
+        The population is identical to VaultBook.generate(params,
+        np.random.default_rng(seed_sequence)).
+
+        Args:
+            key (str): Key of the population, see make_key
+            params (dict): Fully merged simulation parameters
+            seed_sequence (np.random.SeedSequence): Seed to draw the population from
+
+        Returns:
+            VaultBook: The memory-mapped population
+        """
+        population = self.load(key)
+        if population is not None:
+            return population
+
+        # Write to a temporary directory first so readers never see partial
+        # populations
+        tmp_path = Path(tempfile.mkdtemp(dir=self.store_dir, suffix='.tmp'))
+        try:
+            self._write(tmp_path, params, np.random.default_rng(seed_sequence))
+            tmp_path.rename(self._path(key))
+        except OSError:
+            # Another process stored the population first
+            if not self._path(key).is_dir():
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return VaultBook.load(self._path(key))
+
+    def _write(self, path, params, rng):
+        """Sample a population chunk by chunk into .npy files"""
+        num_vaults = params['num_vaults']
+        arrays = {name: np.lib.format.open_memmap(
+            path / f'{name}.npy', mode='w+', dtype=np.float64, shape=(num_vaults,))
+            for name in POPULATION_ARRAYS}
+        chunks = [slice(start, min(start + self.chunk_size, num_vaults))
+                  for start in range(0, num_vaults, self.chunk_size)]
+
+        # Same draws as VaultBook.generate: every collateral amount, then
+        # every health factor. Chunked draws continue the generator's stream,
+        # so they match a single draw of the whole population.
+        for chunk in chunks:
+            arrays['collateral'][chunk] = sample_collateral(
+                params, rng, chunk.stop - chunk.start)
+        for chunk in chunks:
+            arrays['initial_health_factor'][chunk] = sample_initial_health_factors(
+                params, rng, chunk.stop - chunk.start)
+        for chunk in chunks:
+            arrays['debt'][chunk] = initial_debt(
+                params, arrays['collateral'][chunk], arrays['initial_health_factor'][chunk])
+
+        for array in arrays.values():
+            array.flush()
+        VaultBook.wrap(*(arrays[name] for name in POPULATION_ARRAYS)).save_price_indexes(path)
+        # Describes the population for whoever browses the store
+        with open(path / 'population.json', 'w') as f:
+            json.dump({name: params.get(name) for name in POPULATION_PARAMS}, f, indent=2)
+
+    def nbytes(self):
+        """Bytes of all stored populations on disk"""
+        return sum(path.stat().st_size for path in self.store_dir.glob('*/*.npy'))
+
+    def clear(self):
+        """Remove every stored population"""
+        for path in self.store_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
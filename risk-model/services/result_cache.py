@@ -0,0 +1,100 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of simulation results.
+
+    Entries are keyed by a stable hash of everything that determines a
+    simulation's output: the fully merged parameters, the scenario name, the
+    root seed, the iteration, the model version and, for shared vault
+    populations, the population the simulation drew from. Least recently used
+    entries are evicted once the configured size or entry limits are exceeded.
+    """
+
+    def __init__(self, cache_dir='results/cache', max_bytes=None, max_entries=None):
+        """
+        Initialize the cache
+
+        Args:
+            cache_dir (str): Directory holding the cache entries
+            max_bytes (int, optional): Maximum total size of the cache
+            max_entries (int, optional): Maximum number of cached results
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(params, scenario_name, seed, iteration, model_version, population_key=None):
+        """Stable hash identifying one simulation run"""
+        key_fields = {
+            'params': params,
+            'scenario_name': scenario_name,
+            'seed': seed,
+            'iteration': iteration,
+            'model_version': model_version,
+        }
+        if population_key is not None:
+            key_fields['population_key'] = population_key
+        payload = json.dumps(key_fields, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f'{key}.pkl'
+
+    def get(self, key):
+        """Return the cached value for a key, or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store a value and evict old entries if the cache grew too large"""
+        # Write to a temporary file first so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the limits are respected"""
+        if self.max_bytes is None and self.max_entries is None:
+            return
+
+        entries = []
+        for path in self.cache_dir.glob('*.pkl'):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (
+                (self.max_bytes is not None and total_bytes > self.max_bytes) or
+                (self.max_entries is not None and len(entries) > self.max_entries)):
+            _, size, path = entries.pop(0)
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+
+    def clear(self):
+        """Remove every cached entry"""
+        for path in self.cache_dir.glob('*.pkl'):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,159 @@
+from pathlib import Path
+import pandas as pd
+from .results_writer import SCENARIO_COLUMNS, get_scenario_partition_dir, pq
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# Rows parsed at a time when only some scenarios of a CSV file are kept
+CSV_FILTER_CHUNK_ROWS = 100_000
+
+
+class CsvResultsStore:
+    """Read step results from a single CSV file"""
+
+    def __init__(self, path, scenario_filter=None):
+        """
+        Args:
+            path (str): Results CSV file
+            scenario_filter (callable, optional): Keeps the scenarios whose
+                name it returns True for, all by default
+        """
+        self.path = Path(path)
+        # The text format has to be parsed in full, so it is read only once
+        if scenario_filter is None:
+            self.df = pd.read_csv(self.path)
+        else:
+            # Drop the rows of other scenarios chunk by chunk
+            chunks = []
+            for chunk in pd.read_csv(self.path, chunksize=CSV_FILTER_CHUNK_ROWS):
+                names = chunk['scenario_name'].unique()
+                kept = [name for name in names if scenario_filter(name)]
+                chunks.append(chunk[chunk['scenario_name'].isin(kept)])
+            self.df = pd.concat(chunks, ignore_index=True) if chunks \
+                else pd.read_csv(self.path, nrows=0)
+
+    def scenario_names(self):
+        """Scenario names in the order they were run"""
+        return list(self.df['scenario_name'].unique())
+
+    def read(self, columns=None, scenario=None):
+        """
+        Read step rows
+
+        Args:
+            columns (list, optional): Columns to read, all if omitted
+            scenario (str, optional): Only read the rows of this scenario
+
+        Returns:
+            pd.DataFrame: The selected rows and columns
+        """
+        df = self.df
+        if scenario is not None:
+            df = df[df['scenario_name'] == scenario]
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def read_distributions(self):
+        """Health factor distributions stored next to the results, if any"""
+        # Try to infer distributions path from results path
+        potential_dist_path = self.path.parent / \
+            f"health_distributions_{self.path.name.split('_')[-1]}"
+        if potential_dist_path.exists():
+            return pd.read_csv(potential_dist_path), potential_dist_path
+        return None, None
+
+
+class ParquetResultsStore:
+    """
+    Read step results from a Parquet dataset written by ParquetResultsWriter.
+
+    Only the requested scenario partitions and columns are read, with the
+    files memory-mapped. Scenario constants are joined in from the
+    scenarios dimension table when they are requested.
+    """
+
+    def __init__(self, path, scenario_filter=None):
+        """
+        Args:
+            path (str): Results directory
+            scenario_filter (callable, optional): Keeps the scenarios whose
+                name it returns True for, all by default. The partitions of
+                the others are never read.
+        """
+        if pq is None:
+            raise ImportError(
+                "Reading Parquet results requires pyarrow: pip install pyarrow")
+        self.path = Path(path)
+        self.scenarios_df = pq.read_table(
+            self.path / 'scenarios.parquet', memory_map=True).to_pandas()
+        if scenario_filter is not None:
+            self.scenarios_df = self.scenarios_df[
+                self.scenarios_df['scenario_name'].map(scenario_filter).astype(bool)
+            ].reset_index(drop=True)
+
+    def scenario_names(self):
+        """Scenario names in the order they were run"""
+        return list(self.scenarios_df['scenario_name'])
+
+    def _read_steps(self, scenario, columns):
+        part_files = sorted(get_scenario_partition_dir(
+            self.path, scenario).glob('part-*.parquet'))
+        tables = [pq.read_table(part_file, columns=columns, memory_map=True)
+                  for part_file in part_files]
+        steps_df = pa.concat_tables(tables).to_pandas()
+        if 'simulation_phase' in steps_df.columns:
+            steps_df['simulation_phase'] = steps_df['simulation_phase'].astype(
+                str)
+        steps_df.insert(0, 'scenario_name', scenario)
+        return steps_df
+
+    def read(self, columns=None, scenario=None):
+        """
+        Read step rows
+
+        Args:
+            columns (list, optional): Columns to read, all if omitted
+            scenario (str, optional): Only read the rows of this scenario
+
+        Returns:
+            pd.DataFrame: The selected rows and columns
+        """
+        scenarios = self.scenario_names() if scenario is None else [scenario]
+
+        if columns is None:
+            step_columns = None
+            scenario_columns = [
+                column for column in self.scenarios_df.columns if column != 'scenario_name']
+        else:
+            step_columns = [column for column in columns
+                            if column not in SCENARIO_COLUMNS and column != 'scenario_name']
+            scenario_columns = [
+                column for column in columns if column in SCENARIO_COLUMNS]
+
+        df = pd.concat([self._read_steps(name, step_columns) for name in scenarios],
+                       ignore_index=True)
+        if scenario_columns:
+            df = df.merge(self.scenarios_df[['scenario_name'] + scenario_columns],
+                          on='scenario_name', how='left')
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def read_distributions(self):
+        """Health factor distributions written with the dataset"""
+        distributions_path = self.path / 'health_distributions.csv'
+        if distributions_path.exists():
+            return pd.read_csv(distributions_path), distributions_path
+        return None, None
+
+
+def open_results_store(path, scenario_filter=None):
+    """Open a results file (CSV) or results directory (Parquet)"""
+    if Path(path).is_dir():
+        return ParquetResultsStore(path, scenario_filter)
+    return CsvResultsStore(path, scenario_filter)
@@ -0,0 +1,227 @@
+from pathlib import Path
+from urllib.parse import quote
+import queue
+import threading
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Step-result columns that are constant for a scenario. The Parquet format
+# stores them once per scenario in a separate dimension table.
+SCENARIO_COLUMNS = [
+    'scenario_description',
+    'num_vaults',
+    'price_drop_duration',
+    'collateralisation_ratio',
+    'health_factor_mean',
+    'health_factor_std',
+    'min_health_factor',
+    'liquidation_order',
+]
+
+# Step-result columns stored as integers, every other numeric column is float64
+STEP_INTEGER_COLUMNS = [
+    'iteration',
+    'path',
+    'step',
+    'num_healthy_vaults',
+    'num_at_risk_vaults',
+    'num_liquidatable_vaults',
+    'num_liquidated_vaults',
+    'num_insolvent_vaults',
+    'liquidation_queue_size',
+]
+
+
+def get_scenario_partition_dir(results_dir, scenario_name):
+    """Directory holding the step rows of one scenario in a Parquet results dataset"""
+    return Path(results_dir) / 'steps' / f"scenario_name={quote(scenario_name, safe='')}"
+
+
+class StreamingResultsWriter:
+    """
+    Append result rows to a CSV file from a background thread.
+
+    Rows, given as DataFrames or lists of dicts, are grouped into chunks and
+    handed to a writer thread through a bounded queue, so serializing one
+    simulation's results overlaps with running the next one while memory
+    stays bounded by the queue size.
+    Everything written so far stays on disk if the batch crashes.
+    """
+
+    def __init__(self, path, chunk_size=10000, max_pending_chunks=4):
+        """
+        Open the writer
+
+        Args:
+            path (str): Output path
+            chunk_size (int): Number of rows serialized at a time
+            max_pending_chunks (int): Chunks that may wait for the writer thread
+                before write_rows blocks
+        """
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+
+        self._buffer = []
+        self._buffered_rows = 0
+        self._error = None
+        self._open()
+        self._queue = queue.Queue(maxsize=max_pending_chunks)
+        self._thread = threading.Thread(target=self._write_chunks, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._columns = None
+        self._file = open(self.path, 'w', newline='')
+
+    def _write_chunk(self, chunk_df):
+        if self._columns is None:
+            self._columns = list(chunk_df.columns)
+            chunk_df.to_csv(self._file, index=False)
+        else:
+            chunk_df.reindex(columns=self._columns).to_csv(
+                self._file, index=False, header=False)
+        self._file.flush()
+
+    def _finish(self):
+        self._file.close()
+
+    def _write_chunks(self):
+        """Writer thread: serialize queued chunks until the end marker"""
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self._write_chunk(chunk)
+                self.rows_written += len(chunk)
+            except Exception as e:
+                self._error = e
+
+        try:
+            self._finish()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(
+                f"Writing results to {self.path} failed") from self._error
+
+    def write_rows(self, rows):
+        """
+        Queue rows for writing, blocking while the writer is behind
+
+        Args:
+            rows (pd.DataFrame or list): Rows as a DataFrame or a list of dicts
+        """
+        self._raise_error()
+        if not isinstance(rows, pd.DataFrame):
+            rows = pd.DataFrame(rows)
+        if len(rows) == 0:
+            return
+        self._buffer.append(rows)
+        self._buffered_rows += len(rows)
+        if self._buffered_rows < self.chunk_size:
+            return
+
+        buffered = self._take_buffer()
+        start = 0
+        while len(buffered) - start >= self.chunk_size:
+            self._queue.put(buffered.iloc[start:start + self.chunk_size])
+            start += self.chunk_size
+        if start < len(buffered):
+            self._buffer.append(buffered.iloc[start:])
+            self._buffered_rows = len(buffered) - start
+
+    def _take_buffer(self):
+        buffered = self._buffer[0] if len(self._buffer) == 1 \
+            else pd.concat(self._buffer, ignore_index=True)
+        self._buffer = []
+        self._buffered_rows = 0
+        return buffered
+
+    def flush(self):
+        """Queue any buffered rows"""
+        if self._buffer:
+            self._queue.put(self._take_buffer())
+
+    def close(self):
+        """Write the remaining rows and wait for the writer thread"""
+        if self._thread.is_alive():
+            self.flush()
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
+class ParquetResultsWriter(StreamingResultsWriter):
+    """
+    Stream step results into a Parquet dataset partitioned by scenario.
+
+    Layout of the output directory:
+        scenarios.parquet            one row of SCENARIO_COLUMNS per scenario
+        steps/scenario_name=<name>/  typed step rows of that scenario (the name
+                                     is URL-quoted)
+
+    Requires pyarrow.
+    """
+
+    def _open(self):
+        if pq is None:
+            raise ImportError(
+                "The Parquet results format requires pyarrow: pip install pyarrow")
+        (self.path / 'steps').mkdir(parents=True, exist_ok=True)
+        self._scenarios = {}
+        self._part_numbers = {}
+
+    def _write_chunk(self, chunk_df):
+        for scenario_name, scenario_df in chunk_df.groupby('scenario_name', sort=False):
+            # Keep scenario constants once in the dimension table
+            if scenario_name not in self._scenarios:
+                first_row = scenario_df.iloc[0]
+                self._scenarios[scenario_name] = {
+                    'scenario_name': scenario_name,
+                    **{column: first_row[column] for column in SCENARIO_COLUMNS
+                       if column in scenario_df.columns}
+                }
+
+            steps_df = scenario_df.drop(
+                columns=['scenario_name'] + SCENARIO_COLUMNS, errors='ignore')
+            steps_df = steps_df.astype({
+                column: 'int64' if column in STEP_INTEGER_COLUMNS else 'float64'
+                for column in steps_df.columns if column != 'simulation_phase'
+            })
+            if 'simulation_phase' in steps_df.columns:
+                steps_df['simulation_phase'] = steps_df['simulation_phase'].astype(
+                    'category')
+
+            # Parts are numbered so reading them in name order preserves row order
+            part_number = self._part_numbers.get(scenario_name, 0)
+            self._part_numbers[scenario_name] = part_number + 1
+            partition_dir = get_scenario_partition_dir(self.path, scenario_name)
+            partition_dir.mkdir(exist_ok=True)
+            pq.write_table(
+                pa.Table.from_pandas(steps_df, preserve_index=False),
+                partition_dir / f'part-{part_number:05d}.parquet')
+
+    def _finish(self):
+        # Scenario rows keep the order in which scenarios were run
+        scenarios_df = pd.DataFrame(list(self._scenarios.values()))
+        pq.write_table(pa.Table.from_pandas(scenarios_df, preserve_index=False),
+                       self.path / 'scenarios.parquet')
@@ -1,20 +1,271 @@
-from utils import calculate_health_factor, get_health_status, get_protocol_status
-from models.engine import Engine
+from utils import (calculate_health_factor, calculate_health_factors, classify_health_factors,
+                   get_health_status, get_protocol_status, HEALTH_FACTOR_THRESHOLDS)
+from models.engine import Engine, VAULT_QUEUED, VAULT_IN_RECOVERY, VAULT_LIQUIDATED
+from models.multi_path_engine import MultiPathEngine
+from services.step_records import StepRecordBuffer, PathStepRecordBuffer
 from config.params import SIMULATION_PARAMS
+from profiler import NULL_PROFILER
+import importlib.util
+import sys
 import numpy as np
 import pandas as pd
-from datetime import datetime
 import os
 
+# Bump whenever a change alters simulation output - cached results made by
+# other model versions are then ignored
+MODEL_VERSION = 5
+
+# Memory the multi-path engine may use for one chunk of price paths
+DEFAULT_PATH_CHUNK_BYTES = 256 * 1024 * 1024
+
+# Step of an event that never happens
+NEVER = np.iinfo(np.int64).max
+
+# Size of an int object referenced from a Python list
+INT_OBJECT_BYTES = 28
+
+
+def first_step_below_threshold(threshold_prices, step_prices):
+    """
+    First step at which each vault's threshold price is above the step's price
+
+    Args:
+        threshold_prices (np.ndarray): Threshold price of each vault
+        step_prices (np.ndarray): Price at each step, never rising
+
+    Returns:
+        np.ndarray: Step of each vault, NEVER if the price never drops below it
+    """
+    steps = np.searchsorted(-step_prices, -threshold_prices, side='right')
+    return np.where(steps < len(step_prices), steps, NEVER)
+
+
+def first_step_below_health_factor(collateral, debt, step_prices, threshold, first_step=0):
+    """
+    First step at which each vault's health factor is below a threshold
+
+    Health factors are evaluated exactly as the engine does. They can only
+    fall while the price does, so the step is found by a vectorized binary
+    search over the steps.
+
+    Args:
+        collateral (np.ndarray): Collateral amount of each vault
+        debt (np.ndarray): Debt amount of each vault
+        step_prices (np.ndarray): Price at each step, never rising
+        threshold (float): Health factor threshold
+        first_step (int): First step to consider
+
+    Returns:
+        np.ndarray: Step of each vault, NEVER if it stays above the threshold
+    """
+    num_steps = len(step_prices)
+    low = np.full(len(collateral), first_step)
+    high = np.full(len(collateral), num_steps)
+    while np.any(low < high):
+        middle = (low + high) // 2
+        below = calculate_health_factors(
+            collateral, debt, step_prices[np.minimum(middle, num_steps - 1)]) < threshold
+        high = np.where(below, middle, high)
+        low = np.where(below, low, middle + 1)
+    return np.where(low < num_steps, low, NEVER)
+
+
+def count_by_step(event_steps, num_steps, weights=None):
+    """Number (or weight) of the events that happened at or before each step"""
+    happened = event_steps < num_steps
+    return np.bincount(
+        event_steps[happened], weights=None if weights is None else weights[happened],
+        minlength=num_steps).cumsum()
+
+
+class QueueRecurrence:
+    """
+    Liquidation and recovery queues of run_simulation as a recurrence over steps.
+
+    With a price that never rises, every vault's arrival step and the steps at
+    which it becomes insolvent or liquidatable are known up front, so they are
+    computed for the whole path in vectorized searches. The queues then become
+    slices of two arrays in FIFO order, and each step only moves the queue
+    heads and replays the reserve fund on the handful of vaults it processes.
+    The order of operations and the reserve fund arithmetic are those of
+    Engine, so the same vaults are liquidated at the same steps.
+    """
+
+    def __init__(self, engine, step_prices):
+        """
+        Precompute the queue events of a freshly created engine
+
+        Args:
+            engine (Engine): Engine whose vaults were just created
+            step_prices (np.ndarray): Price at step 0 (the start price) and at
+                each block of the price drop
+        """
+        vaults = engine.get_vaults()
+        self.collateral = vaults.collateral
+        self.debt = vaults.debt
+        self.step_prices = step_prices
+        self.last_price_step = len(step_prices) - 1
+
+        # Vaults join a queue at the first check below their liquidation price,
+        # ordered by step and then by index. Insolvent ones go to recovery.
+        arrival_steps = np.maximum(first_step_below_threshold(
+            engine.liquidation_index.threshold_prices, step_prices), 1)
+        queued = np.flatnonzero(arrival_steps != NEVER)
+        queued = queued[np.lexsort((queued, arrival_steps[queued]))]
+        queued_steps = arrival_steps[queued]
+        insolvent_on_arrival = engine.insolvency_index.threshold_prices[queued] > \
+            step_prices[queued_steps]
+
+        self.liquidation_queue = queued[~insolvent_on_arrival]
+        self.recovery_arrivals = queued[insolvent_on_arrival]
+        # Queue lengths including the arrivals of each step
+        all_steps = np.arange(len(step_prices))
+        self.liquidation_tails = np.searchsorted(
+            queued_steps[~insolvent_on_arrival], all_steps, side='right').tolist()
+        self.recovery_arrival_ends = np.searchsorted(
+            queued_steps[insolvent_on_arrival], all_steps, side='right').tolist()
+
+        # Steps from which a queued vault counts as insolvent or liquidatable
+        # when it is popped
+        self.insolvent_step = np.full(len(vaults), NEVER)
+        self.insolvent_step[queued] = first_step_below_health_factor(
+            self.collateral[queued], self.debt[queued], step_prices,
+            HEALTH_FACTOR_THRESHOLDS['INSOLVENCY'], first_step=1)
+        self.liquidatable_step = np.full(len(vaults), NEVER)
+        self.liquidatable_step[queued] = first_step_below_health_factor(
+            self.collateral[queued], self.debt[queued], step_prices,
+            engine.params['health_factor_liquidation_threshold'], first_step=1)
+
+        self.liquidation_head = 0
+        self.liquidation_tail = 0
+        self.recovery_queue = np.empty(len(queued), dtype=queued.dtype)
+        self.recovery_head = 0
+        self.recovery_tail = 0
+        self.recovery_arrivals_start = 0
+        self.liquidated_step = np.full(len(vaults), NEVER)
+        self.tracked = None
+        self.num_tracked_liquidated = 0
+
+        self.reserve_fund = engine.get_reserve_fund()
+        self.reserve_fund_used = engine.get_reserve_fund_used()
+        self.reserve_fund_depleted = engine.reserve_fund_depleted
+
+        self.step = 0
+        self.price_step = 0
+        self.price = float(step_prices[0])
+
+    def get_liquidation_queue_size(self):
+        return self.liquidation_tail - self.liquidation_head
+
+    def get_recovery_queue_size(self):
+        return self.recovery_tail - self.recovery_head
+
+    def nbytes(self):
+        """Bytes held by the queue and event arrays (and the step lists' ints)"""
+        arrays = (self.liquidation_queue, self.recovery_arrivals, self.recovery_queue,
+                  self.insolvent_step, self.liquidatable_step, self.liquidated_step)
+        step_lists = (self.liquidation_tails, self.recovery_arrival_ends)
+        return sum(array.nbytes for array in arrays) + sum(
+            sys.getsizeof(steps) + len(steps) * INT_OBJECT_BYTES for steps in step_lists)
+
+    def _append_to_recovery_queue(self, vaults):
+        self.recovery_queue[self.recovery_tail:self.recovery_tail + len(vaults)] = vaults
+        self.recovery_tail += len(vaults)
+
+    def track(self, mask):
+        """Count liquidations of the masked vaults from now on in num_tracked_liquidated"""
+        self.tracked = mask
+        self.num_tracked_liquidated = int(np.count_nonzero(
+            mask & (self.liquidated_step != NEVER)))
+
+    def _liquidate(self, vaults):
+        liquidated = vaults[self.liquidatable_step[vaults] <= self.price_step]
+        self.liquidated_step[liquidated] = self.step
+        if self.tracked is not None:
+            self.num_tracked_liquidated += int(np.count_nonzero(self.tracked[liquidated]))
+
+    def set_step(self, step):
+        """Move to a step and queue the vaults that arrive at it"""
+        self.step = step
+        self.price_step = min(step, self.last_price_step)
+        self.price = float(self.step_prices[self.price_step])
+
+        self.liquidation_tail = self.liquidation_tails[self.price_step]
+        recovery_arrivals_end = self.recovery_arrival_ends[self.price_step]
+        if recovery_arrivals_end > self.recovery_arrivals_start:
+            self._append_to_recovery_queue(
+                self.recovery_arrivals[self.recovery_arrivals_start:recovery_arrivals_end])
+            self.recovery_arrivals_start = recovery_arrivals_end
+
+    def process_liquidations(self, liquidations_to_process):
+        """Engine.process_liquidations on the queue slice"""
+        liquidations_this_step = 0
+        while (self.liquidation_head < self.liquidation_tail and
+               liquidations_this_step < liquidations_to_process):
+            batch_size = min(liquidations_to_process - liquidations_this_step,
+                             self.liquidation_tail - self.liquidation_head)
+            batch = self.liquidation_queue[
+                self.liquidation_head:self.liquidation_head + batch_size]
+            self.liquidation_head += batch_size
+
+            insolvent = self.insolvent_step[batch] <= self.price_step
+            self._append_to_recovery_queue(batch[insolvent])
+            to_liquidate = batch[~insolvent]
+            self._liquidate(to_liquidate)
+            liquidations_this_step += len(to_liquidate)
+
+    def process_insolvent_vaults_with_reserve_fund(self, recoveries_to_process):
+        """Engine.process_insolvent_vaults_with_reserve_fund on the queue slice"""
+        recoveries_this_step = 0
+        while (self.recovery_head < self.recovery_tail and
+               recoveries_this_step < recoveries_to_process):
+            batch_size = min(recoveries_to_process - recoveries_this_step,
+                             self.recovery_tail - self.recovery_head)
+            batch_start = self.recovery_head
+            batch = self.recovery_queue[batch_start:batch_start + batch_size]
+            self.recovery_head += batch_size
+            debt_amounts = self.debt[batch]
+
+            positions = np.flatnonzero(debt_amounts > 0)
+            candidates = batch[positions]
+            debt_amounts = debt_amounts[positions]
+            collateral_values = self.collateral[candidates] * self.price
+
+            flows = np.empty(2 * len(candidates))
+            flows[0::2] = -debt_amounts
+            flows[1::2] = collateral_values
+            balances = np.cumsum(np.concatenate(([self.reserve_fund], flows)))
+            affordable = balances[0:-1:2] >= debt_amounts
+            num_recovered = len(candidates) if affordable.all() \
+                else int(np.argmin(affordable))
+
+            self.reserve_fund = float(balances[2 * num_recovered])
+            self.reserve_fund_used = float(np.cumsum(
+                np.concatenate(([self.reserve_fund_used], debt_amounts[:num_recovered])))[-1])
+            self._liquidate(candidates[:num_recovered])
+            recoveries_this_step += num_recovered
+
+            if num_recovered < len(candidates):
+                self.recovery_head = batch_start + int(positions[num_recovered])
+                self.reserve_fund_depleted = True
+                break
+
 
 class Simulation:
-    def __init__(self, scenario_params=None, scenario_name="baseline"):
+    def __init__(self, scenario_params=None, scenario_name="baseline", rng=None,
+                 population=None, profiler=None):
         """
         Initialize simulation with optional scenario parameters
 
         Args:
             scenario_params (dict): Override parameters for this scenario
             scenario_name (str): Name of the scenario being run
+            rng (np.random.Generator): Random generator for the vault population,
+                defaults to the global NumPy random state
+            population (VaultBook, optional): Pre-generated vault population
+                shared with other simulations, used instead of sampling one
+            profiler (Profiler, optional): Records the wall time of each phase
+                and sub-step, and the engine's counters
         """
         # Initialize parameters with defaults, then override with scenario params
         self.params = SIMULATION_PARAMS.copy()
@@ -27,7 +278,8 @@ class Simulation:
             'scenario_description', 'Default scenario')
 
         # Initialize engine with scenario parameters
-        self.engine = Engine(self.params)
+        self.profiler = profiler or NULL_PROFILER
+        self.engine = Engine(self.params, rng, population, self.profiler)
 
         # Setup simulation parameters
         self.start_price = self.params['start_price']
@@ -49,27 +301,46 @@ class Simulation:
         self.price_path = np.linspace(
             self.start_price, self.end_price, self.blocks_during_price_drop)
 
-        # Initialize results storage
-        self.simulation_results = []
+        # Initialize results storage, sized for the price drop plus recovery
+        self.step_records = StepRecordBuffer(
+            constants=self._result_constants(),
+            start_price=self.start_price,
+            block_time=self.block_time,
+            capacity=self._max_recorded_steps(self.blocks_during_price_drop))
+        # Bytes held by the fast path's queue recurrence and threshold steps
+        self.fast_path_bytes = 0
 
-    def run_simulation(self, iteration=0, silent=False):
-        """Run the simulation and return results and distribution data"""
-        # Initialize vaults
-        self.engine.create_vaults()
+    def _result_constants(self, iteration=0):
+        """Step result columns that are constant for the run"""
+        return {
+            'scenario_name': self.scenario_name,
+            'scenario_description': self.scenario_description,
+            'iteration': iteration,
+            'num_vaults': self.params['num_vaults'],
+            'price_drop_duration': self.params['price_drop_duration'],
+            'collateralisation_ratio': self.params['collateralisation_ratio'],
+            'health_factor_mean': self.params['health_factor_mean'],
+            'health_factor_std': self.params['health_factor_std'],
+            'min_health_factor': self.params['min_health_factor'],
+            'liquidation_order': self.params.get('liquidation_order', 'fifo'),
+        }
 
-        # Collect initial health factors for reporting
-        initial_health_factors = [
-            vault.initial_health_factor for vault in self.engine.get_vaults()]
+    def _max_recorded_steps(self, num_blocks):
+        """Upper bound of the steps recorded for a price drop of num_blocks"""
+        max_recovery_steps = int(self.recovery_duration * 60 / self.block_time)
+        return min(num_blocks + max_recovery_steps, self.max_simulation_steps) + 1
 
-        # Calculate initial metrics
-        metrics = self.calculate_protocol_metrics()
+    def _distribution_data(self, iteration):
+        """Summary of the initial health factor distribution of the vaults"""
+        initial_health_factors = self.engine.get_vaults().initial_health_factor
+        # Vaults without debt, e.g. in a loaded snapshot, have no finite value
+        initial_health_factors = initial_health_factors[np.isfinite(initial_health_factors)]
 
         # Store histogram data for distribution DataFrame
         hist, bin_edges = np.histogram(
             initial_health_factors, bins=30, range=(100, 300))
 
-        # Create distribution data dictionary
-        distribution_data = {
+        return {
             'scenario_name': self.scenario_name,
             'scenario_description': self.scenario_description,
             'iteration': iteration,
@@ -84,6 +355,28 @@ class Simulation:
             'hf_std': float(np.std(initial_health_factors))
         }
 
+    def run_simulation(self, iteration=0, silent=False):
+        """Run the simulation and return the step results DataFrame and distribution data"""
+        self.step_records.constants['iteration'] = iteration
+
+        profiler = self.profiler
+
+        # Initialize vaults
+        with profiler.timer('create_vaults'):
+            self.engine.create_vaults()
+
+        # Calculate initial metrics
+        metrics = self.calculate_protocol_metrics()
+
+        # Collect the initial health factor distribution for reporting
+        distribution_data = self._distribution_data(iteration)
+
+        if self._can_use_fast_path(silent):
+            with profiler.timer('fast_path'):
+                self._run_fast_path()
+            with profiler.timer('build_results'):
+                return self.step_records.to_frame(), distribution_data
+
         # Store initial state in main results
         self._store_step_results(0, metrics, iteration, phase="initial")
 
@@ -95,91 +388,117 @@ class Simulation:
             self.print_protocol_status(metrics)
 
         # Run price drop phase
-        for step, price in enumerate(self.price_path, 1):
-            self.engine.set_price(price)
-            self.engine.check_and_queue_liquidations()
+        with profiler.timer('price_drop'):
+            for step, price in enumerate(self.price_path, 1):
+                self.engine.set_price(price)
+                with profiler.timer('check_and_queue_liquidations'):
+                    self.engine.check_and_queue_liquidations()
 
-            # Process both liquidations and recoveries during price drop phase
-            recoveries_to_process_during_liquidations = 5
-            liquidations_this_step = self.engine.max_liquidations_per_step
+                # Process both liquidations and recoveries during price drop phase
+                recoveries_to_process_during_liquidations = 5
+                liquidations_this_step = self.engine.max_liquidations_per_step
 
-            if (self.engine.get_recovery_queue_size() > 0 and
-                self.engine.get_liquidation_queue_size() > 0 and
-                    not self.engine.reserve_fund_depleted):
-                self.engine.process_insolvent_vaults_with_reserve_fund(
-                    recoveries_to_process_during_liquidations)
-                liquidations_this_step -= recoveries_to_process_during_liquidations
+                if (self.engine.get_recovery_queue_size() > 0 and
+                    self.engine.get_liquidation_queue_size() > 0 and
+                        not self.engine.reserve_fund_depleted):
+                    with profiler.timer('process_insolvent_vaults_with_reserve_fund'):
+                        self.engine.process_insolvent_vaults_with_reserve_fund(
+                            recoveries_to_process_during_liquidations)
+                    liquidations_this_step -= recoveries_to_process_during_liquidations
 
-            self.engine.process_liquidations(liquidations_this_step)
+                with profiler.timer('process_liquidations'):
+                    self.engine.process_liquidations(liquidations_this_step)
 
-            metrics = self.calculate_protocol_metrics()
-            self._store_step_results(
-                step, metrics, iteration, phase="price_drop")
+                with profiler.timer('calculate_protocol_metrics'):
+                    metrics = self.calculate_protocol_metrics()
+                with profiler.timer('store_step_results'):
+                    self._store_step_results(
+                        step, metrics, iteration, phase="price_drop")
 
-            if not silent and step % 5 == 0:
-                print(f"\nStep {step} (Price Drop Phase):")
-                self.print_protocol_status(metrics)
+                if not silent and step % 5 == 0:
+                    print(f"\nStep {step} (Price Drop Phase):")
+                    self.print_protocol_status(metrics)
 
         # Run recovery phase until all liquidatable vaults are processed or max steps reached
         recovery_step = 0
         max_recovery_steps = int(self.recovery_duration * 60 / self.block_time)
 
-        while True:
-            recovery_step += 1
-            total_step = step + recovery_step
+        with profiler.timer('recovery'):
+            while True:
+                recovery_step += 1
+                total_step = step + recovery_step
 
-            # Check termination conditions
-            if recovery_step > max_recovery_steps:
-                if not silent:
-                    print(
-                        f"\nReached maximum recovery duration ({self.recovery_duration} hours)")
-                break
+                # Check termination conditions
+                if recovery_step > max_recovery_steps:
+                    if not silent:
+                        print(
+                            f"\nReached maximum recovery duration ({self.recovery_duration} hours)")
+                    break
 
-            if total_step > self.max_simulation_steps:
-                if not silent:
-                    print(
-                        f"\nReached maximum simulation steps ({self.max_simulation_steps})")
-                break
+                if total_step > self.max_simulation_steps:
+                    if not silent:
+                        print(
+                            f"\nReached maximum simulation steps ({self.max_simulation_steps})")
+                    break
 
-            # Process liquidations at stable price
-            liquidations_this_step = self.engine.max_liquidations_per_step
-            recoveries_to_process_during_liquidations = 5
+                # Process liquidations at stable price
+                liquidations_this_step = self.engine.max_liquidations_per_step
+                recoveries_to_process_during_liquidations = 5
 
-            if (self.engine.get_recovery_queue_size() > 0 and
-                self.engine.get_liquidation_queue_size() > 0 and
-                    not self.engine.reserve_fund_depleted):
-                self.engine.process_insolvent_vaults_with_reserve_fund(
-                    recoveries_to_process_during_liquidations)
-                liquidations_this_step -= recoveries_to_process_during_liquidations
+                if (self.engine.get_recovery_queue_size() > 0 and
+                    self.engine.get_liquidation_queue_size() > 0 and
+                        not self.engine.reserve_fund_depleted):
+                    with profiler.timer('process_insolvent_vaults_with_reserve_fund'):
+                        self.engine.process_insolvent_vaults_with_reserve_fund(
+                            recoveries_to_process_during_liquidations)
+                    liquidations_this_step -= recoveries_to_process_during_liquidations
 
-            self.engine.check_and_queue_liquidations()
-            self.engine.process_liquidations(liquidations_this_step)
+                with profiler.timer('check_and_queue_liquidations'):
+                    self.engine.check_and_queue_liquidations()
+                with profiler.timer('process_liquidations'):
+                    self.engine.process_liquidations(liquidations_this_step)
 
-            metrics = self.calculate_protocol_metrics()
-            self._store_step_results(
-                total_step, metrics, iteration, phase="recovery")
+                with profiler.timer('calculate_protocol_metrics'):
+                    metrics = self.calculate_protocol_metrics()
+                with profiler.timer('store_step_results'):
+                    self._store_step_results(
+                        total_step, metrics, iteration, phase="recovery")
 
-            # Check if all liquidatable vaults have been processed
-            if (metrics['num_liquidatable_vaults'] == 0 and
-                    self.engine.get_liquidation_queue_size() == 0):
+                # Check if all liquidatable vaults have been processed
+                if (metrics['num_liquidatable_vaults'] == 0 and
+                        self.engine.get_liquidation_queue_size() == 0):
 
-                # Process any remaining insolvent vaults if reserve fund is available
-                if (self.engine.get_recovery_queue_size() > 0 and
-                        not self.engine.reserve_fund_depleted):
-                    self.engine.process_insolvent_vaults_with_reserve_fund(
-                        self.engine.max_liquidations_per_step)
-                else:
-                    if not silent:
-                        print(
-                            f"\nAll liquidatable vaults processed after {(recovery_step * self.block_time) / 60:.1f} hours of recovery")
-                    break
+                    # Process any remaining insolvent vaults if reserve fund is available
+                    if (self.engine.get_recovery_queue_size() > 0 and
+                            not self.engine.reserve_fund_depleted):
+                        with profiler.timer('process_insolvent_vaults_with_reserve_fund'):
+                            self.engine.process_insolvent_vaults_with_reserve_fund(
+                                self.engine.max_liquidations_per_step)
+                    else:
+                        if not silent:
+                            print(
+                                f"\nAll liquidatable vaults processed after {(recovery_step * self.block_time) / 60:.1f} hours of recovery")
+                        break
 
-            if not silent and recovery_step % 5 == 0:
-                # Calculate hours since price drop ended
-                recovery_hours = (recovery_step * self.block_time) / 60
-                print(
-                    f"\nStep {total_step} (Recovery Phase, {recovery_hours:.1f} hours after drop):")
-                self.print_protocol_status(metrics)
+                if not silent and recovery_step % 5 == 0:
+                    # Calculate hours since price drop ended
+                    recovery_hours = (recovery_step * self.block_time) / 60
+                    print(
+                        f"\nStep {total_step} (Recovery Phase, {recovery_hours:.1f} hours after drop):")
+                    self.print_protocol_status(metrics)
+
+                # Jump over the steps before the next event, recording them as one span
+                skipped_steps = self._steps_until_next_event(
+                    metrics, self.engine.get_liquidation_queue_size(),
+                    recovery_step, max_recovery_steps, total_step) - 1
+                if skipped_steps > 0:
+                    self.step_records.append_span(
+                        total_step + 1, skipped_steps, "recovery", metrics,
+                        self.engine.get_liquidation_queue_size())
+                    recovery_step += skipped_steps
+                    profiler.count('steps_skipped', skipped_steps)
+                    if not silent:
+                        print(f"\nNo further changes at this price, skipped {skipped_steps} steps")
 
         # Print final state
         if not silent:
@@ -192,130 +511,506 @@ class Simulation:
             print(
                 f"Total simulation time: {(total_step * self.block_time) / 60:.1f} hours")
 
-        return self.simulation_results, distribution_data
+        with profiler.timer('build_results'):
+            return self.step_records.to_frame(), distribution_data
 
-    def _store_step_results(self, step, metrics, iteration, phase="price_drop"):
-        """Store results for each simulation step"""
-        result = {
-            'scenario_name': self.scenario_name,
-            'scenario_description': self.scenario_description,
-            'iteration': iteration,
-            'step': step,
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'simulation_phase': phase,
-
-            # Price and timing metrics
-            'price': metrics['current_price'],
-            'price_drop_percentage': ((self.start_price - metrics['current_price']) /
-                                      self.start_price * 100),
-            'simulation_hour': (step * self.block_time) / 60,
-
-            # Protocol metrics
-            'total_collateral': metrics['total_collateral'],
-            'total_collateral_value': metrics['total_collateral_value'],
-            'total_debt': metrics['total_debt'],
-            'protocol_health_factor': metrics['protocol_health_factor'],
-            'total_insolvent_collateral': metrics['total_insolvent_collateral'],
-            'total_insolvent_collateral_value': metrics['total_insolvent_collateral_value'],
-            'total_debt_in_insolvent_vaults': metrics['total_debt_in_insolvent_vaults'],
-            # Vault metrics
-            'num_healthy_vaults': metrics['num_healthy_vaults'],
-            'num_at_risk_vaults': metrics['num_at_risk_vaults'],
-            'num_liquidatable_vaults': metrics['num_liquidatable_vaults'],
-            'num_liquidated_vaults': metrics['num_liquidated_vaults'],
-            'num_insolvent_vaults': metrics['num_insolvent_vaults'],
-
-            # Reserve fund metrics
-            'reserve_fund': metrics['reserve_fund'],
-            'initial_reserve_fund': metrics['initial_reserve_fund'],
-            'reserve_fund_used': metrics['reserve_fund_used'],
-            'reserve_fund_percentage': metrics['reserve_fund_percentage'],
-            'reserve_fund_used_percentage': metrics['reserve_fund_used_percentage'],
-
-            # Scenario parameters
-            'num_vaults': self.params['num_vaults'],
-            'price_drop_duration': self.params['price_drop_duration'],
-            'collateralisation_ratio': self.params['collateralisation_ratio'],
-            'health_factor_mean': self.params['health_factor_mean'],
-            'health_factor_std': self.params['health_factor_std'],
-            'min_health_factor': self.params['min_health_factor'],
+    def _steps_until_next_event(self, metrics, liquidation_queue_size, recovery_step,
+                                max_recovery_steps, total_step):
+        """
+        Recovery steps until the next one at which the engine state can change
+
+        The price is constant during recovery, so no vault crosses a threshold
+        and only queued vaults are processed. Recoveries run alongside
+        liquidations, or once nothing is liquidatable, and the reserve fund only
+        changes with them. So while liquidatable vaults remain but the
+        liquidation queue is empty, every later step repeats the current one and
+        the next event is the end of the run.
+
+        Returns:
+            int: 1 if the next step can differ, otherwise the number of steps
+                left before the step limits end the run, plus one
+        """
+        if liquidation_queue_size > 0 or metrics['num_liquidatable_vaults'] == 0:
+            return 1
+        steps_left = min(max_recovery_steps - recovery_step,
+                         self.max_simulation_steps - total_step)
+        return max(steps_left, 0) + 1
+
+    def _can_use_fast_path(self, silent):
+        """
+        Whether run_simulation can use the queue-recurrence fast path
+
+        The fast path does not print progress, cross-check the metrics, model
+        a rising price or order liquidations other than first come first
+        served; any of these falls back to the step engine. It assumes that
+        every popped vault that is not insolvent gets liquidated, which is
+        only checked at the default liquidation threshold, so other
+        thresholds fall back as well.
+        """
+        if not self.params.get('use_fast_path', True):
+            return False
+        if self.params.get('liquidation_order', 'fifo') != 'fifo':
+            return False
+        if self.params['health_factor_liquidation_threshold'] != \
+                SIMULATION_PARAMS['health_factor_liquidation_threshold']:
+            return False
+        if not silent or self.params.get('debug_metrics', False):
+            return False
+        step_prices = np.concatenate(([self.engine.get_price()], self.price_path))
+        return len(self.price_path) > 0 and bool(np.all(np.diff(step_prices) <= 0))
+
+    def _use_jit_kernel(self):
+        """Whether the fast path runs its queue steps in the compiled kernel"""
+        # Numba is only imported by runs that use the kernel: it adds tens of
+        # MB to every process that imports it
+        return bool(self.params.get('use_jit_kernel', False)) and \
+            importlib.util.find_spec('numba') is not None
+
+    def _run_fast_path(self):
+        """Run the steps of run_simulation on a QueueRecurrence and record them in bulk"""
+        engine = self.engine
+        accumulator = engine.metrics
+        num_blocks = len(self.price_path)
+        step_prices = np.concatenate(([engine.get_price()], self.price_path))
+        with self.profiler.timer('queue_recurrence'):
+            queues = QueueRecurrence(engine, step_prices)
+
+        # Step at which each vault's health factor drops below each category
+        # threshold, from the same threshold prices as the metrics
+        below_steps = {
+            'INSOLVENCY': first_step_below_threshold(
+                accumulator.insolvency_index.threshold_prices, step_prices),
+            'LIQUIDATION': first_step_below_threshold(
+                accumulator.liquidation_index.threshold_prices, step_prices),
+            'SAFE': first_step_below_threshold(
+                accumulator.safe_index.threshold_prices, step_prices),
         }
 
-        # Calculate additional metrics
-        if metrics['total_debt'] > 0:
-            result['collateralization_ratio'] = (
-                metrics['total_collateral_value'] / metrics['total_debt'] * 100
-            )
-        else:
-            result['collateralization_ratio'] = float('inf')
+        # The price no longer moves during recovery, so the liquidatable
+        # vaults are the active ones among those liquidatable at the last price
+        liquidatable_at_end = (below_steps['LIQUIDATION'] <= num_blocks) & \
+            (below_steps['INSOLVENCY'] > num_blocks)
+        self.fast_path_bytes = queues.nbytes() + liquidatable_at_end.nbytes + \
+            sum(below_step.nbytes for below_step in below_steps.values())
 
-        result['liquidation_queue_size'] = self.engine.get_liquidation_queue_size()
+        run_queue_steps = self._run_queue_kernel if self._use_jit_kernel() \
+            else self._run_queue_steps
+        reserve_funds, reserve_funds_used, liquidation_queue_sizes, skipped_steps = \
+            run_queue_steps(queues, num_blocks, liquidatable_at_end)
+        self.profiler.count('liquidation_queue_pushes', queues.liquidation_tail)
+        self.profiler.count('liquidation_queue_pops', queues.liquidation_head)
+        self.profiler.count('recovery_queue_pushes', queues.recovery_tail)
+        self.profiler.count('recovery_queue_pops', queues.recovery_head)
+        self.profiler.count('steps_skipped', skipped_steps)
 
-        self.simulation_results.append(result)
+        with self.profiler.timer('step_metrics'):
+            # Metrics of every step follow from the steps at which vaults were
+            # liquidated and crossed the category thresholds
+            num_steps = len(reserve_funds)
+            steps = np.arange(num_steps)
+            prices = step_prices[np.minimum(steps, num_blocks)]
+            collateral = engine.get_vaults().collateral
+            debt = engine.get_vaults().debt
+            liquidated_step = queues.liquidated_step
 
-    def calculate_protocol_metrics(self):
-        """Calculate key health metrics for the entire protocol"""
+            num_liquidated = count_by_step(liquidated_step, num_steps)
+            num_active = accumulator.num_active - num_liquidated
+            total_collateral = accumulator.total_collateral - \
+                count_by_step(liquidated_step, num_steps, collateral)
+            total_debt = accumulator.total_debt - \
+                count_by_step(liquidated_step, num_steps, debt)
+            total_collateral[num_active == 0] = 0.0
+            total_debt[num_active == 0] = 0.0
+
+            num_below = {}
+            for name, below_step in below_steps.items():
+                liquidated_below_step = np.maximum(liquidated_step, below_step)
+                num_below[name] = count_by_step(below_step, num_steps) - \
+                    count_by_step(liquidated_below_step, num_steps)
+                if name == 'INSOLVENCY':
+                    insolvent_collateral = count_by_step(below_step, num_steps, collateral) - \
+                        count_by_step(liquidated_below_step, num_steps, collateral)
+                    insolvent_debt = count_by_step(below_step, num_steps, debt) - \
+                        count_by_step(liquidated_below_step, num_steps, debt)
+                    insolvent_collateral[num_below[name] == 0] = 0.0
+                    insolvent_debt[num_below[name] == 0] = 0.0
+
+            initial_reserve_fund = engine.get_initial_reserve_fund()
+            metrics = {
+                'total_collateral': total_collateral,
+                'total_collateral_value': total_collateral * prices,
+                'total_debt': total_debt,
+                'num_healthy_vaults': num_active - num_below['SAFE'] - accumulator.num_without_debt,
+                'num_at_risk_vaults': num_below['SAFE'] - num_below['LIQUIDATION'],
+                'num_liquidatable_vaults': num_below['LIQUIDATION'] - num_below['INSOLVENCY'],
+                'num_liquidated_vaults': accumulator.num_liquidated + num_liquidated,
+                'num_insolvent_vaults': num_below['INSOLVENCY'],
+                'total_insolvent_collateral': insolvent_collateral,
+                'total_insolvent_collateral_value': insolvent_collateral * prices,
+                'total_debt_in_insolvent_vaults': insolvent_debt,
+                'protocol_health_factor': calculate_health_factors(
+                    total_collateral, total_debt, prices),
+                'current_price': prices,
+                'reserve_fund': reserve_funds,
+                'initial_reserve_fund': initial_reserve_fund,
+                'reserve_fund_used': reserve_funds_used,
+                'reserve_fund_percentage': reserve_funds / initial_reserve_fund * 100
+                if initial_reserve_fund > 0 else 0,
+                'reserve_fund_used_percentage': reserve_funds_used / initial_reserve_fund * 100
+                if initial_reserve_fund > 0 else 0,
+            }
+
+        with self.profiler.timer('store_step_results'):
+            phases = np.where(steps == 0, 0, np.where(steps <= num_blocks, 1, 2))
+            self.step_records.extend(steps, phases, metrics, np.array(liquidation_queue_sizes))
+            if skipped_steps > 0:
+                self.step_records.append_span(
+                    num_steps, skipped_steps, "recovery",
+                    {name: values[-1] if np.ndim(values) else values
+                     for name, values in metrics.items()},
+                    liquidation_queue_sizes[-1])
+
+        # Leave the engine in the state the step engine would have reached
+        liquidated = np.flatnonzero(liquidated_step != NEVER)
+        engine.vaults.mark_liquidated(liquidated)
+        engine.set_price(float(prices[-1]))
+        engine.reserve_fund = queues.reserve_fund
+        engine.reserve_fund_used = queues.reserve_fund_used
+        engine.reserve_fund_depleted = queues.reserve_fund_depleted
+        engine.liquidation_queue.clear()
+        engine.liquidation_queue.push(
+            queues.liquidation_queue[queues.liquidation_head:queues.liquidation_tail])
+        engine.recovery_queue.clear()
+        engine.recovery_queue.push(
+            queues.recovery_queue[queues.recovery_head:queues.recovery_tail])
+        # Popped vaults that were not liquidated are back to VAULT_ACTIVE
+        engine.vault_state[queues.liquidation_queue[
+            queues.liquidation_head:queues.liquidation_tail]] = VAULT_QUEUED
+        engine.vault_state[queues.recovery_queue[
+            queues.recovery_head:queues.recovery_tail]] = VAULT_IN_RECOVERY
+        engine.vault_state[liquidated] = VAULT_LIQUIDATED
+
+    def _run_queue_steps(self, queues, num_blocks, liquidatable_at_end):
+        """
+        Run the queue steps of the price drop and recovery phases
+
+        Args:
+            queues (QueueRecurrence): Queues of a freshly created engine
+            num_blocks (int): Number of price drop blocks
+            liquidatable_at_end (np.ndarray): Vaults liquidatable at the last price
+
+        Returns:
+            tuple: (reserve_funds, reserve_funds_used, liquidation_queue_sizes,
+                skipped_steps) - the first three hold one value per recorded
+                step, skipped_steps the length of the span that follows them
+        """
+        max_liquidations = self.engine.max_liquidations_per_step
+        recoveries_during_liquidations = 5
+        reserve_funds = [queues.reserve_fund]
+        reserve_funds_used = [queues.reserve_fund_used]
+        liquidation_queue_sizes = [0]
+
+        def run_step(step):
+            queues.set_step(step)
+            liquidations_this_step = max_liquidations
+            if (queues.get_recovery_queue_size() > 0 and
+                queues.get_liquidation_queue_size() > 0 and
+                    not queues.reserve_fund_depleted):
+                queues.process_insolvent_vaults_with_reserve_fund(
+                    recoveries_during_liquidations)
+                liquidations_this_step -= recoveries_during_liquidations
+            queues.process_liquidations(liquidations_this_step)
+
+            reserve_funds.append(queues.reserve_fund)
+            reserve_funds_used.append(queues.reserve_fund_used)
+            liquidation_queue_sizes.append(queues.get_liquidation_queue_size())
+
+        # Run price drop phase
+        with self.profiler.timer('price_drop'):
+            for step in range(1, num_blocks + 1):
+                run_step(step)
+
+        # Run recovery phase
+        num_liquidatable_at_end = int(np.count_nonzero(liquidatable_at_end))
+        queues.track(liquidatable_at_end)
+        max_recovery_steps = int(self.recovery_duration * 60 / self.block_time)
+        recovery_step = 0
+        skipped_steps = 0
+        with self.profiler.timer('recovery'):
+            while True:
+                recovery_step += 1
+                total_step = num_blocks + recovery_step
+                if recovery_step > max_recovery_steps or total_step > self.max_simulation_steps:
+                    break
+
+                run_step(total_step)
+
+                num_liquidatable = num_liquidatable_at_end - queues.num_tracked_liquidated
+                if num_liquidatable == 0 and queues.get_liquidation_queue_size() == 0:
+                    if (queues.get_recovery_queue_size() > 0 and
+                            not queues.reserve_fund_depleted):
+                        # These recoveries come after the step was recorded, so
+                        # they show up in the next step
+                        queues.set_step(total_step + 1)
+                        queues.process_insolvent_vaults_with_reserve_fund(max_liquidations)
+                    else:
+                        break
+
+                skipped_steps = self._steps_until_next_event(
+                    {'num_liquidatable_vaults': num_liquidatable},
+                    queues.get_liquidation_queue_size(),
+                    recovery_step, max_recovery_steps, total_step) - 1
+                if skipped_steps > 0:
+                    break
+
+        return (np.array(reserve_funds), np.array(reserve_funds_used),
+                np.array(liquidation_queue_sizes), skipped_steps)
+
+    def _run_queue_kernel(self, queues, num_blocks, liquidatable_at_end):
+        """
+        _run_queue_steps in the compiled kernel of models/queue_kernel.py
+
+        The queue state moves into typed arrays for the two phase calls and
+        back into the QueueRecurrence afterwards.
+        """
+        from models import queue_kernel
+
+        max_liquidations = self.engine.max_liquidations_per_step
+        recoveries_during_liquidations = 5
+        max_recovery_steps = int(self.recovery_duration * 60 / self.block_time)
+        capacity = max(self._max_recorded_steps(num_blocks), num_blocks + 1)
+
+        state = np.zeros(queue_kernel.NUM_STATE_SLOTS, dtype=np.int64)
+        state[queue_kernel.RESERVE_FUND_DEPLETED] = queues.reserve_fund_depleted
+        funds = np.zeros(queue_kernel.NUM_FUND_SLOTS)
+        funds[queue_kernel.RESERVE_FUND] = queues.reserve_fund
+        funds[queue_kernel.RESERVE_FUND_USED] = queues.reserve_fund_used
+        # Liquidations of the tracked vaults are counted from the start, which
+        # leaves the same count at the start of recovery as tracking from there
+        arrays = (queues.liquidation_queue,
+                  np.asarray(queues.liquidation_tails, dtype=np.int64),
+                  queues.recovery_arrivals,
+                  np.asarray(queues.recovery_arrival_ends, dtype=np.int64),
+                  queues.recovery_queue, queues.insolvent_step, queues.liquidatable_step,
+                  queues.liquidated_step, liquidatable_at_end)
+        collateral = np.ascontiguousarray(queues.collateral)
+        debt = np.ascontiguousarray(queues.debt)
+
+        reserve_funds = np.empty(capacity)
+        reserve_funds_used = np.empty(capacity)
+        liquidation_queue_sizes = np.empty(capacity, dtype=np.int64)
+        reserve_funds[0] = queues.reserve_fund
+        reserve_funds_used[0] = queues.reserve_fund_used
+        liquidation_queue_sizes[0] = 0
+
+        with self.profiler.timer('price_drop'):
+            queue_kernel.run_price_drop_phase(
+                num_blocks, max_liquidations, recoveries_during_liquidations, queues.step_prices,
+                collateral, debt, state, funds, arrays,
+                reserve_funds, reserve_funds_used, liquidation_queue_sizes)
+        with self.profiler.timer('recovery'):
+            num_steps, skipped_steps = queue_kernel.run_recovery_phase(
+                num_blocks, max_recovery_steps, self.max_simulation_steps,
+                int(np.count_nonzero(liquidatable_at_end)), max_liquidations,
+                recoveries_during_liquidations, queues.step_prices, collateral, debt,
+                state, funds, arrays, reserve_funds, reserve_funds_used, liquidation_queue_sizes)
+
+        queues.step = int(state[queue_kernel.STEP])
+        queues.price_step = int(state[queue_kernel.PRICE_STEP])
+        queues.price = float(queues.step_prices[queues.price_step])
+        queues.liquidation_head = int(state[queue_kernel.LIQUIDATION_HEAD])
+        queues.liquidation_tail = int(state[queue_kernel.LIQUIDATION_TAIL])
+        queues.recovery_head = int(state[queue_kernel.RECOVERY_HEAD])
+        queues.recovery_tail = int(state[queue_kernel.RECOVERY_TAIL])
+        queues.recovery_arrivals_start = int(state[queue_kernel.RECOVERY_ARRIVALS_START])
+        queues.reserve_fund_depleted = bool(state[queue_kernel.RESERVE_FUND_DEPLETED])
+        queues.reserve_fund = float(funds[queue_kernel.RESERVE_FUND])
+        queues.reserve_fund_used = float(funds[queue_kernel.RESERVE_FUND_USED])
+
+        return (reserve_funds[:num_steps], reserve_funds_used[:num_steps],
+                liquidation_queue_sizes[:num_steps], int(skipped_steps))
+
+    def run_price_paths(self, price_paths, iteration=0, max_chunk_bytes=DEFAULT_PATH_CHUNK_BYTES):
+        """
+        Simulate many price paths against one vault population
+
+        Every path follows the same steps as run_simulation, with its own
+        liquidation queues and reserve fund: the row of prices drives the price
+        drop phase (one price per block) and the recovery phase holds the
+        path's last price. Paths are simulated together in chunks that fit
+        max_chunk_bytes.
+
+        Args:
+            price_paths (array-like): (paths x blocks) price matrix
+            iteration (int): Iteration number
+            max_chunk_bytes (int): Memory budget of one chunk of paths
+
+        Returns:
+            tuple: (results_df, distribution_data) - results_df holds the steps
+                of every path with a 'path' column
+
+        Paths need not fall monotonically. On a V-shaped path, vaults popped
+        after the price recovered are queued again when it falls back, as in
+        run_simulation:
+
+        >>> from models.vault_book import VaultBook
+        >>> vaults = VaultBook.generate({**SIMULATION_PARAMS, 'num_vaults': 500},
+        ...                             np.random.default_rng(1))
+        >>> simulation = Simulation({'num_vaults': 500, 'txs_per_block': 2}, population=vaults)
+        >>> drop = np.linspace(1, 0.6, 30) * simulation.start_price
+        >>> simulation.price_path = np.concatenate((drop, drop[::-1], drop))
+        >>> steps, _ = simulation.run_simulation(silent=True)  # doctest: +ELLIPSIS
+        Total debt: ...
+        >>> paths, _ = simulation.run_price_paths([simulation.price_path])  # doctest: +ELLIPSIS
+        Total debt: ...
+        >>> paths.drop(columns='path').equals(steps)
+        True
+        """
+        price_paths = np.atleast_2d(np.asarray(price_paths, dtype=np.float64))
+        num_paths, num_blocks = price_paths.shape
+        if num_blocks == 0:
+            raise ValueError("price_paths needs at least one block")
+        if self.params.get('liquidation_order', 'fifo') != 'fifo':
+            raise ValueError("run_price_paths only supports the 'fifo' liquidation order")
+
+        # One vault population is shared by every path
+        self.engine.create_vaults()
+        vaults = self.engine.get_vaults()
+        distribution_data = self._distribution_data(iteration)
+
+        paths_per_chunk = max(
+            1, max_chunk_bytes // max(1, MultiPathEngine.bytes_per_path(len(vaults))))
+        results = [
+            self._run_path_chunk(vaults, price_paths[start:start + paths_per_chunk],
+                                 start, iteration)
+            for start in range(0, num_paths, paths_per_chunk)
+        ]
+
+        return pd.concat(results, ignore_index=True), distribution_data
+
+    def _run_path_chunk(self, vaults, price_paths, first_path, iteration):
+        """Run the steps of run_simulation for a chunk of paths at once"""
+        num_paths, num_blocks = price_paths.shape
+        engine = MultiPathEngine(vaults, num_paths, self.params)
+        records = PathStepRecordBuffer(
+            constants=self._result_constants(iteration),
+            start_price=self.start_price,
+            block_time=self.block_time,
+            num_paths=num_paths,
+            first_path=first_path,
+            capacity=self._max_recorded_steps(num_blocks))
+        max_liquidations = engine.max_liquidations_per_step
+        recoveries_during_liquidations = 5
+
+        def recovery_limits(paths):
+            # Recoveries run alongside liquidations while both queues are busy
+            recovering = paths & (engine.get_recovery_queue_sizes() > 0) & \
+                (engine.get_liquidation_queue_sizes() > 0) & ~engine.reserve_fund_depleted
+            return np.where(recovering, recoveries_during_liquidations, 0)
+
+        records.append(0, 'initial', engine.get_metrics(),
+                       engine.get_liquidation_queue_sizes())
+
+        # Run price drop phase
+        all_paths = np.ones(num_paths, dtype=bool)
+        for step in range(1, num_blocks + 1):
+            engine.set_prices(price_paths[:, step - 1])
+            engine.check_and_queue_liquidations()
+
+            recoveries = recovery_limits(all_paths)
+            engine.process_insolvent_vaults_with_reserve_fund(recoveries)
+            engine.process_liquidations(max_liquidations - recoveries)
+
+            records.append(step, 'price_drop', engine.get_metrics(),
+                           engine.get_liquidation_queue_sizes())
+
+        # Run recovery phase until every path processed its liquidatable
+        # vaults or the step limits are reached
+        max_recovery_steps = int(self.recovery_duration * 60 / self.block_time)
+        running = all_paths.copy()
+        recovery_step = 0
+        while running.any():
+            recovery_step += 1
+            total_step = num_blocks + recovery_step
+            if recovery_step > max_recovery_steps or total_step > self.max_simulation_steps:
+                break
+
+            recoveries = recovery_limits(running)
+            engine.process_insolvent_vaults_with_reserve_fund(recoveries)
+            engine.check_and_queue_liquidations()
+            engine.process_liquidations(
+                np.where(running, max_liquidations - recoveries, 0))
+
+            metrics = engine.get_metrics()
+            records.append(total_step, 'recovery', metrics,
+                           engine.get_liquidation_queue_sizes(), recorded=running)
+
+            # Paths without liquidatable vaults spend the rest of the step on
+            # recoveries, or finish once there is nothing left to recover
+            processed = running & (metrics['num_liquidatable_vaults'] == 0) & \
+                (engine.get_liquidation_queue_sizes() == 0)
+            final_recoveries = processed & (engine.get_recovery_queue_sizes() > 0) & \
+                ~engine.reserve_fund_depleted
+            engine.process_insolvent_vaults_with_reserve_fund(
+                np.where(final_recoveries, max_liquidations, 0))
+            running &= ~(processed & ~final_recoveries)
+
+        return records.to_frame()
+
+    def _store_step_results(self, step, metrics, iteration, phase="price_drop"):
+        """Store results for each simulation step"""
+        self.step_records.append(
+            step, phase, metrics, self.engine.get_liquidation_queue_size())
+
+    def memory_usage(self):
+        """
+        Bytes held by the simulation's data structures
+
+        Returns:
+            dict: The engine's vault_storage, price_indexes and queues, plus
+                fast_path (the queue recurrence of the last fast path run) and
+                step_records
+        """
+        return {
+            **self.engine.memory_usage(),
+            'fast_path': self.fast_path_bytes,
+            'step_records': self.step_records.nbytes(),
+        }
+
+    def calculate_vault_metrics_full(self):
+        """Recompute vault totals and category counts with a full pass over all vaults"""
         vaults = self.engine.get_vaults()
         current_price = self.engine.get_price()
 
-        # Initialize counters
-        total_collateral = 0
-        total_collateral_value = 0
-        total_debt = 0
-        num_healthy_vaults = 0
-        num_at_risk_vaults = 0
-        num_liquidatable_vaults = 0
-        num_liquidated_vaults = 0
-        num_insolvent_vaults = 0
-        total_insolvent_collateral = 0
-        total_insolvent_collateral_value = 0
-        total_debt_in_insolvent_vaults = 0
-
-        # Import thresholds from utils
-        from utils import HEALTH_FACTOR_THRESHOLDS
-
-        # Single pass through all vaults
-        for vault in vaults:
-            # Get basic vault metrics
-            collateral_amount = vault.get_collateral_amount()
-            collateral_value = vault.get_collateral_value(current_price)
-            debt_amount = vault.get_debt_amount()
-            health_factor = vault.calculate_health_factor(current_price)
+        # Whole-population vault metrics
+        collateral_amounts = vaults.collateral
+        debt_amounts = vaults.debt
+        health_factors = vaults.calculate_health_factors(current_price)
 
-            # Accumulate totals
-            total_collateral += collateral_amount
-            total_collateral_value += collateral_value
-            total_debt += debt_amount
-
-            # Categorize vault
-            if collateral_amount == 0:
-                num_liquidated_vaults += 1
-            elif health_factor < HEALTH_FACTOR_THRESHOLDS['INSOLVENCY']:
-                num_insolvent_vaults += 1
-                total_insolvent_collateral += collateral_amount
-                total_insolvent_collateral_value += collateral_value
-                total_debt_in_insolvent_vaults += debt_amount
-            elif health_factor >= HEALTH_FACTOR_THRESHOLDS['SAFE'] and health_factor != float('inf'):
-                num_healthy_vaults += 1
-            elif HEALTH_FACTOR_THRESHOLDS['LIQUIDATION'] <= health_factor < HEALTH_FACTOR_THRESHOLDS['SAFE']:
-                num_at_risk_vaults += 1
-            elif health_factor < HEALTH_FACTOR_THRESHOLDS['LIQUIDATION']:
-                num_liquidatable_vaults += 1
+        # Accumulate totals
+        total_collateral = float(collateral_amounts.sum())
+        total_collateral_value = float(
+            vaults.collateral_values(current_price).sum())
+        total_debt = float(debt_amounts.sum())
 
-        # Protocol health factor (similar to vault health factor but protocol-wide)
-        protocol_health_factor = calculate_health_factor(
-            total_collateral, total_debt, current_price)
+        # Categorize vaults (vaults without debt belong to no category)
+        categories = classify_health_factors(
+            health_factors, collateral_amounts, debt_amounts,
+            liquidated=collateral_amounts == 0)
 
-        # Get reserve fund information
-        reserve_fund = self.engine.get_reserve_fund()
-        initial_reserve_fund = self.engine.get_initial_reserve_fund()
-        reserve_fund_used = self.engine.get_reserve_fund_used()
+        num_liquidated_vaults = categories['LIQUIDATED']['count']
+        num_insolvent_vaults = categories['INSOLVENT']['count']
+        num_healthy_vaults = categories['HEALTHY']['count']
+        num_at_risk_vaults = categories['AT_RISK']['count']
+        num_liquidatable_vaults = categories['LIQUIDATABLE']['count']
+        total_insolvent_collateral = categories['INSOLVENT']['collateral']
+        total_insolvent_collateral_value = total_insolvent_collateral * current_price
+        total_debt_in_insolvent_vaults = categories['INSOLVENT']['debt']
 
         return {
             'total_collateral': total_collateral,
             'total_collateral_value': total_collateral_value,
             'total_debt': total_debt,
-            'protocol_health_factor': protocol_health_factor,
             'num_healthy_vaults': num_healthy_vaults,
             'num_at_risk_vaults': num_at_risk_vaults,
             'num_liquidatable_vaults': num_liquidatable_vaults,
@@ -324,6 +1019,46 @@ class Simulation:
             'total_insolvent_collateral': total_insolvent_collateral,
             'total_insolvent_collateral_value': total_insolvent_collateral_value,
             'total_debt_in_insolvent_vaults': total_debt_in_insolvent_vaults,
+        }
+
+    def _check_vault_metrics(self, vault_metrics, expected_metrics):
+        """Raise if the incremental vault metrics drift from a full recompute"""
+        for key, expected in expected_metrics.items():
+            actual = vault_metrics[key]
+            if key.startswith('num_'):
+                matches = actual == expected
+            else:
+                matches = np.isclose(actual, expected, rtol=1e-9, atol=1e-6)
+            if not matches:
+                raise AssertionError(
+                    f"Incremental metric {key} = {actual} does not match "
+                    f"full recompute {expected} at price {self.engine.get_price()}")
+
+    def calculate_protocol_metrics(self):
+        """Calculate key health metrics for the entire protocol"""
+        current_price = self.engine.get_price()
+
+        # Vault totals and category counts are maintained incrementally
+        vault_metrics = self.engine.metrics.snapshot(current_price)
+        if self.params.get('debug_metrics', False):
+            self._check_vault_metrics(
+                vault_metrics, self.calculate_vault_metrics_full())
+
+        total_collateral = vault_metrics['total_collateral']
+        total_debt = vault_metrics['total_debt']
+
+        # Protocol health factor (similar to vault health factor but protocol-wide)
+        protocol_health_factor = calculate_health_factor(
+            total_collateral, total_debt, current_price)
+
+        # Get reserve fund information
+        reserve_fund = self.engine.get_reserve_fund()
+        initial_reserve_fund = self.engine.get_initial_reserve_fund()
+        reserve_fund_used = self.engine.get_reserve_fund_used()
+
+        return {
+            **vault_metrics,
+            'protocol_health_factor': protocol_health_factor,
             'current_price': current_price,
             'reserve_fund': reserve_fund,
             'initial_reserve_fund': initial_reserve_fund,
@@ -404,11 +1139,9 @@ class Simulation:
                   f"{status:^10}")
 
         print("-"*80)
-        total_collateral = sum(v.get_collateral_amount()
-                               for v in vaults)
-        total_debt = sum(v.get_debt_amount() for v in vaults)
-        total_collateral_value = sum(
-            v.get_collateral_value(current_price) for v in vaults)
+        total_collateral = vaults.collateral.sum()
+        total_debt = vaults.debt.sum()
+        total_collateral_value = vaults.collateral_values(current_price).sum()
         print(f"{'TOTALS':^10} | {total_collateral:>13,.0f} | "
               f"${total_collateral_value:>13,.0f} | ${total_debt:>13,.0f} |")
         print("="*80)
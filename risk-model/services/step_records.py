@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+
+SIMULATION_PHASES = ('initial', 'price_drop', 'recovery')
+
+# Per-step values stored in the buffer and their types
+STEP_FIELDS = {
+    'step': np.int64,
+    'simulation_phase': np.int8,
+    'price': np.float64,
+    'total_collateral': np.float64,
+    'total_collateral_value': np.float64,
+    'total_debt': np.float64,
+    'protocol_health_factor': np.float64,
+    'total_insolvent_collateral': np.float64,
+    'total_insolvent_collateral_value': np.float64,
+    'total_debt_in_insolvent_vaults': np.float64,
+    'num_healthy_vaults': np.int64,
+    'num_at_risk_vaults': np.int64,
+    'num_liquidatable_vaults': np.int64,
+    'num_liquidated_vaults': np.int64,
+    'num_insolvent_vaults': np.int64,
+    'reserve_fund': np.float64,
+    'initial_reserve_fund': np.float64,
+    'reserve_fund_used': np.float64,
+    'reserve_fund_percentage': np.float64,
+    'reserve_fund_used_percentage': np.float64,
+    'liquidation_queue_size': np.int64,
+}
+
+# Column order of the step results DataFrame
+RESULT_COLUMNS = [
+    'scenario_name', 'scenario_description', 'iteration', 'step', 'simulation_phase',
+    'price', 'price_drop_percentage', 'simulation_hour',
+    'total_collateral', 'total_collateral_value', 'total_debt', 'protocol_health_factor',
+    'total_insolvent_collateral', 'total_insolvent_collateral_value',
+    'total_debt_in_insolvent_vaults',
+    'num_healthy_vaults', 'num_at_risk_vaults', 'num_liquidatable_vaults',
+    'num_liquidated_vaults', 'num_insolvent_vaults',
+    'reserve_fund', 'initial_reserve_fund', 'reserve_fund_used',
+    'reserve_fund_percentage', 'reserve_fund_used_percentage',
+    'num_vaults', 'price_drop_duration', 'collateralisation_ratio',
+    'health_factor_mean', 'health_factor_std', 'min_health_factor', 'liquidation_order',
+    'collateralization_ratio', 'liquidation_queue_size',
+]
+
+# Column order of multi-path step results: the path number follows the iteration
+PATH_RESULT_COLUMNS = RESULT_COLUMNS[:3] + ['path'] + RESULT_COLUMNS[3:]
+
+
+class StepRecordBuffer:
+    """
+    Preallocated, growable column arrays holding one simulation's step results.
+
+    Each step writes its values into typed NumPy columns instead of building a
+    dict. Values that are constant for the run (scenario name, parameters) are
+    stored once, and values derived from other columns are computed in bulk
+    when the DataFrame is built.
+
+    A run of identical consecutive steps can be stored as a single span entry
+    covering num_steps steps; spans are only expanded into one row per step
+    when a dense DataFrame is built.
+    """
+
+    result_columns = RESULT_COLUMNS
+
+    def __init__(self, constants, start_price, block_time, capacity=1024):
+        """
+        Initialize the buffer
+
+        Args:
+            constants (dict): Columns that are constant for the run
+            start_price (float): Start price, used for price_drop_percentage
+            block_time (float): Block time in minutes, used for simulation_hour
+            capacity (int): Number of steps to preallocate
+        """
+        self.constants = constants
+        self.start_price = start_price
+        self.block_time = block_time
+        self.size = 0
+        self.columns = {name: self._allocate(capacity, dtype)
+                        for name, dtype in STEP_FIELDS.items()}
+        # Number of consecutive steps each entry stands for
+        self.columns['num_steps'] = self._allocate(capacity, np.int64)
+
+    def _allocate(self, capacity, dtype):
+        return np.empty(capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.columns['step'])
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self.capacity)
+        for name, column in self.columns.items():
+            grown = self._allocate(capacity, column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def append(self, step, phase, metrics, liquidation_queue_size):
+        """
+        Record one simulation step
+
+        Args:
+            step (int): Step number
+            phase (str): Simulation phase, one of SIMULATION_PHASES
+            metrics (dict): Protocol metrics of the step
+            liquidation_queue_size (int): Size of the liquidation queue
+        """
+        if self.size == self.capacity:
+            self._grow(self.size + 1)
+
+        index = self.size
+        columns = self.columns
+        columns['step'][index] = step
+        columns['simulation_phase'][index] = SIMULATION_PHASES.index(phase)
+        columns['price'][index] = metrics['current_price']
+        columns['liquidation_queue_size'][index] = liquidation_queue_size
+        columns['num_steps'][index] = 1
+        for name in STEP_FIELDS:
+            if name in metrics:
+                columns[name][index] = metrics[name]
+        self.size += 1
+
+    def append_span(self, first_step, num_steps, phase, metrics, liquidation_queue_size):
+        """
+        Record a run of consecutive steps with identical metrics as one entry
+
+        Args:
+            first_step (int): Step number of the first step of the run
+            num_steps (int): Number of steps in the run
+            phase (str): Simulation phase, one of SIMULATION_PHASES
+            metrics (dict): Protocol metrics shared by the steps
+            liquidation_queue_size (int): Size of the liquidation queue
+        """
+        self.append(first_step, phase, metrics, liquidation_queue_size)
+        self.columns['num_steps'][self.size - 1] = num_steps
+
+    def extend(self, steps, phases, metrics, liquidation_queue_sizes):
+        """
+        Record many steps at once
+
+        Args:
+            steps (np.ndarray): Step numbers
+            phases (np.ndarray): Index of each step's phase in SIMULATION_PHASES
+            metrics (dict): Protocol metrics, arrays over the steps (or scalars)
+            liquidation_queue_sizes (np.ndarray): Size of the liquidation queue
+        """
+        count = len(steps)
+        if self.size + count > self.capacity:
+            self._grow(self.size + count)
+
+        rows = slice(self.size, self.size + count)
+        columns = self.columns
+        columns['step'][rows] = steps
+        columns['simulation_phase'][rows] = phases
+        columns['price'][rows] = metrics['current_price']
+        columns['liquidation_queue_size'][rows] = liquidation_queue_sizes
+        columns['num_steps'][rows] = 1
+        for name in STEP_FIELDS:
+            if name in metrics:
+                columns[name][rows] = metrics[name]
+        self.size += count
+
+    def nbytes(self):
+        """Memory held by the column arrays"""
+        return sum(column.nbytes for column in self.columns.values())
+
+    def num_steps(self):
+        """Number of steps recorded, counting every step of a span"""
+        return int(self.columns['num_steps'][:self.size].sum())
+
+    def _frame_columns(self, dense=True):
+        data = {name: column[:self.size]
+                for name, column in self.columns.items()}
+        spans = data['num_steps']
+        if dense and np.any(spans > 1):
+            # Expand spans, numbering the steps within each from its first step
+            data = {name: np.repeat(values, spans) for name, values in data.items()}
+            span_starts = np.repeat(np.cumsum(spans) - spans, spans)
+            data['step'] = data['step'] + (np.arange(len(data['step'])) - span_starts)
+        return data
+
+    def to_frame(self, dense=True):
+        """
+        Build the step results DataFrame from the recorded columns
+
+        Args:
+            dense (bool): Expand spans into one row per step. Otherwise spans
+                stay single rows and a num_steps column gives their lengths.
+        """
+        data = self._frame_columns(dense)
+
+        data['simulation_phase'] = pd.Categorical.from_codes(
+            data['simulation_phase'], categories=list(SIMULATION_PHASES))
+        data['price_drop_percentage'] = (
+            (self.start_price - data['price']) / self.start_price * 100)
+        data['simulation_hour'] = (data['step'] * self.block_time) / 60
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data['collateralization_ratio'] = np.where(
+                data['total_debt'] > 0,
+                data['total_collateral_value'] / data['total_debt'] * 100,
+                np.inf)
+
+        # Constants are broadcast by the DataFrame constructor
+        data.update(self.constants)
+        columns = self.result_columns if dense else self.result_columns + ['num_steps']
+        return pd.DataFrame(
+            {column: data[column] for column in columns if column in data},
+            copy=False)
+
+
+class PathStepRecordBuffer(StepRecordBuffer):
+    """
+    Step results of many price paths, recorded for all paths at once.
+
+    Every column holds one row per step and one entry per path. Paths that
+    already finished are masked out of later steps, and the DataFrame lists
+    the rows path by path.
+    """
+
+    result_columns = PATH_RESULT_COLUMNS
+
+    def __init__(self, constants, start_price, block_time, num_paths,
+                 first_path=0, capacity=1024):
+        """
+        Initialize the buffer
+
+        Args:
+            constants (dict): Columns that are constant for the run
+            start_price (float): Start price, used for price_drop_percentage
+            block_time (float): Block time in minutes, used for simulation_hour
+            num_paths (int): Number of paths recorded together
+            first_path (int): Path number of the first path
+            capacity (int): Number of steps to preallocate
+        """
+        self.num_paths = num_paths
+        self.first_path = first_path
+        super().__init__(constants, start_price, block_time, capacity)
+        self.columns['recorded'] = self._allocate(capacity, bool)
+
+    def _allocate(self, capacity, dtype):
+        return np.empty((capacity, self.num_paths), dtype=dtype)
+
+    def append(self, step, phase, metrics, liquidation_queue_size, recorded=True):
+        """
+        Record one simulation step of every path
+
+        Args:
+            step (int): Step number
+            phase (str): Simulation phase, one of SIMULATION_PHASES
+            metrics (dict): Protocol metrics of the step, arrays over the paths
+            liquidation_queue_size (np.ndarray): Liquidation queue size of each path
+            recorded (np.ndarray or bool): Paths for which the step is recorded
+        """
+        super().append(step, phase, metrics, liquidation_queue_size)
+        self.columns['recorded'][self.size - 1] = recorded
+
+    def _frame_columns(self, dense=True):
+        recorded = self.columns['recorded'][:self.size].T
+        data = {name: column[:self.size].T[recorded]
+                for name, column in self.columns.items() if name != 'recorded'}
+        data['path'] = self.first_path + np.nonzero(recorded)[0]
+        return data
@@ -0,0 +1,122 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from models.vault_book import VaultBook
+from utils import calculate_health_factors
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Accepted column names of the collateral and debt amounts in a snapshot
+SNAPSHOT_COLUMNS = {
+    'collateral': ('collateral', 'collateral_amount'),
+    'debt': ('debt', 'debt_amount'),
+}
+
+
+def _resolve_columns(path, available):
+    """Map each snapshot field to the column holding it"""
+    columns = {}
+    for field, names in SNAPSHOT_COLUMNS.items():
+        found = [name for name in names if name in available]
+        if not found:
+            raise ValueError(
+                f"{path} has no {field} column, expected one of {', '.join(names)}")
+        columns[field] = found[0]
+    return columns
+
+
+def _csv_chunks(path, chunk_size):
+    """Yield (collateral, debt) arrays of a CSV snapshot, chunk by chunk"""
+    header = pd.read_csv(path, nrows=0).columns
+    columns = _resolve_columns(path, header)
+    reader = pd.read_csv(path, usecols=list(columns.values()), chunksize=chunk_size,
+                         float_precision='round_trip')
+    for chunk in reader:
+        yield (pd.to_numeric(chunk[columns['collateral']], errors='coerce').to_numpy(np.float64),
+               pd.to_numeric(chunk[columns['debt']], errors='coerce').to_numpy(np.float64))
+
+
+def _parquet_chunks(path, chunk_size):
+    """Yield (collateral, debt) arrays of a Parquet snapshot, batch by batch"""
+    if pq is None:
+        raise ImportError(
+            "Loading Parquet snapshots requires pyarrow: pip install pyarrow")
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    columns = _resolve_columns(path, parquet_file.schema_arrow.names)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                           columns=list(columns.values())):
+        yield tuple(batch.column(columns[field]).to_numpy(zero_copy_only=False)
+                    .astype(np.float64, copy=False) for field in ('collateral', 'debt'))
+
+
+def _validate_chunk(path, first_row, collateral, debt):
+    """Raise a ValueError naming the first invalid row of a chunk"""
+    checks = (
+        (~np.isfinite(collateral) | ~np.isfinite(debt), 'missing or non-numeric amount'),
+        ((collateral < 0) | (debt < 0), 'negative amount'),
+        ((collateral == 0) & (debt > 0), 'debt without collateral'),
+    )
+    for invalid, reason in checks:
+        if invalid.any():
+            row = first_row + int(np.argmax(invalid)) + 1
+            raise ValueError(f"{path}: {reason} in data row {row}")
+
+
+def load_vault_snapshot(path, start_price, chunk_size=100_000):
+    """
+    Load a snapshot of real vaults as a vault population
+
+    The file is read chunk by chunk straight into the population's arrays,
+    so a snapshot is never held as a whole DataFrame. It needs a collateral
+    and a debt column (see SNAPSHOT_COLUMNS), other columns are ignored.
+    Every row is validated and rows of closed vaults, without collateral or
+    debt, are skipped. Initial health factors are computed from the amounts
+    at the start price; vaults without debt get an infinite one.
+
+    Args:
+        path (str): CSV file, or Parquet file (.parquet) which requires pyarrow
+        start_price (float): Collateral price the simulation starts at
+        chunk_size (int): Number of rows read at a time
+
+    Returns:
+        VaultBook: The population, simulations work on clones of it
+    """
+    path = Path(path)
+    if path.suffix in ('.parquet', '.pq'):
+        chunks = _parquet_chunks(path, chunk_size)
+    else:
+        chunks = _csv_chunks(path, chunk_size)
+
+    # Buffers grow by doubling, so loading stays linear in the number of rows
+    collateral = np.empty(chunk_size, dtype=np.float64)
+    debt = np.empty(chunk_size, dtype=np.float64)
+    num_rows = 0
+    num_vaults = 0
+    for chunk_collateral, chunk_debt in chunks:
+        _validate_chunk(path, num_rows, chunk_collateral, chunk_debt)
+        num_rows += len(chunk_collateral)
+
+        keep = (chunk_collateral > 0) | (chunk_debt > 0)
+        chunk_collateral = chunk_collateral[keep]
+        chunk_debt = chunk_debt[keep]
+        end = num_vaults + len(chunk_collateral)
+        if end > len(collateral):
+            size = max(2 * len(collateral), end)
+            collateral = np.resize(collateral, size)
+            debt = np.resize(debt, size)
+        collateral[num_vaults:end] = chunk_collateral
+        debt[num_vaults:end] = chunk_debt
+        num_vaults = end
+
+    if num_vaults == 0:
+        raise ValueError(f"{path} holds no open vaults")
+
+    collateral = collateral[:num_vaults].copy()
+    debt = debt[:num_vaults].copy()
+    print(f"Loaded {num_vaults} vaults from {path} "
+          f"({num_rows - num_vaults} closed vaults skipped)")
+    return VaultBook.wrap(collateral, debt,
+                          calculate_health_factors(collateral, debt, start_price))
@@ -1,4 +1,5 @@
 from config.params import SIMULATION_PARAMS
+import numpy as np
 
 # Health factor thresholds
 HEALTH_FACTOR_THRESHOLDS = {
@@ -7,6 +8,18 @@ HEALTH_FACTOR_THRESHOLDS = {
     'SAFE': 150            # Below this is at risk, above is healthy
 }
 
+# Health statuses in the order of the codes returned by get_health_status_codes.
+# NO_DEBT marks active vaults with an infinite health factor.
+HEALTH_STATUSES = ('INSOLVENT', 'LIQUIDATABLE', 'AT_RISK',
+                   'HEALTHY', 'NO_DEBT', 'LIQUIDATED')
+
+# Bin edges separating INSOLVENT | LIQUIDATABLE | AT_RISK | HEALTHY
+HEALTH_STATUS_BINS = np.array([
+    HEALTH_FACTOR_THRESHOLDS['INSOLVENCY'],
+    HEALTH_FACTOR_THRESHOLDS['LIQUIDATION'],
+    HEALTH_FACTOR_THRESHOLDS['SAFE'],
+])
+
 
 def calculate_health_factor(collateral_amount, debt_amount, price):
     """Calculate health factor for a given collateral and debt amount"""
@@ -17,11 +30,38 @@ def calculate_health_factor(collateral_amount, debt_amount, price):
     return (max_allowed_debt / debt_amount) * 100
 
 
+def calculate_health_factors(collateral_amounts, debt_amounts, price):
+    """
+    Vectorized calculate_health_factor for arrays of vaults
+
+    Args:
+        collateral_amounts (array-like): Collateral amount of each vault
+        debt_amounts (array-like): Debt amount of each vault
+        price (float or array-like): Collateral price, broadcast against the vaults
+
+    Returns:
+        np.ndarray: Health factors, inf where a vault has no debt
+    """
+    collateral_amounts = np.asarray(collateral_amounts, dtype=np.float64)
+    debt_amounts = np.asarray(debt_amounts, dtype=np.float64)
+    collateral_value = collateral_amounts * price
+    max_allowed_debt = calculate_max_allowed_debt(collateral_value)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        health_factors = (max_allowed_debt / debt_amounts) * 100
+    return np.where(debt_amounts == 0, np.inf, health_factors)
+
+
 def calculate_max_allowed_debt(collateral_value):
     """Calculate maximum allowed debt for a given collateral value"""
     return collateral_value / SIMULATION_PARAMS['collateralisation_ratio'] * 100
 
 
+def calculate_threshold_price(collateral_amount, debt_amount, health_factor):
+    """Calculate the price at which a vault's health factor equals the given value"""
+    return (health_factor / 100 * debt_amount *
+            SIMULATION_PARAMS['collateralisation_ratio'] / 100 / collateral_amount)
+
+
 def get_health_status(health_factor):
     """
     Get the health status of a vault based on its health factor
@@ -44,6 +84,80 @@ def get_health_status(health_factor):
         return "HEALTHY"
 
 
+def get_health_status_codes(health_factors, liquidated=None):
+    """
+    Classify health factors into indices of HEALTH_STATUSES
+
+    Args:
+        health_factors (array-like): Health factors to classify
+        liquidated (array-like, optional): Boolean mask of liquidated vaults.
+            A health factor of 0 is also treated as liquidated.
+
+    Returns:
+        np.ndarray: Status code of each health factor
+    """
+    health_factors = np.asarray(health_factors, dtype=np.float64)
+    codes = np.digitize(health_factors, HEALTH_STATUS_BINS)
+    codes[np.isposinf(health_factors)] = HEALTH_STATUSES.index('NO_DEBT')
+    codes[health_factors == 0] = HEALTH_STATUSES.index('LIQUIDATED')
+    if liquidated is not None:
+        codes[np.asarray(liquidated, dtype=bool)] = HEALTH_STATUSES.index(
+            'LIQUIDATED')
+    return codes
+
+
+def get_health_statuses(health_factors, liquidated=None):
+    """
+    Vectorized get_health_status
+
+    Args:
+        health_factors (array-like): Health factors of the vaults
+        liquidated (array-like, optional): Boolean mask of liquidated vaults
+
+    Returns:
+        np.ndarray: The health status of each vault
+    """
+    codes = get_health_status_codes(health_factors, liquidated)
+    # Vaults without debt are reported as healthy, like get_health_status
+    codes[codes == HEALTH_STATUSES.index('NO_DEBT')] = HEALTH_STATUSES.index(
+        'HEALTHY')
+    return np.array(HEALTH_STATUSES)[codes]
+
+
+def classify_health_factors(health_factors, collateral_amounts=None, debt_amounts=None,
+                            liquidated=None):
+    """
+    Count vaults and sum their collateral and debt per health status
+
+    Args:
+        health_factors (array-like): Health factors of the vaults
+        collateral_amounts (array-like, optional): Collateral amount of each vault
+        debt_amounts (array-like, optional): Debt amount of each vault
+        liquidated (array-like, optional): Boolean mask of liquidated vaults
+
+    Returns:
+        dict: Status name -> {'count', 'collateral', 'debt'} for every entry of
+            HEALTH_STATUSES (sums are 0 when the amounts are not given)
+    """
+    codes = get_health_status_codes(health_factors, liquidated)
+    num_statuses = len(HEALTH_STATUSES)
+
+    counts = np.bincount(codes, minlength=num_statuses)
+    collateral_sums = np.zeros(num_statuses) if collateral_amounts is None else \
+        np.bincount(codes, weights=collateral_amounts, minlength=num_statuses)
+    debt_sums = np.zeros(num_statuses) if debt_amounts is None else \
+        np.bincount(codes, weights=debt_amounts, minlength=num_statuses)
+
+    return {
+        status: {
+            'count': int(counts[code]),
+            'collateral': float(collateral_sums[code]),
+            'debt': float(debt_sums[code]),
+        }
+        for code, status in enumerate(HEALTH_STATUSES)
+    }
+
+
 def get_health_status_label(health_factor):
     """
     Get a human-readable health status label with threshold information
@@ -105,6 +219,37 @@ def get_protocol_status(protocol_health_factor, num_active_vaults):
         return "HEALTHY - Protocol stable"
 
 
+def get_protocol_statuses(protocol_health_factors, num_active_vaults):
+    """
+    Vectorized get_protocol_status
+
+    Args:
+        protocol_health_factors (array-like): Protocol health factors
+        num_active_vaults (array-like): Number of active vaults for each health factor
+
+    Returns:
+        np.ndarray: The status of the protocol for each entry
+    """
+    protocol_health_factors = np.asarray(
+        protocol_health_factors, dtype=np.float64)
+    num_active_vaults = np.asarray(num_active_vaults)
+    return np.select(
+        [
+            num_active_vaults == 0,
+            protocol_health_factors < HEALTH_FACTOR_THRESHOLDS['INSOLVENCY'],
+            protocol_health_factors < HEALTH_FACTOR_THRESHOLDS['LIQUIDATION'],
+            protocol_health_factors < HEALTH_FACTOR_THRESHOLDS['SAFE'],
+        ],
+        [
+            "All vaults liquidated",
+            "CRITICAL - Protocol insolvent",
+            "SEVERE - Protocol below overcollateralisation ratio",
+            "WARNING - Protocol at risk",
+        ],
+        default="HEALTHY - Protocol stable"
+    )
+
+
 def format_currency(amount):
     """Format amount as currency"""
     return f"${amount:,.2f}"